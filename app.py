@@ -1,495 +1,237 @@
-import io
-import csv
-
-from flask import Flask, render_template, request, redirect, url_for, flash, Response
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+from flask import Flask, render_template, request, redirect, url_for, flash, Response, stream_with_context, \
+    jsonify, send_file, abort, g
+from collections import defaultdict
 from datetime import datetime
-from sqlalchemy import or_
-
-from config import Config
-from vars import etherscan_key, basescan_key, coingecko_key
-from models import db, Transaction, Lot, COINGECKO_ASSET_MAPPING
-from forms import TransactionForm
-
-from currency_converter import CurrencyConverter
-
-# Initialize currency converter
-currency_converter = CurrencyConverter(fallback_on_missing_rate=True)
+from sqlalchemy import or_, and_, event
+from sqlalchemy.exc import OperationalError
+
+from config import Config, COST_BASIS_METHOD, JOBS_DIR, LOG_LEVEL, LOG_FORMAT, DEBUG_FOOTER
+from models import db, Transaction, Lot, Holding, LotSelection, GainsSummary, GainsRun, Job, get_gains_state, \
+    mark_dirty, create_tables, COINGECKO_ASSET_MAPPING
+from forms import TransactionForm, TRANSACTION_TYPES
+from prices import price_store
+from backfill import backfill_prices
+from kraken import import_kraken_stream
+from chains import sync_wallets
+from gains import LEDGER_COLUMNS, COST_BASIS_METHODS, find_balance_errors, normalize_method
+from jobs import JobRunner
+from gains_store import calculate_gains, iter_disposals_csv
+from storage import bulk_update
+from metrics import configure_logging, render as render_metrics, query_counter, HTTP_REQUESTS, HTTP_LATENCY
+
+configure_logging(LOG_LEVEL, LOG_FORMAT)
+logger = logging.getLogger(__name__)
 
-import requests
-
-def calculate_gains(selected_year=None):
+def fetch_historical_price_range(coin_id, transaction_time, vs_currency="usd"):
     """
-    Calculate gains for all transactions and manage the Lot table.
+    Return the closest historical USD price to a transaction timestamp, using the
+    local price store and fetching from CoinGecko's Market Chart Range API as needed.
+    :param coin_id: Asset symbol (e.g., "ETH"), mapped through COINGECKO_ASSET_MAPPING.
+    :param transaction_time: Datetime object representing the transaction time.
+    :param vs_currency: Target currency (only "usd" is stored).
+    :return: The closest price to the transaction time.
     """
+    if(coin_id not in COINGECKO_ASSET_MAPPING):
+        logger.warning("Asset has no CoinGecko ID", extra={"asset": coin_id})
+        return 0.0
+    if vs_currency != "usd":
+        raise ValueError(f"Unsupported currency: {vs_currency}")
 
-    # A place to store CSV lines for partial-lot disposals
-    disposal_lines = []
-
-    # Step 1: Clear and repopulate lots
-    print("Clearing existing lots...")
-    Lot.query.delete()  # Deletes all rows in the Lot table
-    db.session.commit()
+    closest_price = price_store.get_price(coin_id, int(transaction_time.timestamp()))
+    logger.debug("Closest price found", extra={"asset": coin_id, "price": closest_price})
+    return closest_price
 
-    print("Populating lots for BUY transactions...")
-    buy_transactions = Transaction.query.filter_by(transaction_type="BUY").order_by(Transaction.transaction_date).all()
-    for buy_tx in buy_transactions:
-        print(f"Adding lot for {buy_tx.to_asset} with remaining {buy_tx.to_amount}")
-        new_lot = Lot(
-            transaction_id=buy_tx.id,
-            asset_name=buy_tx.to_asset,
-            remaining_amount=buy_tx.to_amount,
-            buy_price=buy_tx.to_asset_cost_basis,
-            transaction_date=buy_tx.transaction_date
-        )
-        db.session.add(new_lot)
+def refresh_balance_errors():
+    """
+    Recompute Transaction.balance_error with one running-balance sweep over
+    the ledger, if the ledger changed since the last sweep. Run by the jobs,
+    never by a page: with a large ledger the sweep takes seconds.
+    :return: Number of transactions whose error changed.
+    """
+    state = get_gains_state()
+    if not state.errors_stale:
+        return 0
+
+    columns = [getattr(Transaction, name) for name in LEDGER_COLUMNS]
+    rows = db.session.query(*columns, Transaction.balance_error) \
+        .order_by(Transaction.transaction_date, Transaction.id).all()
+    errors = find_balance_errors(rows)
+
+    # Only write back the rows whose error changed
+    changed = [
+        {"id": row.id, "balance_error": errors[row.id]}
+        for row in rows if errors[row.id] != row.balance_error
+    ]
+    bulk_update(db.session, Transaction, changed)
+    state.errors_stale = False
     db.session.commit()
+    return len(changed)
 
-    # Step 2: Process all SELL, SWAP, and gas-related transactions
-    transactions = Transaction.query.order_by(Transaction.transaction_date).all()
-    for tx in transactions:
 
-        # Compute the USD->EUR conversion rate
-        conversion_rate = currency_converter.convert(1.0, "USD", "EUR", date=tx.transaction_date)
+app = Flask(__name__)
+app.config.from_object(Config)
+db.init_app(app)
 
-        # Process SELL or SWAP transactions for asset gains
-        if tx.transaction_type in ["SELL", "SWAP"]:
-    
-            sell_amount = tx.from_amount
-            short_term_gains = 0
-            long_term_gains = 0
-            cost_basis = 0
-
-            # Allocate lots using FIFO
-            lots = Lot.query.filter_by(asset_name=tx.from_asset).order_by(Lot.transaction_date).all()
-            for lot in lots:
-                if sell_amount <= 0:
-                    break
-
-                if lot.remaining_amount == 0:
-                    continue  # Skip empty lots
-
-                # Determine how much to allocate from this lot
-                if sell_amount <= lot.remaining_amount:
-                    allocated_amount = sell_amount
-                    lot.remaining_amount -= sell_amount
-                    sell_amount = 0
-                else:
-                    allocated_amount = lot.remaining_amount
-                    sell_amount -= lot.remaining_amount
-                    lot.remaining_amount = 0
-
-                # Calculate overall cost basis
-                cost_basis += allocated_amount * lot.buy_price
-
-                # Cost basis for this chunk
-                chunk_cost = allocated_amount * lot.buy_price
-                # Proceeds for this chunk
-                chunk_proceeds = allocated_amount * tx.from_asset_price_usd
-                # Gains for this chunk
-                chunk_gain = chunk_proceeds - chunk_cost
-
-                # Determine short-term or long-term
-                holding_period_days = (tx.transaction_date - lot.transaction_date).days
-                is_short = (holding_period_days < 365)
-
-                # If we want to record partial-lot disposal lines:
-                if selected_year and tx.tax_year == int(selected_year):
-                    # Build CSV line
-                    disposal_lines.append(build_csv_line(
-                        asset=tx.from_asset,
-                        quantity=allocated_amount,
-                        date_acquired=lot.transaction_date,
-                        date_sold=tx.transaction_date,
-                        proceeds=chunk_proceeds,
-                        cost_basis=chunk_cost,
-                        is_short=is_short
-                    ))
-
-                # Update the total short or long term gains.
-                if is_short:
-                    short_term_gains += allocated_amount * tx.from_asset_price_usd - (allocated_amount * lot.buy_price)
-                else:
-                    long_term_gains += allocated_amount * tx.from_asset_price_usd - (allocated_amount * lot.buy_price)
-
-            # Handle remaining amount error
-            if sell_amount > 0:
-                tx.error = "SELL exceeds available BUY lots"
-            else:
-                # Assign calculated values to the transaction
-                proceeds = tx.from_amount * tx.from_asset_price_usd
-                #tx.gains_usd = proceeds - cost_basis
-                tx.gains_usd_short = short_term_gains
-                tx.gains_usd_long = long_term_gains
-
-                # Convert gains to EUR if necessary (assumes conversion rate is available)
-                tx.gains_eur_short = short_term_gains * conversion_rate
-                tx.gains_eur_long = long_term_gains * conversion_rate
-
-        # Process gas gains for transactions with gas fees in a non-fiat asset
-        gas_fees = tx.gas_fees
-        if tx.gas_asset and gas_fees > 0:
-            print(f"Processing gas gains for {tx.gas_asset}")
-            gas_price_usd = tx.gas_asset_price_usd or 0
-            proceeds = gas_fees * gas_price_usd
-            short_term_gains = 0
-            long_term_gains = 0
-            cost_basis = 0
-
-            # Allocate lots for the gas asset
-            lots = Lot.query.filter_by(asset_name=tx.gas_asset).order_by(Lot.transaction_date).all()
-            for lot in lots:
-                if gas_fees <= 0:
-                    break
-
-                if lot.remaining_amount == 0:
-                    continue  # Skip empty lots
-
-                # Determine how much to allocate from this lot
-                if gas_fees <= lot.remaining_amount:
-                    allocated_amount = gas_fees
-                    lot.remaining_amount -= gas_fees
-                    gas_fees = 0
-                else:
-                    allocated_amount = lot.remaining_amount
-                    gas_fees -= lot.remaining_amount
-                    lot.remaining_amount = 0
-
-                # Calculate cost basis
-                cost_basis += allocated_amount * lot.buy_price
-
-                # Cost basis for gas chunk
-                chunk_cost = allocated_amount * lot.buy_price
-                # Proceeds for gas chunk
-                chunk_proceeds = allocated_amount * (tx.gas_asset_price_usd or 0)
-                # Gains
-                chunk_gain = chunk_proceeds - chunk_cost
-
-                # Determine short-term or long-term gains
-                holding_period_days = (tx.transaction_date - lot.transaction_date).days
-                is_short = (holding_period_days < 365)
-                
-                # If we want to record partial-lot disposal lines:
-                if selected_year and tx.tax_year == int(selected_year):
-                    # Build CSV line for gas disposal
-                    disposal_lines.append(build_csv_line(
-                        asset=tx.gas_asset,
-                        quantity=allocated_amount,
-                        date_acquired=lot.transaction_date,
-                        date_sold=tx.transaction_date,
-                        proceeds=chunk_proceeds,
-                        cost_basis=chunk_cost,
-                        is_short=is_short
-                    ))
-
-                if is_short:
-                    short_term_gains += allocated_amount * gas_price_usd - (allocated_amount * lot.buy_price)
-                else:
-                    long_term_gains += allocated_amount * gas_price_usd - (allocated_amount * lot.buy_price)
-
-            # Handle error if gas fees exceed available lots
-            if gas_fees > 0:
-                tx.error = "Gas fees exceed available lots for the gas asset."
-            else:
-                # Assign calculated values to the transaction
-                #tx.gains_gas_usd = proceeds - cost_basis
-                tx.gains_gas_usd_short = short_term_gains
-                tx.gains_gas_usd_long = long_term_gains
-
-                # Convert to EUR if necessary (assumes conversion rate is available)
-                tx.gains_gas_eur_short = short_term_gains * conversion_rate
-                tx.gains_gas_eur_long = long_term_gains * conversion_rate
-
-        # Save changes to lots and transactions
-        db.session.commit()
+with app.app_context():
+    create_tables()
+    event.listen(db.engine, "before_cursor_execute", query_counter.on_execute)
 
-    # Step 3: After computing everything, if selected_year is set,
-    # produce a CSV from the disposal_lines
-    if selected_year:
-        return build_csv_string(disposal_lines)
-    else:
-        return None
+# Size of the chunks an upload is copied to disk in
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-    print("Gains calculation completed.")
+runner = JobRunner(app)
 
-def build_csv_line(asset, quantity, date_acquired, date_sold, proceeds, cost_basis, is_short):
+@runner.handler("gains", coalesce_running=False)
+def run_gains_job(progress, method, tax_year=None):
     """
-    Return a tuple: (Security Description, Quantity, Date Acquired, Date Sold, Proceeds, Cost Basis, Term)
+    Recalculate the gains, then write the capital gains CSV of a tax year if one was asked for.
     """
-    security_desc = f"CRYPTO {asset}"
-    quantity_str = f"{quantity:.8f}"
-    date_acq_str = date_acquired.strftime("%Y-%m-%d")
-    date_sold_str = date_sold.strftime("%Y-%m-%d")
-    proceeds_str = f"{proceeds:.8f}"
-    cost_basis_str = f"{cost_basis:.8f}"
-    term_flag = "C" if is_short else "F"  # e.g. "C" for short, "F" for long
-
-    return (security_desc, quantity_str, date_acq_str, date_sold_str, proceeds_str, cost_basis_str, term_flag)
-
+    replayed = calculate_gains(progress=progress, method=method)
+    refresh_balance_errors()
+    if not tax_year:
+        return {"replayed": replayed, "method": method}, None
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=JOBS_DIR, prefix=f"capgains_{tax_year}_", suffix=".csv")
+    with os.fdopen(fd, "w", newline="") as f:
+        f.writelines(iter_disposals_csv(tax_year, method))
+    return {"replayed": replayed, "method": method, "tax_year": tax_year}, path
+
+@runner.handler("import_kraken")
+def run_import_job(progress, path, filename):
+    """
+    Import a saved Kraken upload, then delete it.
+    """
+    with open(path, "rb") as f:
+        total = max(sum(1 for _ in f) - 1, 0)  # Minus the header
+    with open(path, "rb") as f:
+        result = import_kraken_stream(f, progress=lambda done: progress(done, total))
+    os.remove(path)
+    refresh_balance_errors()
+    return dict(result, filename=filename), None
+
+@runner.handler("sync")
+def run_sync_job(progress, wallets):
+    inserted, errors = sync_wallets(wallets, progress=progress)
+    refresh_balance_errors()
+    return {"inserted": inserted, "errors": errors}, None
+
+@runner.handler("backfill")
+def run_backfill_job(progress):
+    result = backfill_prices(progress=progress)
+    refresh_balance_errors()
+    return result, None
+
+@runner.handler("balance_errors", coalesce_running=False)
+def run_balance_errors_job(progress):
+    return {"changed": refresh_balance_errors()}, None
+
+def queue_balance_errors():
+    """
+    Queue a balance error sweep if the ledger changed since the last one.
+    Called once a write has been committed.
+    """
+    if get_gains_state().errors_stale:
+        runner.enqueue("balance_errors")
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    query_counter.start(request.endpoint or "unmatched")
+
+@app.before_request
+def resume_jobs():
+    # Done on the first request rather than at import, so that the reloader's
+    # parent process does not run jobs too
+    if not runner.resumed:
+        runner.resume()
+        # Catch up with ledger changes made by the CLI or a schema upgrade
+        queue_balance_errors()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or "unmatched"
+    HTTP_REQUESTS.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    HTTP_LATENCY.observe(elapsed, endpoint=endpoint)
+    if DEBUG_FOOTER and response.mimetype == "text/html" and not response.is_streamed:
+        footer = render_template("debug_footer.html", elapsed_ms=elapsed * 1000, queries=query_counter.count)
+        response.set_data(response.get_data(as_text=True).replace("</body>", footer + "</body>"))
+    return response
+
+@app.errorhandler(OperationalError)
+def database_locked(e):
+    """
+    On SQLite a gains run holds the only write lock until it commits; a write
+    that waited SQLITE_BUSY_TIMEOUT seconds for it fails, and is reported here
+    instead of as a server error.
+    """
+    if "database is locked" not in str(e.orig):
+        raise e
+    db.session.rollback()
+    logger.warning("Write failed on a locked database", extra={"endpoint": request.endpoint})
+    flash("The database is busy writing gains results. Please try again once the calculation is done.", "danger")
+    return redirect(url_for("view_jobs"))
 
-def build_csv_string(disposal_lines):
-    import io, csv
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Security Description", "Quantity", "Date Acquired", "Date Sold", "Proceeds", "Cost Basis", "Term"])
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
-    for line in disposal_lines:
-        writer.writerow(line)
 
-    return output.getvalue()
+# Number of transactions shown per page on the index
+PAGE_SIZE = 100
 
+# Number of open lots shown per page
+LOTS_PAGE_SIZE = 100
 
-def update_gains_summary(tax_year):
-    transactions = Transaction.query.filter_by(tax_year=tax_year).all()
-    short_term_gains = sum(t.gains_usd for t in transactions if t.is_short_term)
-    long_term_gains = sum(t.gains_usd for t in transactions if not t.is_short_term)
-    staking_rewards = sum(t.to_asset_cost_basis for t in transactions if t.transaction_type == "STAKE")
-    airdrops = sum(t.to_asset_cost_basis for t in transactions if t.transaction_type == "CLAIM")
-    gas_fees = sum(t.gas_fees for t in transactions)
-    
-    net_gain = short_term_gains + long_term_gains + staking_rewards + airdrops - gas_fees
-    
-    # Update or create the summary
-    summary = GainsSummary.query.filter_by(tax_year=tax_year).first()
-    if not summary:
-        summary = GainsSummary(tax_year=tax_year)
-        db.session.add(summary)
-    summary.total_short_term_gains = short_term_gains
-    summary.total_long_term_gains = long_term_gains
-    summary.total_staking_rewards = staking_rewards
-    summary.total_airdrops = airdrops
-    summary.total_gas_fees = gas_fees
-    summary.net_gain_usd = net_gain
-    db.session.commit()
+# Number of most recent jobs listed on the jobs page
+JOBS_SHOWN = 50
 
-def fetch_historical_price_range(coin_id, transaction_time, vs_currency="usd"):
+def selected_method():
     """
-    Fetch the closest historical price to a transaction timestamp using CoinGecko's Market Chart Range API.
-    :param coin_id: CoinGecko coin ID (e.g., "ethereum").
-    :param transaction_time: Datetime object representing the transaction time.
-    :param vs_currency: Target currency (e.g., "usd").
-    :return: The closest price to the transaction time.
+    Cost basis method asked for in the query string, or the default one.
     """
-    # Convert transaction time to UNIX timestamp
-    transaction_timestamp = int(transaction_time.timestamp())
-    
-    # Define range: ±1 day to ensure we get relevant data
-    range_start = transaction_timestamp - 86400  # 1 day before
-    range_end = transaction_timestamp + 86400  # 1 day after
-    
-    # Make the API request
-    if(coin_id in COINGECKO_ASSET_MAPPING):
-        gecko_id = COINGECKO_ASSET_MAPPING[coin_id]
-    else:
-        print(f"Warning: {coin_id} not in COINGECKO_ASSET_MAPPING")
-        return 0.0
-    url = f"https://api.coingecko.com/api/v3/coins/{gecko_id}/market_chart/range"
-    params = {
-        "vs_currency": vs_currency,
-        "from": range_start,
-        "to": range_end,
-    }
-    response = requests.get(url, params=params)
-    if response.status_code != 200:
-        raise Exception(f"Error fetching price range: {response.status_code}, {response.text}")
-    
-    # Parse the response
-    data = response.json()
-    prices = data.get("prices", [])
-    if not prices:
-        raise ValueError("No price data found for the given range.")
-    
-    # Find the closest price
-    closest_price = None
-    smallest_diff = float("inf")
-    for price_data in prices:
-        timestamp, price = price_data
-        diff = abs(transaction_timestamp - (timestamp // 1000))  # Convert ms to seconds
-        if diff < smallest_diff:
-            smallest_diff = diff
-            closest_price = price
-
-    print(f"[fetch_historical_price_range] Returning {closest_price} for {coin_id}")
-    return closest_price
-
-def fetch_etherscan_transactions(address, api_key, start_block=0, end_block=99999999):
-    url = f"https://api.etherscan.io/api"
-    params = {
-        "module": "account",
-        "action": "txlist",
-        "address": address,
-        "startblock": start_block,
-        "endblock": end_block,
-        "sort": "asc",
-        "apikey": api_key
-    }
-
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        if data["status"] == "1":
-            return data["result"]
-        else:
-            return []
-    else:
-        raise Exception(f"Error fetching data: {response.status_code}")
-    
-def fetch_basescan_transactions(address, api_key, start_block=0, end_block=99999999):
-    url = "https://api.basescan.org/api"
-    params = {
-        "module": "account",
-        "action": "txlist",
-        "address": address,
-        "startblock": start_block,
-        "endblock": end_block,
-        "sort": "asc",
-        "apikey": api_key
-    }
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        if data["status"] == "1":
-            return data["result"]
-        else:
-            return []
-    else:
-        raise Exception(f"Error fetching data: {response.status_code}")
-
-    
-def import_kraken_csv(file_path):
-    """
-    Import transactions from a Kraken CSV file and handle FROM and TO assets based on transaction type.
-    :param file_path: Path to the Kraken CSV file.
-    """
-    with open(file_path, mode="r") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            # Parse the pair and skip unsupported pairs
-            pair = row["pair"]
-            
-            # Split the pair into FROM and TO assets
-            try:
-                asset1, asset2 = pair.split("/")  # e.g., "XRP/EUR" -> ("XRP", "EUR")
-            except ValueError:
-                print(f"Invalid pair format: {pair}")
-                continue
-            
-            if((asset1 == "USD" or asset1 == "EUR") and (asset2 == "USD" or asset2 == "EUR")):
-                print(f"SKIPPING FIAT PAIR ({asset1},{asset2})")
-                continue
-
-            transaction_type = row["type"].lower()
-            transaction_date = datetime.strptime(row["time"], "%Y-%m-%d %H:%M:%S.%f")
-            
-            if transaction_type == "buy":
-                from_asset, to_asset = asset2, asset1  # Buying asset1 with asset2
-                from_amount = float(row["cost"])
-                to_amount = float(row["vol"])
-                fee_asset = from_asset
-
-                # Determine the from_asset price (note: for now assuming only fiat buys/sells in Kraken)
-                if from_asset == "EUR":
-                    from_asset_price_usd = currency_converter.convert(1.0, "EUR", "USD", date=transaction_date)
-                    from_asset_price_eur = 1.0
-                    to_asset_cost_basis_usd = currency_converter.convert(float(row["price"]), "EUR", "USD", date=transaction_date)
-                elif from_asset == "USD":
-                    from_asset_price_usd = 1.0
-                    from_asset_price_eur = currency_converter.convert(1.0, "USD", "EUR", date=transaction_date)
-                    to_asset_cost_basis_usd = float(row["price"])
-                else:
-                    print(f"INVALID FROM ASSET IN BUY {pair}")
-                    from_asset_price_usd = 0.0
-                    from_asset_price_eur = 0.0
-
-            elif transaction_type == "sell":
-                from_asset, to_asset = asset1, asset2  # Selling asset1 for asset2
-                from_amount = float(row["vol"])
-                to_amount = float(row["cost"])
-                fee_asset = to_asset
-
-                if to_asset == "EUR":
-                    from_asset_price_usd = currency_converter.convert(float(row["price"]), "EUR", "USD", date=transaction_date)
-                    from_asset_price_eur = float(row["price"])
-                    to_asset_cost_basis_usd = currency_converter.convert(1.0, "EUR", "USD", date=transaction_date)
-                elif to_asset == "USD":
-                    from_asset_price_usd = float(row["price"])
-                    from_asset_price_eur = currency_converter.convert(float(row["price"]), "USD", "EUR", date=transaction_date)
-                    to_asset_cost_basis_usd = 1.0
-                else:
-                    print(f"INVALID FROM ASSET IN BUY {pair}")
-                    from_asset_price_usd = 0.0
-                    from_asset_price_eur = 0.0
-            else:
-                print("WARNING: Unsupported transaction type")
-                continue  # Unsupported transaction type
-            
-            # Create a new Transaction object
-            tx = Transaction(
-                from_asset=from_asset,
-                to_asset=to_asset,
-                from_amount=from_amount,
-                from_asset_price_usd=from_asset_price_usd,
-                from_asset_price_eur=from_asset_price_eur,
-                to_amount=to_amount,
-                to_asset_cost_basis=to_asset_cost_basis_usd,
-                transaction_type=transaction_type.upper(),
-                transaction_date=transaction_date,
-                gas_fees=float(row["fee"]),
-                gas_asset=fee_asset,  # Assuming fees are paid in the FROM asset
-                tax_year=datetime.strptime(row["time"], "%Y-%m-%d %H:%M:%S.%f").year
-            )
-            db.session.add(tx)
-
-        # Commit all transactions to the database
-        db.session.commit()
-        print("Kraken transactions imported successfully!")
-
-def detect_errors(tx: Transaction):
-    """
-    Function to detect errors in a transaction, such as a SELL with no prior BUY 
-    for the same asset or insufficient holdings for the SELL.
-    """
-    if tx.transaction_type == "SELL":
-        # Check if there's any BUY transaction for the FROM asset prior to this date
-        buy_txs = Transaction.query.filter(
-            Transaction.to_asset == tx.from_asset,
-            Transaction.transaction_type == "BUY",
-            Transaction.transaction_date <= tx.transaction_date
-        ).all()
-
-        if not buy_txs:
-            return f"Error: SELL transaction for {tx.from_asset} before any BUY."
-
-        # Calculate total bought and total sold up to the current transaction date
-        total_bought = sum(b.to_amount for b in buy_txs)
-        sell_txs = Transaction.query.filter(
-            Transaction.from_asset == tx.from_asset,
-            Transaction.transaction_type == "SELL",
-            Transaction.transaction_date <= tx.transaction_date,
-            Transaction.id != tx.id  # Exclude the current transaction
-        ).all()
-        total_sold = sum(s.from_amount for s in sell_txs)
-
-        # Check if the total holdings are sufficient for this SELL
-        if total_bought < (total_sold + tx.from_amount):
-            return f"Error: SELL amount exceeds total available holdings for {tx.from_asset}."
-    
-    return ""  # No error found
+    try:
+        return normalize_method(request.args.get("method") or COST_BASIS_METHOD)
+    except ValueError as e:
+        abort(400, str(e))
 
+def cost_basis_choices():
+    """
+    Methods offered in the forms: the default one first, then the other single methods.
+    """
+    default = normalize_method(COST_BASIS_METHOD)
+    return [default] + [method for method in COST_BASIS_METHODS if method != default]
 
-app = Flask(__name__)
-app.config.from_object(Config)
-db.init_app(app)
+def computed_methods():
+    return [method for method, in db.session.query(GainsRun.method).filter(GainsRun.computed_at.isnot(None))
+            .order_by(GainsRun.method)]
 
-with app.app_context():
-    db.create_all()  # Create tables if not exist (for demo)
+def encode_cursor(tx):
+    return f"{tx.transaction_date.isoformat()}|{tx.id}"
 
+def decode_cursor(cursor):
+    try:
+        date_str, tx_id = cursor.rsplit("|", 1)
+        return datetime.fromisoformat(date_str), int(tx_id)
+    except (ValueError, TypeError):
+        abort(400, f"Invalid page cursor: {cursor}")
 
 @app.route("/")
 def index():
-    
+
     # Get query parameters for filtering
     asset_filter = request.args.get("asset")
     chain_filter = request.args.get("chain")
+    type_filter = request.args.get("type")
+    year_filter = request.args.get("tax_year", type=int)
+    error_filter = request.args.get("has_error") == "1"
 
     # Build the query dynamically based on the filters
     query = Transaction.query
@@ -502,46 +244,70 @@ def index():
         )
     if chain_filter:
         query = query.filter(Transaction.chain == chain_filter)
-
-    # Execute the query and order by transaction date
-    transactions = query.order_by(Transaction.transaction_date).all()
-    
-    tx_list = []
-    for t in transactions:
-        error_msg = detect_errors(t)
-        tx_list.append({
-            "id": t.id,
-            "chain": t.chain,
-            "from_asset": t.from_asset,
-            "from_amount": t.from_amount,
-            "to_asset": t.to_asset,
-            "to_amount": t.to_amount,
-            "to_asset_cost_basis": t.to_asset_cost_basis,
-            "from_asset_price_usd": t.from_asset_price_usd,
-            "transaction_type": t.transaction_type,
-            "transaction_date": t.transaction_date,
-            "tax_year": t.tax_year,
-            "gas_fees": t.gas_fees,
-            "gas_asset": t.gas_asset,
-            "gas_asset_price_usd": t.gas_asset_price_usd,
-            "gains_usd_short": t.gains_usd_short,
-            "gains_eur_short": t.gains_eur_short,
-            "gains_usd_long": t.gains_usd_long,
-            "gains_eur_long": t.gains_eur_long,
-            "gains_gas_usd_short": t.gains_gas_usd_short,
-            "gains_gas_eur_short": t.gains_gas_eur_short,
-            "gains_gas_usd_long": t.gains_gas_usd_long,
-            "gains_gas_eur_long": t.gains_gas_eur_long,
-            "error": error_msg,
-            "note": t.note
-        })
-        
-    return render_template("index.html", transactions=tx_list, asset_filter=asset_filter)
+    if type_filter:
+        query = query.filter(Transaction.transaction_type == type_filter)
+    if year_filter:
+        query = query.filter(Transaction.tax_year == year_filter)
+    if error_filter:
+        query = query.filter(Transaction.balance_error.isnot(None))
+
+    # Keyset pagination on (transaction_date, id): fetch one extra row to
+    # know whether there is another page in the direction we are moving
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if before:
+        date, tx_id = decode_cursor(before)
+        query = query.filter(or_(
+            Transaction.transaction_date < date,
+            and_(Transaction.transaction_date == date, Transaction.id < tx_id)
+        ))
+        rows = query.order_by(Transaction.transaction_date.desc(), Transaction.id.desc()) \
+            .limit(PAGE_SIZE + 1).all()
+        has_more = len(rows) > PAGE_SIZE
+        transactions = list(reversed(rows[:PAGE_SIZE]))
+        has_prev, has_next = has_more, True
+    else:
+        if after:
+            date, tx_id = decode_cursor(after)
+            query = query.filter(or_(
+                Transaction.transaction_date > date,
+                and_(Transaction.transaction_date == date, Transaction.id > tx_id)
+            ))
+        rows = query.order_by(Transaction.transaction_date, Transaction.id) \
+            .limit(PAGE_SIZE + 1).all()
+        has_more = len(rows) > PAGE_SIZE
+        transactions = rows[:PAGE_SIZE]
+        has_prev, has_next = bool(after), has_more
+
+    # Filters are carried over into the pagination links
+    filter_args = {
+        key: value for key, value in request.args.items()
+        if key not in ("after", "before") and value
+    }
+    prev_url = next_url = None
+    if transactions and has_prev:
+        prev_url = url_for("index", before=encode_cursor(transactions[0]), **filter_args)
+    if transactions and has_next:
+        next_url = url_for("index", after=encode_cursor(transactions[-1]), **filter_args)
+
+    return render_template(
+        "index.html",
+        transactions=transactions,
+        asset_filter=asset_filter,
+        chain_filter=chain_filter,
+        type_filter=type_filter,
+        year_filter=year_filter,
+        error_filter=error_filter,
+        transaction_types=TRANSACTION_TYPES,
+        cost_basis_methods=cost_basis_choices(),
+        prev_url=prev_url,
+        next_url=next_url
+    )
 
 @app.route("/import_kraken", methods=["POST"])
 def import_kraken():
     """
-    Handle the upload and processing of a Kraken CSV file.
+    Save an uploaded Kraken CSV file and queue its import.
     """
     if "kraken_csv" not in request.files:
         flash("No file uploaded. Please select a CSV file.", "danger")
@@ -557,19 +323,22 @@ def import_kraken():
         flash("Invalid file type. Please upload a CSV file.", "danger")
         return redirect(url_for("index"))
 
-    try:
-        # Save the uploaded file temporarily
-        file_path = f"/tmp/{file.filename}"
-        file.save(file_path)
-
-        # Import the transactions from the CSV file
-        import_kraken_csv(file_path)
-        flash("Kraken transactions imported successfully.", "success")
-
-    except Exception as e:
-        flash(f"Error importing transactions: {str(e)}", "danger")
-
-    return redirect(url_for("index"))
+    # Uploads are named after their content, so uploading the same file twice queues it once
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=JOBS_DIR, suffix=".upload", delete=False) as upload:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            upload.write(chunk)
+    path = os.path.join(JOBS_DIR, f"kraken_{digest.hexdigest()}.csv")
+    os.replace(upload.name, path)
+
+    job, queued = runner.enqueue("import_kraken", key=digest.hexdigest(), path=path, filename=file.filename)
+    if queued:
+        flash(f"Import of {file.filename} queued (job {job.id}).", "info")
+    else:
+        flash(f"{file.filename} is already being imported (job {job.id}).", "info")
+    return redirect(url_for("view_jobs"))
 
 @app.route("/add", methods=["GET", "POST"])
 def add_transaction():
@@ -598,6 +367,7 @@ def add_transaction():
             # Add and commit the transaction to the database
             db.session.add(tx)
             db.session.commit()
+            queue_balance_errors()
 
             # Flash success message
             flash("Transaction added successfully.", "success")
@@ -633,6 +403,7 @@ def edit_transaction(tx_id):
         tx.note = form.note.data
         
         db.session.commit()
+        queue_balance_errors()
         flash("Transaction updated successfully.", "success")
         return redirect(url_for("index"))
     
@@ -644,26 +415,84 @@ def delete_transaction(tx_id):
     tx = Transaction.query.get_or_404(tx_id)
     db.session.delete(tx)
     db.session.commit()
+    queue_balance_errors()
     flash("Transaction deleted.", "info")
     return redirect(url_for("index"))
 
 
+@app.route("/select_lots/<int:tx_id>", methods=["GET", "POST"])
+def select_lots(tx_id):
+    """
+    Choose the lots a SELL/SWAP disposes of under the SPECIFIC cost basis method.
+    """
+    tx = Transaction.query.get_or_404(tx_id)
+    if request.method == "POST":
+        lot_transaction_id = request.form.get("lot_transaction_id", type=int)
+        amount = request.form.get("amount", type=float)
+        lot_tx = db.session.get(Transaction, lot_transaction_id) if lot_transaction_id else None
+        if lot_tx is None or lot_tx.transaction_type != "BUY" or lot_tx.to_asset != tx.from_asset \
+                or lot_tx.transaction_date > tx.transaction_date:
+            flash(f"Transaction {lot_transaction_id} is not an earlier BUY of {tx.from_asset}.", "danger")
+        elif not amount or amount <= 0:
+            flash("Please enter a positive amount.", "danger")
+        else:
+            db.session.add(LotSelection(transaction_id=tx.id, lot_transaction_id=lot_tx.id, amount=amount))
+            mark_dirty(tx.transaction_date)
+            db.session.commit()
+            flash("Lot selected.", "success")
+        return redirect(url_for("select_lots", tx_id=tx.id))
+
+    selections = LotSelection.query.filter_by(transaction_id=tx.id).order_by(LotSelection.id).all()
+    candidates = Transaction.query.filter(
+        Transaction.transaction_type == "BUY", Transaction.to_asset == tx.from_asset,
+        Transaction.transaction_date <= tx.transaction_date
+    ).order_by(Transaction.transaction_date.desc(), Transaction.id.desc()).limit(LOTS_PAGE_SIZE).all()
+    return render_template("select_lots.html", tx=tx, selections=selections, candidates=candidates)
+
+@app.route("/select_lots/<int:tx_id>/delete/<int:selection_id>", methods=["POST"])
+def delete_lot_selection(tx_id, selection_id):
+    tx = Transaction.query.get_or_404(tx_id)
+    selection = LotSelection.query.filter_by(id=selection_id, transaction_id=tx.id).first_or_404()
+    db.session.delete(selection)
+    mark_dirty(tx.transaction_date)
+    db.session.commit()
+    flash("Lot selection removed.", "info")
+    return redirect(url_for("select_lots", tx_id=tx_id))
+
 @app.route("/calculate_gains", methods=["POST"])
 def calculate_gains_route():
-    selected_year = request.form.get("tax_year", "")
-    
-    csv_data = calculate_gains(selected_year=selected_year)  # the function returns CSV data or None
-    flash("Gains calculated successfully.", "success")
-
-    if selected_year and csv_data:
-        filename = f"capgains_{selected_year}.csv"
-        return Response(
-            csv_data,
-            mimetype="text/csv",
-            headers={"Content-disposition": f"attachment; filename={filename}"}
-        )
+    selected_year = request.form.get("tax_year", type=int)
+    try:
+        method = normalize_method(request.form.get("method") or COST_BASIS_METHOD)
+    except ValueError as e:
+        flash(str(e), "danger")
+        return redirect(url_for("index"))
 
-    return redirect(url_for("index"))
+    job, queued = runner.enqueue("gains", key=f"{method}:{selected_year or ''}", method=method, tax_year=selected_year)
+    if queued:
+        flash(f"{method} gains calculation queued (job {job.id}).", "info")
+    else:
+        flash(f"A gains calculation is already queued (job {job.id}).", "info")
+    return redirect(url_for("view_jobs"))
+
+
+@app.route("/export")
+def export_disposals():
+    """
+    Stream the capital gains CSV for a tax year from the stored disposals.
+    """
+    tax_year = request.args.get("tax_year", type=int)
+    if not tax_year:
+        flash("Please select a tax year to export.", "danger")
+        return redirect(url_for("index"))
+    method = selected_method()
+
+    filename = f"capgains_{tax_year}.csv"
+    return Response(
+        stream_with_context(iter_disposals_csv(tax_year, method)),
+        mimetype="text/csv",
+        headers={"Content-disposition": f"attachment; filename={filename}"}
+    )
 
 
 @app.route("/fetch_prices/<int:tx_id>", methods=["POST"])
@@ -685,6 +514,7 @@ def fetch_prices(tx_id):
 
         # Save changes
         db.session.commit()
+        queue_balance_errors()
         flash(f"Prices fetched and updated for transaction {tx_id}.", "success")
     except Exception as e:
         flash(f"Error fetching prices: {str(e)}", "danger")
@@ -692,138 +522,134 @@ def fetch_prices(tx_id):
 
     return redirect(url_for("index"))
 
+@app.route("/backfill_prices", methods=["POST"])
+def backfill_prices_route():
+    """
+    Queue fetching historical prices for every transaction that is missing one.
+    """
+    job, queued = runner.enqueue("backfill")
+    if queued:
+        flash(f"Price backfill queued (job {job.id}).", "info")
+    else:
+        flash(f"A price backfill is already running (job {job.id}).", "info")
+    return redirect(url_for("view_jobs"))
+
 @app.route("/sync_transactions", methods=["POST"])
 def sync_transactions():
-    eth_address = request.form.get("eth_address")
-    api_key_eth = etherscan_key
-    base_address = request.form.get("base_address")
-    api_key_base = basescan_key
-
-    try:
-        # ------------------------------------------------------------------------------------------
-        # Fetch transactions from Etherscan
-        transactions_eth = fetch_etherscan_transactions(eth_address, api_key_eth)
-        print("Got Etherscan transactions")
-
-        for tx in transactions_eth:
-            # Filter out non-value transactions
-            if int(tx["value"]) >= 0:
-                # Determine transaction type (BUY or SELL)
-                transaction_type = "BUY" if tx["to"].lower() == eth_address.lower() else "SELL"
-
-                # Fetch historical price (replace with actual API call)
-                price_usd = 0 #fetch_historical_price("ethereum", datetime.fromtimestamp(int(tx["timeStamp"])))
-
-                # Create a new transaction
-                new_tx = Transaction(
-                    chain="ETH",
-                    from_asset="ETH",
-                    from_amount=int(tx["value"]) / (10**18),
-                    from_asset_price_usd=price_usd,
-                    transaction_type=transaction_type,
-                    transaction_date=datetime.fromtimestamp(int(tx["timeStamp"])),
-                    gas_fees=int(tx["gasUsed"]) * int(tx["gasPrice"]) / (10**18),
-                    gas_asset="ETH",
-                    tax_year=datetime.fromtimestamp(int(tx["timeStamp"])).year,
-                )
-                db.session.add(new_tx)
-
-                # ------------------------------------------------------------------------------------------
-        # Fetch transactions from Etherscan
-        transactions_base = fetch_basescan_transactions(base_address, api_key_base)
-        print("Got Basescan transactions")
-
-        for tx in transactions_base:
-            # Filter out non-value transactions
-            if int(tx["value"]) >= 0:
-                # Determine transaction type (BUY or SELL)
-                transaction_type = "BUY" if tx["to"].lower() == base_address.lower() else "SELL"
-
-                # Fetch historical price (replace with actual API call)
-                price_usd = 0 #fetch_historical_price("ethereum", datetime.fromtimestamp(int(tx["timeStamp"])))
-
-                # Create a new transaction
-                new_tx = Transaction(
-                    chain="BASE",
-                    from_asset="ETH",
-                    from_amount=int(tx["value"]) / (10**18),
-                    from_asset_price_usd=price_usd,
-                    transaction_type=transaction_type,
-                    transaction_date=datetime.fromtimestamp(int(tx["timeStamp"])),
-                    gas_fees=int(tx["gasUsed"]) * int(tx["gasPrice"]) / (10**18),
-                    gas_asset="ETH",
-                    tax_year=datetime.fromtimestamp(int(tx["timeStamp"])).year,
-                )
-                db.session.add(new_tx)
-
-        # Commit all transactions to the database
-        db.session.commit()
-        flash("Transactions synced successfully.", "success")
-    except Exception as e:
-        # Rollback the session on error
-        db.session.rollback()
-        flash(f"Error syncing transactions: {str(e)}", "danger")
+    wallets = [
+        (chain, address.lower())
+        for chain, address in (("ETH", request.form.get("eth_address")), ("BASE", request.form.get("base_address")))
+        if address
+    ]
+    if not wallets:
+        flash("Please enter at least one address to sync.", "danger")
+        return redirect(url_for("index"))
 
-    return redirect(url_for("index"))
+    key = ",".join(f"{chain}:{address}" for chain, address in sorted(wallets))
+    job, queued = runner.enqueue("sync", key=key, wallets=wallets)
+    if queued:
+        flash(f"Wallet sync queued (job {job.id}).", "info")
+    else:
+        flash(f"These wallets are already being synced (job {job.id}).", "info")
+    return redirect(url_for("view_jobs"))
 
 @app.route("/summary")
 def summary():
-    transactions = Transaction.query.all()
-    unsorted_summaries = {}
-
-    for tx in transactions:
-        year = tx.tax_year
-        if year not in unsorted_summaries:
-            unsorted_summaries[year] = {
-                "short_term_usd": 0.0,
-                "short_term_eur": 0.0,
-                "long_term_usd": 0.0,
-                "long_term_eur": 0.0,
-            }
-
-        short_term_usd = tx.gains_usd_short or 0
-        short_term_eur = tx.gains_eur_short or 0
-        long_term_usd = tx.gains_usd_long or 0
-        long_term_eur = tx.gains_eur_long or 0
-
-        gas_short_term_usd = tx.gains_gas_usd_short or 0
-        gas_short_term_eur = tx.gains_gas_eur_short or 0
-        gas_long_term_usd = tx.gains_gas_usd_long or 0
-        gas_long_term_eur = tx.gains_gas_eur_long or 0
-
-        unsorted_summaries[year]["short_term_usd"] += short_term_usd + gas_short_term_usd
-        unsorted_summaries[year]["short_term_eur"] += short_term_eur + gas_short_term_eur
-        unsorted_summaries[year]["long_term_usd"] += long_term_usd + gas_long_term_usd
-        unsorted_summaries[year]["long_term_eur"] += long_term_eur + gas_long_term_eur
-
-    # Sort the dictionary by year and convert it to a list of tuples: [(year, {data}), ...]
-    sorted_summaries = sorted(unsorted_summaries.items(), key=lambda x: x[0])
-
-    return render_template("summary.html", summaries=sorted_summaries)
+    """
+    Per-year totals and per-asset breakdown, read from the GainsSummary rows
+    maintained by the gains calculation, for one cost basis method.
+    """
+    method = selected_method()
+    years = {}
+    for row in GainsSummary.query.filter_by(method=method).order_by(GainsSummary.tax_year, GainsSummary.asset):
+        if row.tax_year not in years:
+            years[row.tax_year] = {"totals": defaultdict(float), "assets": []}
+        totals = years[row.tax_year]["totals"]
+        for currency in ("usd", "eur"):
+            totals[f"short_term_{currency}"] += getattr(row, f"short_term_{currency}") + getattr(row, f"gas_short_term_{currency}")
+            totals[f"long_term_{currency}"] += getattr(row, f"long_term_{currency}") + getattr(row, f"gas_long_term_{currency}")
+            totals[f"gas_{currency}"] += getattr(row, f"gas_short_term_{currency}") + getattr(row, f"gas_long_term_{currency}")
+            totals[f"staking_rewards_{currency}"] += getattr(row, f"staking_rewards_{currency}")
+            totals[f"airdrops_{currency}"] += getattr(row, f"airdrops_{currency}")
+            totals[f"net_gain_{currency}"] += getattr(row, f"net_gain_{currency}")
+        totals["gas_fees_usd"] += row.gas_fees_usd
+        years[row.tax_year]["assets"].append(row)
+
+    return render_template("summary.html", summaries=sorted(years.items()), method=method, methods=computed_methods())
+
+@app.route("/jobs")
+def view_jobs():
+    jobs = Job.query.order_by(Job.id.desc()).limit(JOBS_SHOWN).all()
+    statuses = [runner.status(job) for job in jobs]
+    active = any(status["status"] in ("queued", "running") for status in statuses)
+    return render_template("jobs.html", jobs=statuses, active=active)
+
+@app.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    """
+    Status of a job as JSON: progress, ETA, errors and where to download its result.
+    """
+    job = Job.query.get_or_404(job_id)
+    status = runner.status(job)
+    status["result_url"] = url_for("job_result", job_id=job.id) if job.result_path else None
+    return jsonify(status)
+
+@app.route("/jobs/<int:job_id>/result")
+def job_result(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.status != "done" or not job.result_path or not os.path.exists(job.result_path):
+        abort(404)
+    params = json.loads(job.params)
+    if job.kind == "gains":
+        download_name = f"capgains_{params['tax_year']}_{params['method'].replace(',', '_').replace(':', '-')}.csv"
+    else:
+        download_name = os.path.basename(job.result_path)
+    return send_file(job.result_path, as_attachment=True, download_name=download_name)
 
 @app.route("/lots")
 def view_lots():
-    lots = Lot.query.filter(Lot.remaining_amount > 0).order_by(Lot.asset_name, Lot.transaction_date).all()
-    return render_template("lots.html", lots=lots)
+    """
+    Open lots, one page at a time, optionally for a single asset. With
+    partial=1 only the table is rendered, for the collapsed holdings view.
+    """
+    method = selected_method()
+    asset = request.args.get("asset")
+    after = request.args.get("after")
+    partial = request.args.get("partial") == "1"
+
+    query = Lot.query.filter(Lot.method == method, Lot.remaining_amount > 0)
+    if asset:
+        query = query.filter(Lot.asset_name == asset)
+    if after:
+        # Keyset pagination on (asset_name, transaction_date, id); the asset name may contain "|"
+        try:
+            asset_name, date_str, lot_id = after.rsplit("|", 2)
+            date, lot_id = datetime.fromisoformat(date_str), int(lot_id)
+        except (ValueError, TypeError):
+            abort(400, f"Invalid page cursor: {after}")
+        query = query.filter(or_(
+            Lot.asset_name > asset_name,
+            and_(Lot.asset_name == asset_name, Lot.transaction_date > date),
+            and_(Lot.asset_name == asset_name, Lot.transaction_date == date, Lot.id > lot_id)
+        ))
+    rows = query.order_by(Lot.asset_name, Lot.transaction_date, Lot.id).limit(LOTS_PAGE_SIZE + 1).all()
+    lots = rows[:LOTS_PAGE_SIZE]
+
+    next_url = None
+    if len(rows) > LOTS_PAGE_SIZE:
+        last = lots[-1]
+        cursor = f"{last.asset_name}|{last.transaction_date.isoformat()}|{last.id}"
+        next_url = url_for("view_lots", method=method, asset=asset or None, after=cursor, partial=1 if partial else None)
+    return render_template("lots_table.html" if partial else "lots.html", lots=lots, asset=asset, next_url=next_url,
+                           method=method, methods=computed_methods())
 
 @app.route("/lots_collapsed")
 def view_lots_collapsed():
-    # Query all lots with remaining amounts
-    all_lots = Lot.query.filter(Lot.remaining_amount > 0).order_by(Lot.asset_name, Lot.transaction_date).all()
-
-    # Group lots by asset_name
-    holdings = {}
-    for lot in all_lots:
-        asset = lot.asset_name
-        if asset not in holdings:
-            holdings[asset] = {
-                "total_amount": 0.0,
-                "lots": []
-            }
-        holdings[asset]["lots"].append(lot)
-        holdings[asset]["total_amount"] += lot.remaining_amount
-
-    return render_template("lots_collapsed.html", holdings=holdings)
+    # Per-asset totals are maintained by the gains calculation; the lots of an
+    # asset are only loaded when it is expanded
+    method = selected_method()
+    holdings = Holding.query.filter_by(method=method).order_by(Holding.asset_name).all()
+    return render_template("lots_collapsed.html", holdings=holdings, method=method, methods=computed_methods())
 
 
 if __name__ == "__main__":
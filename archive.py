@@ -0,0 +1,188 @@
+"""
+Backups of the ledger as columnar files, one per table, in Parquet (for
+analytics tools) or the Arrow IPC file format (memory-mapped when restored).
+
+    backup_archive("backup/", "parquet")  # backup/transactions.parquet, backup/lots.parquet, ...
+    restore_archive("backup/", replace=True)
+
+Needs pyarrow, which is only imported with this module. Tables are read and
+written in record batches, so memory stays bounded by ARCHIVE_BATCH_SIZE.
+"""
+import io
+import os
+import logging
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from sqlalchemy import select, insert, Boolean, Integer, Float, DateTime, String, Text
+
+from models import db, Transaction, Lot, LotDisposal, LotSelection, LotCheckpoint, Holding, GainsSummary, \
+    GainsRun, get_gains_state
+from storage import copy_csv, reset_id_sequence
+
+logger = logging.getLogger(__name__)
+
+# Rows per record batch, when reading from the database and when loading it back
+ARCHIVE_BATCH_SIZE = 50000
+
+# Archived tables, in the order they are restored (transactions first, as the others refer to them)
+ARCHIVE_MODELS = [Transaction, LotSelection, Lot, LotDisposal]
+
+# File extension of each format
+ARCHIVE_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def arrow_schema(model):
+    """
+    Arrow schema of a table, from its column types.
+    """
+    fields = []
+    for column in model.__table__.columns:
+        if isinstance(column.type, Boolean):
+            arrow_type = pa.bool_()
+        elif isinstance(column.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, Float):
+            arrow_type = pa.float64()
+        elif isinstance(column.type, DateTime):
+            arrow_type = pa.timestamp("us")
+        elif isinstance(column.type, (String, Text)):
+            arrow_type = pa.string()
+        else:
+            raise TypeError(f"No Arrow type for {model.__tablename__}.{column.name} ({column.type})")
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields, metadata={"table": model.__tablename__})
+
+
+def archive_path(directory, model, file_format):
+    return os.path.join(directory, model.__tablename__ + ARCHIVE_FORMATS[file_format])
+
+
+def write_table(model, path, file_format="parquet", batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Write every row of a table to a Parquet or Arrow file, in id order.
+    :return: Number of rows written.
+    """
+    schema = arrow_schema(model)
+    columns = list(model.__table__.columns)
+    result = db.session.execute(
+        select(*columns).order_by(model.__table__.primary_key.columns.values()[0])
+        .execution_options(yield_per=batch_size)
+    )
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    written = 0
+    with writer:
+        for rows in result.partitions():
+            values = list(zip(*rows))
+            writer.write_batch(pa.record_batch(
+                [pa.array(column_values, type=field.type) for column_values, field in zip(values, schema)],
+                schema=schema,
+            ))
+            written += len(rows)
+    return written
+
+
+def read_batches(path, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Record batches of a Parquet or Arrow file. Arrow files are memory-mapped,
+    so the batches are read without copying.
+    """
+    if path.endswith(ARCHIVE_FORMATS["parquet"]):
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+    else:
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i)
+
+
+def load_table(model, path, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Insert the rows of a Parquet or Arrow file into a table, batch by batch,
+    keeping their ids. Does not commit.
+
+    Values are stored as they are, NULLs included (unlike bulk_insert(), which
+    fills in the column defaults). On PostgreSQL each batch is written out as
+    CSV by Arrow and loaded with COPY, without turning the values into Python
+    objects.
+    :return: Number of rows loaded.
+    """
+    known = set(model.__table__.columns.keys())
+    as_csv = db.session.get_bind().dialect.name == "postgresql"
+    csv_options = pa_csv.WriteOptions(include_header=False, quoting_style="all_valid")
+    loaded = 0
+    for batch in read_batches(path, batch_size):
+        unknown = set(batch.schema.names) - known
+        if unknown:
+            raise ValueError(f"{os.path.basename(path)} has columns {model.__tablename__} does not: "
+                             f"{', '.join(sorted(unknown))}")
+        names = batch.schema.names
+        if as_csv:
+            stream = io.BytesIO()
+            pa_csv.write_csv(batch, stream, csv_options)
+            stream.seek(0)
+            copy_csv(db.session, model, names, stream)
+        else:
+            values = [column.to_pylist() for column in batch.columns]
+            db.session.execute(insert(model.__table__), [dict(zip(names, row)) for row in zip(*values)])
+        loaded += batch.num_rows
+    reset_id_sequence(db.session, model)
+    return loaded
+
+
+def backup_archive(directory, file_format="parquet"):
+    """
+    Write the transactions, lot selections, lots and disposals (of every cost
+    basis method) to one file each in a directory.
+    :return: Dict of table name -> rows written.
+    """
+    if file_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format {file_format!r}, expected one of {', '.join(ARCHIVE_FORMATS)}")
+    os.makedirs(directory, exist_ok=True)
+    written = {}
+    for model in ARCHIVE_MODELS:
+        written[model.__tablename__] = write_table(model, archive_path(directory, model, file_format), file_format)
+        logger.info("Table archived", extra={"table": model.__tablename__, "rows": written[model.__tablename__]})
+    return written
+
+
+def restore_archive(directory, replace=False):
+    """
+    Load a backup written by backup_archive(), in a single transaction.
+    Every method's gains are marked for a full recalculation: the lots and
+    disposals are restored as they were, but the checkpoints, holdings and
+    summaries they came with are not part of the backup.
+    :param replace: Delete the current ledger first. Without it the ledger must be empty.
+    :return: Dict of table name -> rows loaded.
+    """
+    paths = {}
+    for model in ARCHIVE_MODELS:
+        found = [archive_path(directory, model, file_format) for file_format in ARCHIVE_FORMATS]
+        found = [path for path in found if os.path.exists(path)]
+        if found:
+            paths[model] = found[0]
+    if Transaction not in paths:
+        raise ValueError(f"No transactions file in {directory}")
+
+    if not replace and db.session.query(Transaction.id).first() is not None:
+        raise ValueError("The ledger is not empty; restore with replace to overwrite it")
+
+    loaded = {}
+    try:
+        for model in reversed(ARCHIVE_MODELS + [LotCheckpoint, Holding, GainsSummary]):
+            model.query.delete()
+        for model, path in paths.items():
+            loaded[model.__tablename__] = load_table(model, path)
+            logger.info("Table restored", extra={"table": model.__tablename__, "rows": loaded[model.__tablename__]})
+        # Bulk inserts bypass the change tracking, so flag the gains explicitly
+        GainsRun.query.update({"computed_at": None, "dirty_from": None, "dirty_count": GainsRun.dirty_count + 1})
+        get_gains_state().errors_stale = True
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return loaded
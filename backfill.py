@@ -0,0 +1,139 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from sqlalchemy import or_, and_
+
+from models import db, Transaction, COINGECKO_ASSET_MAPPING, mark_dirty
+from prices import price_store, CHUNK_SECONDS, MAX_PRICE_GAP
+from ratelimit import TokenBucket, fetch_with_retry
+from storage import bulk_update
+
+logger = logging.getLogger(__name__)
+
+# CoinGecko's public API allows roughly 30 calls per minute
+COINGECKO_CALLS_PER_SECOND = 0.5
+COINGECKO_BURST = 5
+
+BACKFILL_WORKERS = 4
+
+# (asset column, price column) pairs a backfill can fill in
+PRICE_FIELDS = (
+    ("from_asset", "from_asset_price_usd"),
+    ("to_asset", "to_asset_cost_basis"),
+    ("gas_asset", "gas_asset_price_usd"),
+)
+
+
+def _is_missing(value):
+    return value is None or value == 0
+
+
+def find_missing_prices():
+    """
+    Return (transaction id, price column, asset, UNIX timestamp, date) for every price
+    that is missing and can be looked up on CoinGecko, plus the number skipped.
+    """
+    rows = db.session.query(
+        Transaction.id, Transaction.transaction_date, Transaction.gas_fees,
+        Transaction.from_asset, Transaction.from_asset_price_usd,
+        Transaction.to_asset, Transaction.to_asset_cost_basis,
+        Transaction.gas_asset, Transaction.gas_asset_price_usd,
+    ).filter(or_(
+        Transaction.from_asset_price_usd.is_(None),
+        Transaction.from_asset_price_usd == 0,
+        and_(Transaction.to_asset.isnot(None),
+             or_(Transaction.to_asset_cost_basis.is_(None), Transaction.to_asset_cost_basis == 0)),
+        and_(Transaction.gas_fees > 0,
+             or_(Transaction.gas_asset_price_usd.is_(None), Transaction.gas_asset_price_usd == 0)),
+    )).all()
+
+    missing = []
+    skipped = 0
+    for row in rows:
+        timestamp = int(row.transaction_date.timestamp())
+        for asset_field, price_field in PRICE_FIELDS:
+            asset = getattr(row, asset_field)
+            if not asset or not _is_missing(getattr(row, price_field)):
+                continue
+            if price_field == "gas_asset_price_usd" and not (row.gas_fees or 0) > 0:
+                continue
+            if asset not in COINGECKO_ASSET_MAPPING:
+                skipped += 1
+                continue
+            missing.append((row.id, price_field, asset, timestamp, row.transaction_date))
+    return missing, skipped
+
+
+def _print_progress(done, total):
+    logger.info("Fetched price ranges", extra={"done": done, "total": total})
+
+
+def backfill_prices(workers=BACKFILL_WORKERS, progress=_print_progress):
+    """
+    Fill in every missing transaction price from the local price store, fetching
+    the missing ranges from CoinGecko concurrently under a shared rate limit.
+    :param workers: Number of concurrent requests.
+    :param progress: Callable receiving (ranges fetched, ranges to fetch).
+    :return: Dict summarizing the run.
+    """
+    missing, skipped = find_missing_prices()
+
+    # Group the lookups by (asset, day) and work out which chunks are not stored yet
+    days = {(asset, timestamp // 86400) for _, _, asset, timestamp, _ in missing}
+    chunks = set()
+    for asset, day in days:
+        day_start = day * 86400
+        for chunk_start in price_store.missing_chunks(asset, day_start - MAX_PRICE_GAP, day_start + 86400 + MAX_PRICE_GAP):
+            chunks.add((asset, chunk_start))
+
+    # Fetch the chunks concurrently; results are stored from this thread only
+    bucket = TokenBucket(COINGECKO_CALLS_PER_SECOND, COINGECKO_BURST, "coingecko")
+    failed_requests = 0
+    done = 0
+    # Requests are queued behind the rate limit, so the submit time understates how far they cover
+    requested_at = int(time.time())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_with_retry, price_store.fetch_range, bucket,
+                            COINGECKO_ASSET_MAPPING[asset], chunk_start, chunk_start + CHUNK_SECONDS): (asset, chunk_start)
+            for asset, chunk_start in sorted(chunks)
+        }
+        for future in as_completed(futures):
+            asset, chunk_start = futures[future]
+            try:
+                price_store.store_chunk(asset, chunk_start, future.result(), requested_at)
+            except Exception as e:
+                failed_requests += 1
+                logger.error("Giving up on a price range", extra={"asset": asset, "chunk_start": chunk_start, "error": str(e)})
+            done += 1
+            if progress is not None:
+                progress(done, len(futures))
+
+    # Resolve every lookup locally and write the prices back in one batch
+    updates = {}
+    earliest = None
+    unresolved = 0
+    for tx_id, price_field, asset, timestamp, transaction_date in missing:
+        price = price_store.lookup(asset, timestamp)
+        if price is None:
+            unresolved += 1
+            continue
+        updates.setdefault(tx_id, {"id": tx_id})[price_field] = price
+        if earliest is None or transaction_date < earliest:
+            earliest = transaction_date
+
+    # Bulk updates bypass the change tracking, so flag the gains explicitly
+    if updates:
+        bulk_update(db.session, Transaction, list(updates.values()))
+        mark_dirty(earliest)
+    db.session.commit()
+
+    return {
+        "transactions": len(updates),
+        "prices": len(missing) - unresolved,
+        "requests": len(chunks),
+        "failed_requests": failed_requests,
+        "unresolved": unresolved,
+        "skipped": skipped,
+    }
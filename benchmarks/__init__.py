@@ -0,0 +1,11 @@
+"""
+Benchmarks for the gains calculation, the Kraken import and the main pages.
+
+Run from the repository root:
+
+    python -m benchmarks.run --sizes 1000,100000,1000000 --output bench_results.json
+    python -m benchmarks.run --sizes 1000 --compare bench_results.json
+
+Every size runs in its own process against a temporary SQLite database, with
+offline stand-ins for CoinGecko and the block explorers.
+"""
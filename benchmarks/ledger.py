@@ -0,0 +1,131 @@
+"""
+Deterministic synthetic ledgers and Kraken trade exports.
+"""
+import csv
+import math
+import random
+from datetime import datetime, timedelta
+
+DEFAULT_ASSETS = ("BTC", "ETH", "ADA", "DOT", "ATOM", "XRP", "TIA", "AERO")
+
+# Share of each transaction type in a generated ledger
+DEFAULT_MIX = {"BUY": 0.5, "SELL": 0.3, "SWAP": 0.2}
+
+# Kraken asset codes for the generated pairs
+KRAKEN_CODES = {"BTC": "XBT"}
+
+
+class PriceWalk:
+    """
+    Deterministic daily random walk of USD prices, one per asset.
+    """
+
+    def __init__(self, assets, seed=0, start=datetime(2015, 1, 1)):
+        rnd = random.Random(seed)
+        self.start = start
+        self.base = {asset: 10 ** rnd.uniform(0, 4) for asset in assets}
+        self.phase = {asset: rnd.uniform(0, 2 * math.pi) for asset in assets}
+
+    def price(self, asset, when):
+        days = (when - self.start).total_seconds() / 86400
+        return self.base[asset] * (1.5 + math.sin(days / 180 + self.phase[asset])) * (1 + days / 3650)
+
+
+def generate_ledger(n, assets=DEFAULT_ASSETS, mix=None, gas_share=0.3, years=6, seed=0,
+                    start=datetime(2015, 1, 1)):
+    """
+    Yield transaction mappings (for bulk_insert_mappings) in date order.
+    :param n: Number of transactions.
+    :param assets: Asset symbols traded.
+    :param mix: Dict of transaction type -> share (BUY, SELL and SWAP; defaults to DEFAULT_MIX).
+    :param gas_share: Share of transactions paying an ETH gas fee on chain.
+    :param years: Number of calendar years the ledger spans.
+    :param seed: Random seed; the same arguments always give the same ledger.
+
+    Disposals never exceed the running holdings of their asset, so the ledger
+    has realistic lot queues rather than a stream of errors.
+    """
+    rnd = random.Random(seed)
+    prices = PriceWalk(assets, seed, start)
+    mix = mix or DEFAULT_MIX
+    types, weights = zip(*mix.items())
+    step = timedelta(days=365 * years) / max(n, 1)
+    holdings = dict.fromkeys(assets, 0.0)
+
+    for i in range(n):
+        when = start + step * i + timedelta(seconds=rnd.randrange(max(int(step.total_seconds()), 1)))
+        transaction_type = rnd.choices(types, weights)[0]
+        asset = rnd.choice(assets)
+        if transaction_type != "BUY" and holdings[asset] <= 0:
+            transaction_type = "BUY"
+        price = prices.price(asset, when)
+        row = {
+            "chain": "EXCH",
+            "transaction_type": transaction_type,
+            "transaction_date": when,
+            "tax_year": when.year,
+            "gas_fees": 0.0,
+            "gas_asset": "",
+            "gas_asset_price_usd": 0.0,
+        }
+        if transaction_type == "BUY":
+            amount = rnd.uniform(10, 1000) / price
+            holdings[asset] += amount
+            row.update(from_asset="USD", from_amount=amount * price, from_asset_price_usd=1.0,
+                       to_asset=asset, to_amount=amount, to_asset_cost_basis=price)
+        else:
+            amount = holdings[asset] * rnd.uniform(0.05, 0.6)
+            holdings[asset] -= amount
+            if transaction_type == "SELL":
+                to_asset, to_amount, to_price = "USD", amount * price, 1.0
+            else:
+                to_asset = rnd.choice([other for other in assets if other != asset] or [asset])
+                to_price = prices.price(to_asset, when)
+                to_amount = amount * price / to_price
+            row.update(from_asset=asset, from_amount=amount, from_asset_price_usd=price,
+                       to_asset=to_asset, to_amount=to_amount, to_asset_cost_basis=to_price)
+        if "ETH" in holdings and rnd.random() < gas_share:
+            gas = 0.002 * rnd.random()
+            if holdings["ETH"] > gas:
+                holdings["ETH"] -= gas
+                row.update(chain="ETH", gas_fees=gas, gas_asset="ETH", gas_asset_price_usd=prices.price("ETH", when))
+        yield row
+
+
+def write_kraken_csv(path, n, assets=DEFAULT_ASSETS, quotes=("USD", "EUR"), years=6, seed=0,
+                     start=datetime(2015, 1, 1)):
+    """
+    Write a Kraken trades export of n rows, in the format import_kraken_stream() reads.
+    """
+    rnd = random.Random(seed)
+    prices = PriceWalk(assets, seed, start)
+    step = timedelta(days=365 * years) / max(n, 1)
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        writer.writerow(["txid", "ordertxid", "pair", "time", "type", "ordertype", "price", "cost", "fee", "vol",
+                         "margin", "misc", "ledgers"])
+        for i in range(n):
+            when = start + step * i
+            asset = rnd.choice(assets)
+            quote = rnd.choice(quotes)
+            price = prices.price(asset, when)
+            vol = rnd.uniform(10, 1000) / price
+            cost = vol * price
+            writer.writerow([
+                f"T{i:07d}-BENCH", f"O{i:07d}-BENCH", f"{KRAKEN_CODES.get(asset, asset)}/{quote}",
+                when.strftime("%Y-%m-%d %H:%M:%S.%f")[:-2], rnd.choice(("buy", "sell")), "limit",
+                f"{price:.5f}", f"{cost:.5f}", f"{cost * 0.0026:.5f}", f"{vol:.8f}", 0, "", "",
+            ])
+
+
+def synthetic_market_chart_range(gecko_id, range_start, range_end, vs_currency="usd"):
+    """
+    Offline stand-in for prices.fetch_market_chart_range(): hourly prices from a
+    deterministic walk, in CoinGecko's [timestamp in ms, price] format.
+    """
+    walk = PriceWalk([gecko_id], seed=sum(map(ord, gecko_id)))
+    start = range_start - range_start % 3600
+    return [
+        [timestamp * 1000, walk.price(gecko_id, datetime.fromtimestamp(timestamp))]
+        for timestamp in range(start, range_end + 1, 3600)
+    ]
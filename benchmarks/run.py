@@ -0,0 +1,294 @@
+"""
+Time the gains recompute, imports, syncs, backfills and the main pages on
+synthetic ledgers, and write the results to a JSON file.
+
+    python -m benchmarks.run --sizes 1000,100000,1000000 --output bench_results.json
+    python -m benchmarks.run --sizes 1000,100000 --compare bench_results.json
+
+Each size runs in a fresh process with its own temporary SQLite database, so
+one size cannot warm caches for the next. With --database-url (e.g. a local
+PostgreSQL) the tables of that database are dropped and recreated for each
+size instead, so it must be a scratch database. CoinGecko is replaced by a synthetic
+price function and the explorers by a pre-filled offline ExplorerCache, so
+nothing goes to the network.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.engine import make_url
+
+from benchmarks.ledger import generate_ledger, write_kraken_csv, synthetic_market_chart_range
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZES = "1000,100000,1000000"
+
+# Rows inserted per bulk_insert() call when loading a ledger
+INSERT_BATCH_SIZE = 10000
+
+# Wallets synced from the explorer stand-in, and the share of the ledger size they hold
+SYNC_WALLETS = 4
+SYNC_SHARE = 0.1
+
+# A benchmark this much slower than the baseline is reported as a regression
+REGRESSION_THRESHOLD = 1.1
+
+# Benchmarks faster than this are too noisy to flag
+MIN_COMPARED_SECONDS = 0.1
+
+
+class Timings:
+    """
+    Collects named stage timings and their throughput.
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    def measure(self, name, func, rows=None):
+        started = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - started
+        self.results[name] = {"seconds": round(seconds, 4)}
+        if rows:
+            self.results[name]["rows"] = rows
+            self.results[name]["rows_per_second"] = round(rows / seconds, 1) if seconds else None
+        print(f"  {name}: {seconds:.3f}s")
+        return value
+
+
+def write_explorer_pages(directory, chain, addresses, per_wallet, page_limit, seed=0):
+    """
+    Fill an ExplorerCache directory with incoming native transfers for each
+    address, paged the way the explorers page by block range.
+    """
+    for n, address in enumerate(addresses):
+        start = datetime(2021, 1, 1)
+        items = [
+            {
+                "hash": f"0x{seed:04x}{n:04x}{i:056x}",
+                "blockNumber": str(i + 1),
+                "timeStamp": str(int((start + timedelta(minutes=37 * i)).timestamp())),
+                "from": "0x" + "ab" * 20,
+                "to": address,
+                "value": str(10**16 * (1 + i % 97)),
+                "gasUsed": "21000",
+                "gasPrice": str(10**9 * (5 + i % 50)),
+                "isError": "0",
+            }
+            for i in range(per_wallet)
+        ]
+        # A full page ends partway through its last block, so the next one starts there again
+        pos, start_block = 0, 0
+        while True:
+            page = items[pos:pos + page_limit]
+            path = os.path.join(directory, f"{chain}_txlist_{address}_{start_block}.json")
+            with open(path, "w") as file:
+                json.dump(page, file)
+            if len(page) < page_limit:
+                break
+            pos += page_limit - 1
+            start_block = int(page[-1]["blockNumber"])
+        for action in ("tokentx", "txlistinternal"):
+            with open(os.path.join(directory, f"{chain}_{action}_{address}_0.json"), "w") as file:
+                json.dump([], file)
+
+
+def run_size(size, workdir, engines, seed, database_url=None):
+    """
+    Run every benchmark for one ledger size. Must run in a fresh process: the
+    app reads its database URL and cache directories when it is imported.
+    :param database_url: Scratch database to use instead of a temporary SQLite file.
+    :return: Dict of benchmark name -> timing.
+    """
+    os.environ["DATABASE_URL"] = database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["EXPLORER_CACHE_DIR"] = os.path.join(workdir, "explorer_cache")
+    os.environ["EXPLORER_OFFLINE"] = "1"
+    os.environ["JOBS_DIR"] = os.path.join(workdir, "jobs")
+    sys.path.insert(0, BASE_DIR)
+
+    import app as tracker
+    import backfill
+    import chains
+    from fx import get_rate_table
+    from prices import price_store
+    from models import db, Transaction, get_gains_run, create_tables
+    from gains import normalize_method
+    from storage import bulk_insert
+
+    # Offline stand-ins: synthetic CoinGecko prices (with no rate limit to respect)
+    # and explorer pages recorded into the cache directory
+    price_store.fetch_range = synthetic_market_chart_range
+    backfill.COINGECKO_CALLS_PER_SECOND = 1000
+    backfill.COINGECKO_BURST = 1000
+    chains.EXPLORER_CALLS_PER_SECOND = 1000
+    chains.EXPLORER_BURST = 1000
+    cache = chains.ExplorerCache(os.environ["EXPLORER_CACHE_DIR"], offline=True)
+    addresses = [f"0x{n:040x}" for n in range(1, SYNC_WALLETS + 1)]
+    per_wallet = max(int(size * SYNC_SHARE) // SYNC_WALLETS, 1)
+    write_explorer_pages(cache.directory, "ETH", addresses, per_wallet, chains.EXPLORER_PAGE_LIMIT, seed)
+
+    csv_path = os.path.join(workdir, "kraken.csv")
+    write_kraken_csv(csv_path, size, seed=seed)
+
+    timings = Timings()
+    client = tracker.app.test_client()
+    with tracker.app.app_context():
+        if database_url:
+            db.drop_all()
+            create_tables()
+        # Build the FX rate cache up front so the first import does not pay for it
+        get_rate_table()
+        with open(csv_path, "rb") as stream:
+            timings.measure("import_kraken", lambda: tracker.import_kraken_stream(stream), rows=size)
+
+        # The synthetic ledger replaces the imported trades
+        Transaction.query.delete()
+        db.session.commit()
+
+        def insert_ledger():
+            batch = []
+            for mapping in generate_ledger(size, seed=seed):
+                batch.append(mapping)
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    bulk_insert(db.session, Transaction, batch)
+                    batch = []
+            if batch:
+                bulk_insert(db.session, Transaction, batch)
+            db.session.commit()
+        timings.measure("ledger_insert", insert_ledger, rows=size)
+
+        method = normalize_method(tracker.COST_BASIS_METHOD)
+        for engine in engines:
+            get_gains_run(method).computed_at = None
+            db.session.commit()
+            timings.measure(f"gains_full_{engine}", lambda: tracker.calculate_gains(engine), rows=size)
+
+        # Edit a transaction near the end of the ledger and replay from there
+        late = Transaction.query.order_by(Transaction.transaction_date.desc()) \
+            .offset(size // 10).first()
+        late.gas_fees = (late.gas_fees or 0) + 0.001
+        db.session.commit()
+        timings.measure("gains_incremental", lambda: tracker.calculate_gains(engines[0]))
+
+    for name, url in (("index_cold", "/"), ("index_warm", "/"), ("index_filtered", "/?asset=ETH&type=SELL"),
+                      ("summary", "/summary")):
+        response = timings.measure(name, lambda: client.get(url))
+        if response.status_code != 200:
+            raise Exception(f"GET {url} returned {response.status_code}")
+
+    with tracker.app.app_context():
+        synced = per_wallet * SYNC_WALLETS
+        timings.measure("sync_wallets", lambda: chains.sync_wallets(
+            [("ETH", address) for address in addresses], cache=cache), rows=synced)
+        timings.measure("backfill_prices", lambda: backfill.backfill_prices(progress=lambda done, total: None),
+                        rows=synced)
+
+        # Backups need the optional pyarrow
+        if importlib.util.find_spec("pyarrow") is not None:
+            from archive import backup_archive, restore_archive
+            backup_dir = os.path.join(workdir, "backup")
+            rows = Transaction.query.count()
+            for file_format in ("parquet", "arrow"):
+                directory = os.path.join(backup_dir, file_format)
+                timings.measure(f"backup_{file_format}", lambda: backup_archive(directory, file_format), rows=rows)
+                timings.measure(f"restore_{file_format}", lambda: restore_archive(directory, replace=True),
+                                rows=rows)
+
+    timings.results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return timings.results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    """
+    Print each benchmark's time against a baseline results file.
+    :return: Number of regressions beyond REGRESSION_THRESHOLD.
+    """
+    regressions = 0
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('created_at')}):")
+    for size, results in current["results"].items():
+        for name, timing in results.items():
+            old = baseline.get("results", {}).get(size, {}).get(name)
+            if not isinstance(timing, dict) or not isinstance(old, dict) or not old["seconds"]:
+                continue
+            ratio = timing["seconds"] / old["seconds"]
+            flag = ""
+            if ratio > REGRESSION_THRESHOLD and max(timing["seconds"], old["seconds"]) >= MIN_COMPARED_SECONDS:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {size:>8} {name:<22} {old['seconds']:>9.3f}s -> {timing['seconds']:>9.3f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma-separated ledger sizes (rows)")
+    parser.add_argument("--engines", default="reference",
+                        help="Comma-separated gains engines to time (reference, columnar, parallel)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-url", help="Scratch database to run against (its tables are dropped)")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    engines = args.engines.split(",")
+
+    if args.worker is not None:
+        results = run_size(args.worker, args.workdir, engines, args.seed, args.database_url)
+        with open(os.path.join(args.workdir, "results.json"), "w") as file:
+            json.dump(results, file)
+        return
+
+    report = {
+        "commit": git_commit(),
+        "database": make_url(args.database_url).get_backend_name() if args.database_url else "sqlite",
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "engines": engines,
+        "seed": args.seed,
+        "results": {},
+    }
+    for size in (int(size) for size in args.sizes.split(",")):
+        print(f"{size} rows:")
+        with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+            command = [sys.executable, "-m", "benchmarks.run", "--worker", str(size), "--workdir", workdir,
+                       "--engines", args.engines, "--seed", str(args.seed)]
+            if args.database_url:
+                command += ["--database-url", args.database_url]
+            subprocess.run(command, cwd=BASE_DIR, check=True)
+            with open(os.path.join(workdir, "results.json")) as file:
+                report["results"][str(size)] = json.load(file)
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if compare(baseline, report):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
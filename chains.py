@@ -0,0 +1,390 @@
+import glob
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from models import db, Transaction, SyncState, mark_dirty, existing_external_ids
+from ratelimit import TokenBucket, fetch_with_retry
+from metrics import outbound_request
+from storage import bulk_insert
+from config import EXPLORER_CACHE_DIR, EXPLORER_OFFLINE
+from vars import etherscan_key, basescan_key
+
+logger = logging.getLogger(__name__)
+
+EXPLORER_URLS = {
+    "ETH": "https://api.etherscan.io/api",
+    "BASE": "https://api.basescan.org/api",
+}
+EXPLORER_KEYS = {
+    "ETH": etherscan_key,
+    "BASE": basescan_key,
+}
+
+# Native asset of each chain
+NATIVE_ASSETS = {
+    "ETH": "ETH",
+    "BASE": "ETH",
+}
+
+# Account list actions ingested for every wallet
+SYNC_ACTIONS = ("txlist", "tokentx", "txlistinternal")
+
+# Explorers return at most this many results per list call
+EXPLORER_PAGE_LIMIT = 10000
+END_BLOCK = 99999999
+
+# Blocks behind the chain head a sync stops at, so that every list the explorer
+# indexes has caught up with its end block
+SYNC_CONFIRMATIONS = 12
+
+# Free explorer API keys allow 5 calls per second
+EXPLORER_CALLS_PER_SECOND = 4
+EXPLORER_BURST = 4
+
+SYNC_WORKERS = 4
+
+# Seconds a cached page that was not full stays valid (newer blocks may add to it)
+EXPLORER_CACHE_TTL = 3600
+
+
+def make_http_session(pool_size=SYNC_WORKERS):
+    """
+    HTTP session with a connection pool large enough for the sync workers.
+    """
+    http = requests.Session()
+    http.mount("https://", HTTPAdapter(pool_connections=len(EXPLORER_URLS), pool_maxsize=pool_size))
+    return http
+
+
+def explorer_service(chain):
+    # Label of a chain's explorer in the request and rate limit metrics
+    return f"explorer_{chain.lower()}"
+
+
+def fetch_latest_block(http, chain):
+    """
+    Number of the latest block of a chain, from the explorer's JSON-RPC proxy.
+    """
+    params = {"module": "proxy", "action": "eth_blockNumber", "apikey": EXPLORER_KEYS[chain]}
+    with outbound_request(explorer_service(chain)) as call:
+        response = http.get(EXPLORER_URLS[chain], params=params, timeout=60)
+        call.status_code = response.status_code
+    if response.status_code != 200:
+        raise Exception(f"Error fetching data: {response.status_code}")
+    result = response.json().get("result")
+    try:
+        return int(result, 16)
+    except (TypeError, ValueError):
+        raise Exception(f"Error fetching {chain} block number: {result}")
+
+
+def fetch_explorer_page(http, chain, action, address, start_block, end_block=END_BLOCK):
+    """
+    One explorer account list call (txlist, tokentx, ...) from start_block to end_block.
+    """
+    params = {
+        "module": "account",
+        "action": action,
+        "address": address,
+        "startblock": start_block,
+        "endblock": end_block,
+        "sort": "asc",
+        "apikey": EXPLORER_KEYS[chain],
+    }
+    with outbound_request(explorer_service(chain)) as call:
+        response = http.get(EXPLORER_URLS[chain], params=params, timeout=60)
+        call.status_code = response.status_code
+    if response.status_code != 200:
+        raise Exception(f"Error fetching data: {response.status_code}")
+    data = response.json()
+    if data["status"] == "1":
+        return data["result"]
+    if str(data.get("message", "")).startswith("No transactions found"):
+        return []
+    raise Exception(f"Error fetching {chain} {action}: {data.get('message')} {data.get('result')}")
+
+
+class ExplorerCache:
+    """
+    JSON files holding explorer pages, keyed by (chain, action, address, start block).
+
+    Full pages cover finished blocks and are reused forever, whatever the end
+    block. Shorter pages fetched up to a pinned end block are keyed on it too
+    and also reused forever; those fetched up to END_BLOCK expire after `ttl`
+    seconds. In offline mode only the files are read, so a directory of
+    recorded pages works as a fixture set.
+    """
+
+    def __init__(self, directory=EXPLORER_CACHE_DIR, ttl=EXPLORER_CACHE_TTL, offline=EXPLORER_OFFLINE):
+        self.directory = directory
+        self.ttl = ttl
+        self.offline = offline
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, chain, action, address, start_block, end_block=END_BLOCK):
+        name = f"{chain}_{action}_{address}_{start_block}"
+        if end_block != END_BLOCK:
+            name += f"_{end_block}"
+        return os.path.join(self.directory, name + ".json")
+
+    def get_page(self, fetch, chain, action, address, start_block, end_block=END_BLOCK):
+        full_path = self._path(chain, action, address, start_block)
+        path = self._path(chain, action, address, start_block, end_block)
+        for cached_path in dict.fromkeys([full_path, path]):
+            if not os.path.exists(cached_path):
+                continue
+            with open(cached_path) as file:
+                page = json.load(file)
+            full = len(page) >= EXPLORER_PAGE_LIMIT
+            if cached_path == full_path and not full and end_block != END_BLOCK:
+                continue  # Fetched up to another end block
+            fresh = end_block != END_BLOCK or time.time() - os.path.getmtime(cached_path) < self.ttl
+            if self.offline or fresh or full:
+                return page
+        if self.offline:
+            raise Exception(f"No cached {chain} {action} page for {address} from block {start_block}")
+
+        page = fetch()
+        if len(page) >= EXPLORER_PAGE_LIMIT:
+            path = full_path
+        elif end_block != END_BLOCK:
+            # Short pages up to earlier end blocks are superseded by this one
+            for stale_path in glob.glob(glob.escape(full_path[:-len(".json")]) + "_*.json"):
+                os.remove(stale_path)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(page, file)
+        os.replace(tmp_path, path)
+        return page
+
+
+def _result_key(item):
+    # Token transfers and internal transactions share their parent's hash
+    return (item["hash"], item.get("logIndex", ""), item.get("traceId", ""))
+
+
+def fetch_explorer_results(http, bucket, chain, action, address, start_block=0, end_block=END_BLOCK, cache=None):
+    """
+    Page through an explorer list by block range until it is exhausted.
+
+    A full page ends partway through its last block, so the next page starts
+    again at that block and the repeated results are dropped.
+    """
+    results = []
+    seen = set()
+    while True:
+        def fetch(start_block=start_block):
+            return fetch_with_retry(fetch_explorer_page, bucket, http, chain, action, address, start_block, end_block)
+
+        page = cache.get_page(fetch, chain, action, address, start_block, end_block) if cache else fetch()
+        # A cached full page may run past the end block
+        page = [item for item in page if int(item["blockNumber"]) <= end_block]
+        for item in page:
+            key = _result_key(item)
+            if key not in seen:
+                seen.add(key)
+                results.append(item)
+        if len(page) < EXPLORER_PAGE_LIMIT:
+            return results
+        next_block = int(page[-1]["blockNumber"])
+        if next_block == start_block:
+            raise Exception(f"More than {EXPLORER_PAGE_LIMIT} {action} results in {chain} block {start_block}")
+        start_block = next_block
+
+
+def _add_flow(flows, asset, amount, address, item):
+    if item["to"].lower() == address:
+        flows[asset] += amount
+    if item["from"].lower() == address:
+        flows[asset] -= amount
+
+
+def build_mappings(chain, address, txlist, tokentx, internal):
+    """
+    Join native, token and internal transfers by transaction hash into one
+    Transaction mapping per hash, from the wallet's net flow of each asset.
+
+    One asset out and one in makes a SWAP, only incoming a BUY (at market
+    value) and only outgoing a SELL. A transaction that moves nothing is kept
+    as an APPROVE so its gas is still accounted for.
+
+    Rows are keyed on the hash and the wallet, so a transfer between two
+    synced wallets is stored once for each side.
+    """
+    native = NATIVE_ASSETS[chain]
+    by_hash = defaultdict(lambda: {"tx": None, "items": []})
+    for tx in txlist:
+        by_hash[tx["hash"]]["tx"] = tx
+    for item in tokentx:
+        by_hash[item["hash"]]["items"].append(item)
+    for item in internal:
+        by_hash[item["hash"]]["items"].append(item)
+
+    mappings = []
+    for tx_hash, group in by_hash.items():
+        tx = group["tx"]
+        first = tx or group["items"][0]
+        flows = defaultdict(float)  # Insertion order follows the explorer order
+
+        gas_fees = 0.0
+        if tx is not None:
+            if tx["from"].lower() == address:
+                gas_fees = int(tx["gasUsed"]) * int(tx["gasPrice"]) / (10**18)
+            if tx.get("isError") != "1":
+                _add_flow(flows, native, int(tx["value"]) / (10**18), address, tx)
+        for item in group["items"]:
+            if item.get("isError") == "1":
+                continue
+            if "tokenSymbol" in item:
+                amount = int(item["value"]) / (10**int(item["tokenDecimal"] or 0))
+                _add_flow(flows, item["tokenSymbol"], amount, address, item)
+            else:
+                _add_flow(flows, native, int(item["value"]) / (10**18), address, item)
+
+        outgoing = [(asset, -amount) for asset, amount in flows.items() if amount < 0]
+        incoming = [(asset, amount) for asset, amount in flows.items() if amount > 0]
+        note = None
+        if len(outgoing) > 1 or len(incoming) > 1:
+            note = "Multi-asset transaction: " + ", ".join(
+                f"{amount:+g} {asset}" for asset, amount in flows.items() if amount
+            )
+
+        if outgoing and incoming:
+            transaction_type = "SWAP"
+            (from_asset, from_amount), (to_asset, to_amount) = outgoing[0], incoming[0]
+        elif incoming:
+            transaction_type = "BUY"
+            from_asset, from_amount = incoming[0]
+            to_asset, to_amount = incoming[0]
+        elif outgoing:
+            transaction_type = "SELL"
+            from_asset, from_amount = outgoing[0]
+            to_asset, to_amount = None, 0.0
+        else:
+            transaction_type = "APPROVE"
+            from_asset, from_amount = native, 0.0
+            to_asset, to_amount = None, 0.0
+
+        transaction_date = datetime.fromtimestamp(int(first["timeStamp"]))
+        mappings.append({
+            "source": chain,
+            "external_id": f"{tx_hash}:{address}",
+            "chain": chain,
+            "from_asset": from_asset,
+            "from_amount": from_amount,
+            "from_asset_price_usd": 0,
+            "to_asset": to_asset,
+            "to_amount": to_amount,
+            "transaction_type": transaction_type,
+            "transaction_date": transaction_date,
+            "tax_year": transaction_date.year,
+            "gas_fees": gas_fees,
+            "gas_asset": native,
+            "gas_asset_price_usd": 0.0,
+            "note": note,
+        })
+    return mappings
+
+
+def get_sync_state(chain, address):
+    state = SyncState.query.filter_by(chain=chain, address=address).first()
+    if state is None:
+        state = SyncState(chain=chain, address=address, last_block=0)
+        db.session.add(state)
+    return state
+
+
+def store_mappings(chain, mappings):
+    """
+    Insert the mappings whose hash is not stored yet for their wallet.
+    :return: Number of transactions inserted.
+    """
+    known = existing_external_ids(chain, {m["external_id"] for m in mappings})
+    mappings = [m for m in mappings if m["external_id"] not in known]
+
+    # Bulk inserts bypass the change tracking, so flag the gains explicitly
+    if mappings:
+        bulk_insert(db.session, Transaction, mappings)
+        mark_dirty(min(m["transaction_date"] for m in mappings))
+    return len(mappings)
+
+
+def fetch_wallet(http, bucket, cache, chain, address, start_block):
+    """
+    Fetch every SYNC_ACTIONS list for one wallet from start_block on.
+
+    All lists stop at the same end block, pinned before the first is fetched:
+    otherwise a block mined in between would be stored from only some of
+    them, and the next sync, resuming after it, would never add the rest.
+    Offline, the recorded pages cannot change, so the lists are not pinned.
+    """
+    end_block = END_BLOCK
+    if not (cache and cache.offline):
+        end_block = fetch_with_retry(fetch_latest_block, bucket, http, chain) - SYNC_CONFIRMATIONS
+    if end_block < start_block:
+        return {action: [] for action in SYNC_ACTIONS}
+    return {
+        action: fetch_explorer_results(http, bucket, chain, action, address, start_block, end_block, cache)
+        for action in SYNC_ACTIONS
+    }
+
+
+def sync_wallets(wallets, workers=SYNC_WORKERS, cache=None, progress=None):
+    """
+    Fetch new transactions for several (chain, address) wallets concurrently.
+
+    Each wallet resumes from the highest block stored by its previous sync.
+    Network calls run in worker threads; rows are written from this thread.
+    :param wallets: Iterable of (chain, address) pairs.
+    :param cache: ExplorerCache to read/write pages through (the default directory if None).
+    :param progress: Optional callable receiving (wallets done, wallets total) as each wallet finishes.
+    :return: (dict of "chain address" -> new transactions, dict of errors)
+    """
+    if cache is None:
+        cache = ExplorerCache()
+    wallets = {(chain, address.lower()) for chain, address in wallets if address}
+    states = {wallet: get_sync_state(*wallet) for wallet in wallets}
+    db.session.commit()
+
+    http = make_http_session(workers)
+    buckets = {
+        chain: TokenBucket(EXPLORER_CALLS_PER_SECOND, EXPLORER_BURST, explorer_service(chain))
+        for chain in EXPLORER_URLS
+    }
+    inserted = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_wallet, http, buckets[chain], cache, chain,
+                            address, states[(chain, address)].last_block): (chain, address)
+            for chain, address in sorted(wallets)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            chain, address = futures[future]
+            label = f"{chain} {address}"
+            if progress is not None:
+                progress(done, len(futures))
+            try:
+                results = future.result()
+            except Exception as e:
+                errors[label] = str(e)
+                continue
+
+            mappings = build_mappings(chain, address, results["txlist"], results["tokentx"], results["txlistinternal"])
+            inserted[label] = store_mappings(chain, mappings)
+            state = states[(chain, address)]
+            blocks = [int(item["blockNumber"]) for entries in results.values() for item in entries]
+            if blocks:
+                state.last_block = max(state.last_block, max(blocks))
+            state.synced_at = datetime.now()
+            db.session.commit()
+            logger.info("Synced wallet", extra={"wallet": label, "inserted": inserted[label]})
+    return inserted, errors
@@ -0,0 +1,202 @@
+"""
+Command line for unattended runs (cron, CI), without starting the web app:
+
+    python cli.py import-kraken trades.csv
+    python cli.py sync ETH:0xabc... BASE:0xdef...
+    python cli.py backfill
+    python cli.py recompute --method HIFO
+    python cli.py export 2024 --output capgains_2024.csv
+    python cli.py backup backup/ --format parquet
+    python cli.py restore backup/ --replace
+
+Results are printed to stdout as JSON (the CSV for export), logs go to stderr.
+Modules are imported inside the subcommands, so each one only loads what it
+uses: --help needs nothing but argparse, only sync and backfill import
+requests and only backup and restore import pyarrow.
+"""
+import argparse
+import json
+import sys
+
+
+def open_database():
+    """
+    Push an app context on a bare Flask app bound to the configured database,
+    creating any missing tables. The routes, forms and job runner are not loaded.
+    """
+    from flask import Flask
+    from config import Config, LOG_LEVEL, LOG_FORMAT
+    from metrics import configure_logging
+    from models import db, create_tables
+
+    configure_logging(LOG_LEVEL, LOG_FORMAT)
+    app = Flask("crypto-tax-tracker")
+    app.config.from_object(Config)
+    db.init_app(app)
+    app.app_context().push()
+    create_tables()
+
+
+def print_result(result):
+    print(json.dumps(result, indent=2, default=str))
+
+
+def import_kraken(args):
+    from kraken import import_kraken_stream
+
+    open_database()
+    results = {}
+    for path in args.files:
+        with open(path, "rb") as stream:
+            results[path] = import_kraken_stream(stream)
+    print_result(results)
+    return 0
+
+
+def parse_wallet(value):
+    chain, _, address = value.partition(":")
+    if not address:
+        raise argparse.ArgumentTypeError(f"expected CHAIN:ADDRESS, got {value!r}")
+    return chain.upper(), address.lower()
+
+
+def sync(args):
+    from chains import sync_wallets, EXPLORER_URLS
+
+    unknown = {chain for chain, _ in args.wallets} - set(EXPLORER_URLS)
+    if unknown:
+        print(f"Unknown chains: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+    open_database()
+    inserted, errors = sync_wallets(args.wallets)
+    print_result({"inserted": inserted, "errors": errors})
+    return 1 if errors else 0
+
+
+def backfill(args):
+    from backfill import backfill_prices
+
+    open_database()
+    result = backfill_prices()
+    print_result(result)
+    return 1 if result["failed_requests"] else 0
+
+
+def recompute(args):
+    from config import COST_BASIS_METHOD
+    from models import db, get_gains_run
+    from gains import normalize_method
+    from gains_store import calculate_gains, RecomputeInProgress
+
+    try:
+        method = normalize_method(args.method or COST_BASIS_METHOD)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    open_database()
+    if args.full:
+        get_gains_run(method).computed_at = None
+        db.session.commit()
+    try:
+        replayed = calculate_gains(args.engine, method=method)
+    except RecomputeInProgress as e:
+        print(e, file=sys.stderr)
+        return 1
+    print_result({"method": method, "replayed": replayed})
+    return 0
+
+
+def export(args):
+    from gains import normalize_method
+    from gains_store import calculate_gains, iter_disposals_csv, RecomputeInProgress
+
+    if args.method:
+        try:
+            normalize_method(args.method)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+    open_database()
+    if not args.no_recompute:
+        try:
+            calculate_gains(method=args.method)
+        except RecomputeInProgress as e:
+            print(e, file=sys.stderr)
+            return 1
+    if args.output == "-":
+        sys.stdout.writelines(iter_disposals_csv(args.tax_year, args.method))
+    else:
+        with open(args.output, "w", newline="") as file:
+            file.writelines(iter_disposals_csv(args.tax_year, args.method))
+    return 0
+
+
+def backup(args):
+    from archive import backup_archive
+
+    open_database()
+    print_result(backup_archive(args.directory, args.format))
+    return 0
+
+
+def restore(args):
+    from archive import restore_archive
+
+    open_database()
+    try:
+        loaded = restore_archive(args.directory, replace=args.replace)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print_result(loaded)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Crypto tax tracker batch commands.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("import-kraken", help="Import Kraken trades CSV exports")
+    command.add_argument("files", nargs="+", metavar="FILE")
+    command.set_defaults(func=import_kraken)
+
+    command = commands.add_parser("sync", help="Fetch new on-chain transactions for wallets")
+    command.add_argument("wallets", nargs="+", type=parse_wallet, metavar="CHAIN:ADDRESS")
+    command.set_defaults(func=sync)
+
+    command = commands.add_parser("backfill", help="Fill in missing prices from CoinGecko")
+    command.set_defaults(func=backfill)
+
+    command = commands.add_parser("recompute", help="Recalculate gains for the changed part of the ledger")
+    command.add_argument("--method", help="Cost basis method or plan (defaults to COST_BASIS_METHOD)")
+    command.add_argument("--engine", choices=("reference", "columnar", "parallel"),
+                         help="Lot matching implementation (defaults to GAINS_ENGINE)")
+    command.add_argument("--full", action="store_true", help="Replay the whole ledger, ignoring checkpoints")
+    command.set_defaults(func=recompute)
+
+    command = commands.add_parser("export", help="Write the capital gains CSV of a tax year")
+    command.add_argument("tax_year", type=int)
+    command.add_argument("--method", help="Cost basis method or plan (defaults to COST_BASIS_METHOD)")
+    command.add_argument("--output", default="-", help="File to write (default: stdout)")
+    command.add_argument("--no-recompute", action="store_true", help="Export the stored disposals as they are")
+    command.set_defaults(func=export)
+
+    command = commands.add_parser("backup", help="Write the ledger, lots and disposals to Parquet or Arrow files")
+    command.add_argument("directory")
+    command.add_argument("--format", choices=("parquet", "arrow"), default="parquet")
+    command.set_defaults(func=backup)
+
+    command = commands.add_parser("restore", help="Load a backup written by the backup command")
+    command.add_argument("directory")
+    command.add_argument("--replace", action="store_true", help="Delete the current ledger first")
+    command.set_defaults(func=restore)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,8 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, FloatField, DateTimeField, SelectField, SubmitField, IntegerField, BooleanField, TextAreaField
 from wtforms.validators import DataRequired, InputRequired
 
+TRANSACTION_TYPES = ["BUY", "SELL", "SWAP", "TXFR", "CLAIM", "AIRDROP", "STAKE", "APPROVE"]
+
 class TransactionForm(FlaskForm):
     # Required fields
     from_asset = StringField("From Asset", validators=[DataRequired()])
@@ -14,9 +16,7 @@ class TransactionForm(FlaskForm):
     )
     transaction_type = SelectField(
         "Transaction Type", 
-        choices=[("BUY", "BUY"), ("SELL", "SELL"), ("SWAP", "SWAP"), 
-                 ("TXFR", "TXFR"), ("CLAIM", "CLAIM"), ("AIRDROP", "AIRDROP"), ("STAKE", "STAKE"),
-                 ("APPROVE", "APPROVE")],
+        choices=[(tx_type, tx_type) for tx_type in TRANSACTION_TYPES],
         validators=[DataRequired()]
     )
     transaction_date = DateTimeField("Transaction Date", format="%Y-%m-%d %H:%M:%S", validators=[DataRequired()])
@@ -0,0 +1,150 @@
+import logging
+import mmap
+import os
+import struct
+from datetime import date, datetime
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; batches are then converted one date at a time
+    np = None
+
+from config import FX_RATES_PATH
+
+logger = logging.getLogger(__name__)
+
+# File layout: header followed by one little-endian float64 per day, holding
+# the number of USD per EUR on that day (weekends/holidays interpolated)
+_MAGIC = b"FXR1"
+_HEADER = struct.Struct("<4sIqd")  # magic, day count, first day ordinal, source file mtime
+
+
+def _day_ordinal(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.toordinal()
+
+
+class RateTable:
+    """
+    Dense daily USD/EUR rates, indexed by day.
+    """
+
+    def __init__(self, first_ordinal, rates):
+        self.first_ordinal = first_ordinal
+        self.rates = rates  # USD per EUR, one entry per day
+
+    def _rate(self, value):
+        index = _day_ordinal(value) - self.first_ordinal
+        if not 0 <= index < len(self.rates):
+            first = date.fromordinal(self.first_ordinal)
+            last = date.fromordinal(self.first_ordinal + len(self.rates) - 1)
+            raise ValueError(f"{value} not in USD/EUR rate bounds {first}/{last}")
+        return self.rates[index]
+
+    def usd_to_eur(self, value, amount=1.0):
+        return amount / self._rate(value)
+
+    def eur_to_usd(self, value, amount=1.0):
+        return amount * self._rate(value)
+
+    def _rates_many(self, dates):
+        """
+        Rates of a batch of dates as an array, indexed by day offset in one
+        vectorized step. Needs NumPy.
+        """
+        # date.toordinal() also takes datetimes; it is much faster than numpy's datetime64 conversion
+        ordinals = np.fromiter(map(date.toordinal, dates), dtype=np.int64, count=len(dates))
+        indexes = ordinals - self.first_ordinal
+        outside = (indexes < 0) | (indexes >= len(self.rates))
+        if outside.any():
+            self._rate(dates[int(np.argmax(outside))])  # Raises the out-of-bounds error
+        return np.asarray(self.rates)[indexes]
+
+    def usd_to_eur_many(self, dates):
+        """
+        USD->EUR rates for a batch of dates.
+        """
+        if np is None:
+            return [1.0 / self._rate(value) for value in dates]
+        return (1.0 / self._rates_many(dates)).tolist()
+
+    def eur_to_usd_many(self, dates):
+        """
+        EUR->USD rates for a batch of dates.
+        """
+        if np is None:
+            return [self._rate(value) for value in dates]
+        return self._rates_many(dates).tolist()
+
+    def convert(self, amount, currency, new_currency, date):
+        """
+        Drop-in for CurrencyConverter.convert(), limited to USD and EUR.
+        """
+        if currency == new_currency:
+            return amount
+        if (currency, new_currency) == ("USD", "EUR"):
+            return self.usd_to_eur(date, amount)
+        if (currency, new_currency) == ("EUR", "USD"):
+            return self.eur_to_usd(date, amount)
+        raise ValueError(f"Unsupported conversion {currency}->{new_currency}")
+
+
+def _source_file():
+    from currency_converter.currency_converter import CURRENCY_FILE
+    return CURRENCY_FILE
+
+
+def build_rate_table(path=FX_RATES_PATH):
+    """
+    Parse the ECB dataset once and write the daily rate file.
+    """
+    from currency_converter import CurrencyConverter
+
+    source = _source_file()
+    converter = CurrencyConverter(source, fallback_on_missing_rate=True)
+    first_date, last_date = converter.bounds["USD"]
+    first_ordinal = first_date.toordinal()
+    count = last_date.toordinal() - first_ordinal + 1
+    rates = [
+        converter.convert(1.0, "EUR", "USD", date=date.fromordinal(first_ordinal + i))
+        for i in range(count)
+    ]
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(_HEADER.pack(_MAGIC, count, first_ordinal, os.path.getmtime(source)))
+        file.write(struct.pack(f"<{count}d", *rates))
+    os.replace(tmp_path, path)
+    logger.info("Built USD/EUR rate table", extra={"first_date": first_date, "last_date": last_date})
+
+
+def load_rate_table(path=FX_RATES_PATH):
+    """
+    Memory-map the daily rate file, (re)building it if it is missing or older
+    than the ECB dataset shipped with currency_converter.
+    """
+    header = None
+    if os.path.exists(path):
+        with open(path, "rb") as file:
+            header = _HEADER.unpack(file.read(_HEADER.size))
+    if header is None or header[0] != _MAGIC or header[3] < os.path.getmtime(_source_file()):
+        build_rate_table(path)
+
+    with open(path, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    _, count, first_ordinal, _ = _HEADER.unpack_from(mapped)
+    rates = memoryview(mapped)[_HEADER.size:_HEADER.size + 8 * count].cast("d")
+    return RateTable(first_ordinal, rates)
+
+
+_rate_table = None
+
+def get_rate_table():
+    """
+    Return the process-wide rate table, loading it on first use.
+    """
+    global _rate_table
+    if _rate_table is None:
+        _rate_table = load_rate_table()
+    return _rate_table
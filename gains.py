@@ -0,0 +1,458 @@
+import heapq
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime
+
+# Holding period (in days) below which a disposal is short term
+SHORT_TERM_DAYS = 365
+
+# Lot selection methods. SPECIFIC consumes the lots chosen for a disposal (see
+# LotSelection) first and falls back to FIFO for the rest.
+COST_BASIS_METHODS = ("FIFO", "LIFO", "HIFO", "SPECIFIC")
+
+# Columns needed from each transaction to run the lot matching
+LEDGER_COLUMNS = (
+    "id", "transaction_type", "transaction_date", "tax_year",
+    "from_asset", "from_amount", "from_asset_price_usd",
+    "to_asset", "to_amount", "to_asset_cost_basis",
+    "gas_fees", "gas_asset", "gas_asset_price_usd",
+)
+
+# One allocation of (part of) a lot against a SELL/SWAP or a gas fee
+Disposal = namedtuple("Disposal", [
+    "transaction_id", "lot_transaction_id", "asset", "quantity",
+    "date_acquired", "date_sold", "proceeds", "cost_basis",
+    "is_short", "is_gas", "tax_year",
+])
+
+
+class OpenLot:
+    """
+    In-memory counterpart of a row in the lots table.
+    """
+    __slots__ = ("transaction_id", "asset_name", "remaining_amount", "buy_price", "transaction_date")
+
+    def __init__(self, transaction_id, asset_name, remaining_amount, buy_price, transaction_date):
+        self.transaction_id = transaction_id
+        self.asset_name = asset_name
+        self.remaining_amount = remaining_amount
+        self.buy_price = buy_price
+        self.transaction_date = transaction_date
+
+    def to_mapping(self):
+        return {
+            "transaction_id": self.transaction_id,
+            "asset_name": self.asset_name,
+            "remaining_amount": self.remaining_amount,
+            "buy_price": self.buy_price,
+            "transaction_date": self.transaction_date,
+        }
+
+
+class FifoPool(deque):
+    """
+    Open lots of one asset, oldest first.
+    """
+    push = deque.append
+    pop = deque.popleft
+
+    def peek(self):
+        return self[0]
+
+
+class LifoPool(list):
+    """
+    Open lots of one asset as a stack, newest on top.
+    """
+    push = list.append
+    pop = list.pop
+
+    def peek(self):
+        return self[-1]
+
+
+class HifoPool:
+    """
+    Open lots of one asset as a heap, highest buy price on top (oldest first on ties).
+    """
+    __slots__ = ("heap",)
+
+    def __init__(self):
+        self.heap = []
+
+    def push(self, lot):
+        heapq.heappush(self.heap, (-lot.buy_price, lot.transaction_date, lot.transaction_id, lot))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[3]
+
+    def peek(self):
+        return self.heap[0][3]
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return (entry[3] for entry in sorted(self.heap))
+
+
+POOLS = {"FIFO": FifoPool, "LIFO": LifoPool, "HIFO": HifoPool, "SPECIFIC": FifoPool}
+
+
+def parse_method_plan(method):
+    """
+    Parse a cost basis method, optionally changing by tax year.
+    :param method: A method name, or a comma-separated plan like "FIFO,2022:HIFO"
+                   (FIFO before 2022, HIFO from 2022 on).
+    :return: List of (first tax year or None, method name), in year order.
+    """
+    plan = []
+    for i, part in enumerate(method.split(",")):
+        year, _, name = part.strip().rpartition(":")
+        name = name.upper()
+        if name not in COST_BASIS_METHODS:
+            raise ValueError(f"Unknown cost basis method: {name}")
+        if (i == 0) != (not year):
+            raise ValueError(f"Invalid cost basis method plan: {method}")
+        plan.append((int(year) if year else None, name))
+    if [year for year, _ in plan[1:]] != sorted(year for year, _ in plan[1:]):
+        raise ValueError(f"Invalid cost basis method plan: {method}")
+    return plan
+
+
+def normalize_method(method):
+    """
+    Canonical spelling of a cost basis method or plan, used to store its results.
+    """
+    return ",".join(name if year is None else f"{year}:{name}" for year, name in parse_method_plan(method))
+
+
+class LotEngine:
+    """
+    Per-asset pools of open lots, ordered by the lot selection method.
+
+    Exhausted lots are dropped from the top of their pool as soon as they
+    are used up, so every allocation only touches the lots it consumes, plus
+    O(log n) per lot for the HIFO heap. Lots consumed by specific
+    identification stay in their pool until they reach the top.
+
+    By default every lot opened is also kept in `lots`, to be written out
+    after the run. With `on_lot_closed`, lots are instead handed over as
+    they are used up and forgotten, so the engine only holds the open lots.
+    """
+
+    def __init__(self, method="FIFO", selections=None, on_lot_closed=None):
+        """
+        :param method: Cost basis method or plan, see parse_method_plan().
+        :param selections: Dict of disposing transaction id -> list of (lot transaction id, amount),
+                           used while the method is SPECIFIC.
+        :param on_lot_closed: Optional callable receiving each lot once it is used up.
+        """
+        self.method = method
+        self.plan = parse_method_plan(method)
+        self.current = self.plan[0][1]
+        self.selections = selections or {}
+        self.on_lot_closed = on_lot_closed
+        self.queues = defaultdict(POOLS[self.current])
+        self.by_id = {}  # Lot transaction id -> open lot, for specific identification
+        self.lots = []  # Every lot opened by this engine, in opening order (unless on_lot_closed is set)
+        self.restored = []  # Lots carried over from a checkpoint
+
+    def start_year(self, year):
+        """
+        Switch to the method the plan uses for a tax year, re-ordering the open lots if it changes.
+        """
+        method = self.current
+        for first_year, name in self.plan:
+            if first_year is None or first_year <= year:
+                method = name
+        if method == self.current:
+            return
+        open_lots = []
+        for lot in self.open_lots():
+            if lot.remaining_amount > 0:
+                open_lots.append(lot)
+            else:
+                self.close_lot(lot)
+        open_lots.sort(key=lambda lot: (lot.transaction_date, lot.transaction_id))
+        self.current = method
+        self.queues = defaultdict(POOLS[method])
+        for lot in open_lots:
+            self.queues[lot.asset_name].push(lot)
+
+    def snapshot(self):
+        """
+        Serializable state of the open lots, in pool order.
+        """
+        return [
+            [lot.transaction_id, lot.asset_name, lot.remaining_amount, lot.buy_price,
+             lot.transaction_date.isoformat()]
+            for pool in self.queues.values() for lot in pool if lot.remaining_amount > 0
+        ]
+
+    @classmethod
+    def restore(cls, snapshot, method="FIFO", selections=None, on_lot_closed=None):
+        """
+        Build an engine from the output of snapshot().
+        """
+        engine = cls(method, selections, on_lot_closed)
+        for transaction_id, asset_name, remaining_amount, buy_price, transaction_date in snapshot:
+            lot = OpenLot(transaction_id, asset_name, remaining_amount, buy_price,
+                          datetime.fromisoformat(transaction_date))
+            engine.restored.append(lot)
+            engine.add_lot(lot)
+        return engine
+
+    def add_lot(self, lot):
+        """
+        Put an open lot in its asset's pool.
+        """
+        self.queues[lot.asset_name].push(lot)
+        if self.selections:
+            self.by_id[lot.transaction_id] = lot
+
+    def close_lot(self, lot):
+        """
+        Hand a used up lot, no longer in any pool, to on_lot_closed.
+        """
+        if self.on_lot_closed is not None:
+            self.by_id.pop(lot.transaction_id, None)
+            self.on_lot_closed(lot)
+
+    def open_lots(self):
+        """
+        Every lot still in a pool, including ones used up by specific identification.
+        """
+        for pool in self.queues.values():
+            yield from pool
+
+    def holdings(self):
+        """
+        Per-asset totals of the open lots, as rows for the holdings table.
+        """
+        rows = []
+        for asset_name, pool in self.queues.items():
+            lots = [lot for lot in pool if lot.remaining_amount > 0]
+            if not lots:
+                continue
+            total_amount = sum(lot.remaining_amount for lot in lots)
+            total_cost = sum(lot.remaining_amount * lot.buy_price for lot in lots)
+            rows.append({
+                "asset_name": asset_name,
+                "total_amount": total_amount,
+                "total_cost": total_cost,
+                "average_cost": total_cost / total_amount,
+                "lot_count": len(lots),
+                "oldest_lot_date": min(lot.transaction_date for lot in lots),
+            })
+        return rows
+
+    def open_lot(self, transaction_id, asset_name, amount, buy_price, transaction_date):
+        lot = OpenLot(transaction_id, asset_name, amount, buy_price, transaction_date)
+        if self.on_lot_closed is None:
+            self.lots.append(lot)
+        if amount > 0:
+            self.add_lot(lot)
+        else:
+            self.close_lot(lot)
+        return lot
+
+    def allocate(self, asset_name, amount, transaction_id=None):
+        """
+        Consume `amount` of an asset, from the lots chosen for the transaction
+        (with SPECIFIC) and then from the top of the asset's pool.
+        :return: (list of (lot, allocated_amount), amount left unallocated)
+        """
+        allocations = []
+        if self.current == "SPECIFIC" and transaction_id in self.selections:
+            for lot_transaction_id, selected_amount in self.selections[transaction_id]:
+                lot = self.by_id.get(lot_transaction_id)
+                if amount <= 0:
+                    break
+                if lot is None or lot.asset_name != asset_name or lot.remaining_amount <= 0:
+                    continue
+                allocated_amount = min(amount, selected_amount, lot.remaining_amount)
+                allocations.append((lot, allocated_amount))
+                lot.remaining_amount -= allocated_amount
+                amount -= allocated_amount
+
+        pool = self.queues.get(asset_name)
+        if not pool:
+            return allocations, amount
+        peek, pop = pool.peek, pool.pop
+        closed = self.on_lot_closed is not None
+        while amount > 0 and pool:
+            lot = peek()
+            if lot.remaining_amount <= 0:
+                pop()  # Used up by specific identification
+            elif amount < lot.remaining_amount:
+                allocations.append((lot, amount))
+                lot.remaining_amount -= amount
+                amount = 0
+                continue
+            else:
+                allocations.append((lot, lot.remaining_amount))
+                amount -= lot.remaining_amount
+                lot.remaining_amount = 0
+                pop()
+            if closed:
+                self.close_lot(lot)
+        return allocations, amount
+
+
+def _dispose(engine, tx, asset, amount, price_usd, is_gas, on_disposal):
+    """
+    Allocate a disposal against the lot queues and split the gains by term.
+    :return: (short term gains, long term gains, amount left unallocated)
+    """
+    short_term_gains = 0
+    long_term_gains = 0
+    allocations, remaining = engine.allocate(asset, amount, None if is_gas else tx.id)
+    for lot, allocated_amount in allocations:
+        chunk_cost = allocated_amount * lot.buy_price
+        chunk_proceeds = allocated_amount * price_usd
+
+        holding_period_days = (tx.transaction_date - lot.transaction_date).days
+        is_short = (holding_period_days < SHORT_TERM_DAYS)
+
+        if is_short:
+            short_term_gains += chunk_proceeds - chunk_cost
+        else:
+            long_term_gains += chunk_proceeds - chunk_cost
+
+        if on_disposal is not None:
+            on_disposal(Disposal(
+                transaction_id=tx.id,
+                lot_transaction_id=lot.transaction_id,
+                asset=asset,
+                quantity=allocated_amount,
+                date_acquired=lot.transaction_date,
+                date_sold=tx.transaction_date,
+                proceeds=chunk_proceeds,
+                cost_basis=chunk_cost,
+                is_short=is_short,
+                is_gas=is_gas,
+                tax_year=tx.tax_year,
+            ))
+    return short_term_gains, long_term_gains, remaining
+
+
+def process_transaction(engine, tx, conversion_rate, on_disposal=None):
+    """
+    Apply one transaction to the lot engine.
+    :param engine: LotEngine holding the open lots.
+    :param tx: Row with the LEDGER_COLUMNS attributes.
+    :param conversion_rate: Callable returning the USD->EUR rate for a datetime.
+    :param on_disposal: Optional callable receiving every Disposal.
+    :return: Dict of gain/error columns for the transaction.
+    """
+    update = {
+        "id": tx.id,
+        "gains_usd_short": None,
+        "gains_eur_short": None,
+        "gains_usd_long": None,
+        "gains_eur_long": None,
+        "gains_gas_usd_short": None,
+        "gains_gas_eur_short": None,
+        "gains_gas_usd_long": None,
+        "gains_gas_eur_long": None,
+        "error": None,
+    }
+    rate = None
+
+    if tx.transaction_type == "BUY":
+        engine.open_lot(tx.id, tx.to_asset, tx.to_amount or 0.0,
+                        tx.to_asset_cost_basis or 0.0, tx.transaction_date)
+
+    # Process SELL or SWAP transactions for asset gains
+    elif tx.transaction_type in ("SELL", "SWAP"):
+        short_term_gains, long_term_gains, remaining = _dispose(
+            engine, tx, tx.from_asset, tx.from_amount, tx.from_asset_price_usd, False, on_disposal
+        )
+        if remaining > 0:
+            update["error"] = "SELL exceeds available BUY lots"
+        else:
+            rate = conversion_rate(tx.transaction_date)
+            update["gains_usd_short"] = short_term_gains
+            update["gains_usd_long"] = long_term_gains
+            update["gains_eur_short"] = short_term_gains * rate
+            update["gains_eur_long"] = long_term_gains * rate
+
+    # Process gas gains for transactions with gas fees in a non-fiat asset
+    gas_fees = tx.gas_fees or 0
+    if tx.gas_asset and gas_fees > 0:
+        short_term_gains, long_term_gains, remaining = _dispose(
+            engine, tx, tx.gas_asset, gas_fees, tx.gas_asset_price_usd or 0, True, on_disposal
+        )
+        if remaining > 0:
+            update["error"] = "Gas fees exceed available lots for the gas asset."
+        else:
+            if rate is None:
+                rate = conversion_rate(tx.transaction_date)
+            update["gains_gas_usd_short"] = short_term_gains
+            update["gains_gas_usd_long"] = long_term_gains
+            update["gains_gas_eur_short"] = short_term_gains * rate
+            update["gains_gas_eur_long"] = long_term_gains * rate
+
+    return update
+
+
+def compute_gains(rows, conversion_rate, on_disposal=None, engine=None, on_checkpoint=None, on_update=None):
+    """
+    Run the FIFO lot matching over a date-ordered ledger in a single pass.
+    :param rows: Iterable of rows ordered by (transaction_date, id).
+    :param conversion_rate: Callable returning the USD->EUR rate for a datetime.
+    :param on_disposal: Optional callable receiving every Disposal.
+    :param engine: Optional LotEngine to continue from (a fresh one by default).
+    :param on_checkpoint: Optional callable receiving (year start, engine snapshot)
+                          each time the pass crosses into a new calendar year.
+    :param on_update: Optional callable receiving each per-transaction update dict
+                      instead of collecting them, so the ledger can be streamed.
+    :return: (engine, list of per-transaction update dicts, empty with on_update)
+    """
+    if engine is None:
+        engine = LotEngine()
+    updates = []
+    add_update = updates.append if on_update is None else on_update
+    year = None
+    for tx in rows:
+        tx_year = tx.transaction_date.year
+        if tx_year != year:
+            if on_checkpoint is not None and year is not None:
+                on_checkpoint(datetime(tx_year, 1, 1), engine.snapshot())
+            engine.start_year(tx_year)
+        year = tx_year
+        add_update(process_transaction(engine, tx, conversion_rate, on_disposal))
+    return engine, updates
+
+
+def find_balance_errors(rows):
+    """
+    Check a date-ordered ledger for disposals that exceed the running holdings.
+    :param rows: Iterable of rows ordered by (transaction_date, id), with the
+                 LEDGER_COLUMNS attributes.
+    :return: Dict of transaction id -> error message (None when the row is fine).
+    """
+    balances = defaultdict(float)
+    bought = set()
+    errors = {}
+    for tx in rows:
+        error = None
+        if tx.transaction_type == "BUY":
+            balances[tx.to_asset] += tx.to_amount or 0.0
+            bought.add(tx.to_asset)
+
+        elif tx.transaction_type in ("SELL", "SWAP"):
+            if tx.from_asset not in bought:
+                error = f"Error: {tx.transaction_type} transaction for {tx.from_asset} before any BUY."
+            elif balances[tx.from_asset] < tx.from_amount:
+                error = f"Error: {tx.transaction_type} amount exceeds total available holdings for {tx.from_asset}."
+            balances[tx.from_asset] -= tx.from_amount
+
+        gas_fees = tx.gas_fees or 0
+        if tx.gas_asset and gas_fees > 0:
+            if error is None and balances[tx.gas_asset] < gas_fees:
+                error = f"Error: gas fees exceed total available holdings for {tx.gas_asset}."
+            balances[tx.gas_asset] -= gas_fees
+
+        errors[tx.id] = error
+    return errors
@@ -0,0 +1,265 @@
+"""
+Columnar (NumPy) implementation of the FIFO lot matching in gains.py.
+
+Instead of walking lot queues transaction by transaction, the ledger is
+loaded into arrays and, for each asset, every lot and every disposal is
+placed on a cumulative-amount axis:
+
+- lot k covers [S[k-1], S[k]), where S is the cumulative sum of lot amounts;
+- disposal j covers [D[j-1], D[j]), where D is the cumulative sum of the
+  disposed amounts, clamped so that it never runs past the supply that was
+  open at the time (a disposal can only consume lots opened before it, and
+  a shortfall is not carried over to later disposals).
+
+The allocations are then the overlaps between the two sets of intervals,
+found with searchsorted. Allocations, gains and errors match the reference
+engine up to floating-point rounding.
+"""
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+import numpy as np
+
+from gains import LEDGER_COLUMNS, LotEngine, OpenLot, Disposal, SHORT_TERM_DAYS
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_MICROS_PER_DAY = 86400 * 10**6
+
+# Allocations smaller than this fraction of an asset's total supply are rounding noise
+_DUST = 1e-12
+
+_SELL_ERROR = "SELL exceeds available BUY lots"
+_GAS_ERROR = "Gas fees exceed available lots for the gas asset."
+
+
+def _micros(dates):
+    # Microseconds since the epoch, so holding periods floor exactly like timedelta.days
+    return np.array([(d - _EPOCH) // _MICROSECOND for d in dates], dtype=np.int64)
+
+
+def _floats(values):
+    # None (NULL) becomes 0.0, as in the reference engine
+    return np.nan_to_num(np.array(values, dtype=np.float64), nan=0.0)
+
+
+def compute_gains_columnar(rows, conversion_rate, on_disposal=None, engine=None, on_checkpoint=None):
+    """
+    Drop-in replacement for gains.compute_gains() using vectorized FIFO matching.
+    :param rows: Iterable of rows ordered by (transaction_date, id), each a tuple
+                 of the LEDGER_COLUMNS in order.
+    :param conversion_rate: Callable returning the USD->EUR rate for a datetime.
+    :param on_disposal: Optional callable receiving every Disposal, in the same
+                        order as the reference engine.
+    :param engine: Optional LotEngine restored from a checkpoint. Only the FIFO
+                   method can be vectorized.
+    :param on_checkpoint: Optional callable receiving (year start, snapshot) for
+                          each calendar year the ledger crosses into.
+    :return: (engine holding the final lots, list of per-transaction update dicts)
+    """
+    if engine is not None and engine.method != "FIFO":
+        raise ValueError(f"The columnar engine only supports FIFO, not {engine.method}")
+    rows = list(rows)
+    n = len(rows)
+    restored = list(engine.restored) if engine is not None else []
+
+    # ---- Load the ledger into columns ------------------------------------------
+    columns = {name: list(map(itemgetter(i), rows)) for i, name in enumerate(LEDGER_COLUMNS)}
+    types = np.array(columns["transaction_type"], dtype=object)
+    dates = columns["transaction_date"]
+    tx_micros = _micros(dates)
+    to_amount = _floats(columns["to_amount"])
+    to_cost_basis = _floats(columns["to_asset_cost_basis"])
+    from_amount = _floats(columns["from_amount"])
+    from_price = _floats(columns["from_asset_price_usd"])
+    gas_fees = _floats(columns["gas_fees"])
+    gas_price = _floats(columns["gas_asset_price_usd"])
+
+    # Assets as categorical codes
+    codes = {}
+
+    def encode(assets):
+        for asset in dict.fromkeys(assets):
+            codes.setdefault(asset, len(codes))
+        return np.fromiter(map(codes.__getitem__, assets), dtype=np.int64, count=len(assets))
+
+    from_code = encode(columns["from_asset"])
+    to_code = encode(columns["to_asset"])
+    gas_code = encode(columns["gas_asset"])
+    restored_code = encode([lot.asset_name for lot in restored])
+    asset_names = list(codes)
+
+    # Lots: restored ones first (before every row), then one per BUY
+    buy_pos = np.flatnonzero(types == "BUY")
+    lot_pos = np.concatenate([np.full(len(restored), -1, dtype=np.int64), buy_pos])
+    lot_asset = np.concatenate([restored_code, to_code[buy_pos]])
+    lot_amount = np.concatenate([_floats([lot.remaining_amount for lot in restored]), to_amount[buy_pos]])
+    lot_price = np.concatenate([_floats([lot.buy_price for lot in restored]), to_cost_basis[buy_pos]])
+    lot_dates = [lot.transaction_date for lot in restored] + [dates[p] for p in buy_pos.tolist()]
+    lot_micros = np.concatenate([_micros(lot_dates[:len(restored)]), tx_micros[buy_pos]])
+    lot_tx_ids = [lot.transaction_id for lot in restored] + [columns["id"][p] for p in buy_pos.tolist()]
+
+    # Disposals: SELL/SWAP amounts (sub 0) and gas fees (sub 1), in (row, sub) order
+    sell_pos = np.flatnonzero((types == "SELL") | (types == "SWAP"))
+    gas_pos = np.flatnonzero((gas_code != codes.get(None, -1)) & (gas_code != codes.get("", -1)) & (gas_fees > 0))
+    dem_pos = np.concatenate([sell_pos, gas_pos])
+    dem_sub = np.concatenate([np.zeros(len(sell_pos), dtype=np.int64), np.ones(len(gas_pos), dtype=np.int64)])
+    dem_asset = np.concatenate([from_code[sell_pos], gas_code[gas_pos]])
+    dem_amount = np.concatenate([from_amount[sell_pos], gas_fees[gas_pos]])
+    dem_price = np.concatenate([from_price[sell_pos], gas_price[gas_pos]])
+    order = np.lexsort((dem_sub, dem_pos))
+    dem_pos, dem_sub, dem_asset, dem_amount, dem_price = (
+        dem_pos[order], dem_sub[order], dem_asset[order], dem_amount[order], dem_price[order]
+    )
+    nd = len(dem_pos)
+
+    # ---- Match every asset on the cumulative-amount axis -------------------------
+    lot_remaining = lot_amount.copy()
+    dem_short = np.zeros(nd, dtype=bool)
+    seg_dem, seg_lot, seg_qty = [], [], []
+    per_asset = []  # (lot indices, S0, demand positions, D0) for the checkpoints
+
+    for asset in np.union1d(np.unique(lot_asset), np.unique(dem_asset)):
+        li = np.flatnonzero(lot_asset == asset)
+        di = np.flatnonzero(dem_asset == asset)
+        amounts = np.maximum(lot_amount[li], 0.0)
+        S = np.cumsum(amounts)
+        S0 = np.concatenate([[0.0], S])
+
+        if len(di) == 0:
+            per_asset.append((li, S0, np.empty(0, dtype=np.int64), np.zeros(1)))
+            continue
+
+        # Supply open at each disposal, and the clamped cumulative demand
+        C = S0[np.searchsorted(lot_pos[li], dem_pos[di], side="right")]
+        A = np.cumsum(np.maximum(dem_amount[di], 0.0))
+        E = np.minimum.accumulate(np.minimum(0.0, C - A))
+        D = A + E
+        D0 = np.concatenate([[0.0], D])
+        dem_short[di] = E < np.concatenate([[0.0], E[:-1]])  # Clamped: not enough lots
+
+        # Overlaps between lot intervals and disposal intervals
+        points = np.unique(np.concatenate([S0, D0]))
+        points = points[points <= D[-1]]
+        lo, hi = points[:-1], points[1:]
+        keep = (hi - lo) > _DUST * max(S[-1], 1.0)
+        lo, hi = lo[keep], hi[keep]
+        mid = (lo + hi) / 2
+        seg_lot.append(li[np.searchsorted(S, mid, side="right")])
+        seg_dem.append(di[np.searchsorted(D, mid, side="right")])
+        seg_qty.append(hi - lo)
+
+        # Final remaining amount of each lot
+        consumed = D[-1]
+        lot_remaining[li] = np.where(S0[:-1] >= consumed, amounts, np.where(S <= consumed, 0.0, S - consumed))
+        per_asset.append((li, S0, dem_pos[di], D0))
+
+    # Lots that were never queued (non-positive amounts) keep their amount
+    lot_remaining = np.where(lot_amount > 0, lot_remaining, lot_amount)
+
+    seg_dem = np.concatenate(seg_dem) if seg_dem else np.empty(0, dtype=np.int64)
+    seg_lot = np.concatenate(seg_lot) if seg_lot else np.empty(0, dtype=np.int64)
+    seg_qty = np.concatenate(seg_qty) if seg_qty else np.empty(0)
+
+    # ---- Gains per allocation, classified and summed per disposal ----------------
+    seg_cost = seg_qty * lot_price[seg_lot]
+    seg_proceeds = seg_qty * dem_price[seg_dem]
+    seg_gain = seg_proceeds - seg_cost
+    seg_days = (tx_micros[dem_pos[seg_dem]] - lot_micros[seg_lot]) // _MICROS_PER_DAY
+    seg_is_short = seg_days < SHORT_TERM_DAYS
+    dem_short_gains = np.bincount(seg_dem, weights=np.where(seg_is_short, seg_gain, 0.0), minlength=nd)
+    dem_long_gains = np.bincount(seg_dem, weights=np.where(seg_is_short, 0.0, seg_gain), minlength=nd)
+
+    # ---- Per-transaction update dicts --------------------------------------------
+    ok = ~dem_short
+    rate_pos = np.unique(dem_pos[ok])
+    rate = np.zeros(n)
+    rate[rate_pos] = list(map(conversion_rate, map(dates.__getitem__, rate_pos.tolist())))
+
+    def gains_column(sub, gains, to_eur=False):
+        # Object column of floats, None where the transaction has no such gains
+        selected = ok & (dem_sub == sub)
+        positions = dem_pos[selected]
+        values = gains[selected] * rate[positions] if to_eur else gains[selected]
+        column = np.full(n, None, dtype=object)
+        column[positions] = values
+        return column.tolist()
+
+    error = np.full(n, None, dtype=object)
+    error[dem_pos[dem_short & (dem_sub == 0)]] = _SELL_ERROR
+    error[dem_pos[dem_short & (dem_sub == 1)]] = _GAS_ERROR  # Gas errors take precedence, as in process_transaction()
+
+    updates = [{
+        "id": tx_id,
+        "gains_usd_short": usd_short,
+        "gains_eur_short": eur_short,
+        "gains_usd_long": usd_long,
+        "gains_eur_long": eur_long,
+        "gains_gas_usd_short": gas_usd_short,
+        "gains_gas_eur_short": gas_eur_short,
+        "gains_gas_usd_long": gas_usd_long,
+        "gains_gas_eur_long": gas_eur_long,
+        "error": message,
+    } for tx_id, usd_short, eur_short, usd_long, eur_long,
+        gas_usd_short, gas_eur_short, gas_usd_long, gas_eur_long, message in zip(
+        columns["id"],
+        gains_column(0, dem_short_gains), gains_column(0, dem_short_gains, True),
+        gains_column(0, dem_long_gains), gains_column(0, dem_long_gains, True),
+        gains_column(1, dem_short_gains), gains_column(1, dem_short_gains, True),
+        gains_column(1, dem_long_gains), gains_column(1, dem_long_gains, True),
+        error.tolist(),
+    )]
+
+    # ---- Disposal rows, in the reference engine's order --------------------------
+    if on_disposal is not None and len(seg_dem):
+        order = np.lexsort((seg_lot, dem_sub[seg_dem], dem_pos[seg_dem]))
+        positions = dem_pos[seg_dem[order]].tolist()
+        gas = (dem_sub[seg_dem[order]] == 1).tolist()
+        lots = seg_lot[order].tolist()
+        for disposal in map(
+                Disposal,
+                map(columns["id"].__getitem__, positions),
+                map(lot_tx_ids.__getitem__, lots),
+                [gas_asset if is_gas else from_asset for gas_asset, from_asset, is_gas in zip(
+                    map(columns["gas_asset"].__getitem__, positions),
+                    map(columns["from_asset"].__getitem__, positions), gas)],
+                seg_qty[order].tolist(),
+                map(lot_dates.__getitem__, lots),
+                map(dates.__getitem__, positions),
+                seg_proceeds[order].tolist(),
+                seg_cost[order].tolist(),
+                seg_is_short[order].tolist(),
+                gas,
+                map(columns["tax_year"].__getitem__, positions)):
+            on_disposal(disposal)
+
+    # ---- Year-boundary checkpoints -----------------------------------------------
+    if on_checkpoint is not None and n:
+        years = np.array([d.year for d in dates])
+        lot_price_list = lot_price.tolist()
+        for pos in np.flatnonzero(years[1:] > years[:-1]) + 1:
+            snapshot = []
+            for li, S0, positions, D0 in per_asset:
+                consumed = D0[np.searchsorted(positions, pos, side="left")]
+                is_open = (lot_pos[li] < pos) & (lot_amount[li] > 0) & (S0[1:] > consumed)
+                remaining = np.where(S0[:-1] >= consumed, lot_amount[li], S0[1:] - consumed)
+                for k, amount in zip(li[is_open].tolist(), remaining[is_open].tolist()):
+                    snapshot.append([lot_tx_ids[k], asset_names[lot_asset[k]], amount,
+                                     lot_price_list[k], lot_dates[k].isoformat()])
+            on_checkpoint(datetime(int(years[pos]), 1, 1), snapshot)
+
+    # ---- Final lots, as a LotEngine -----------------------------------------------
+    result = LotEngine()
+    remaining = lot_remaining.tolist()
+    for lot, amount in zip(restored, remaining):
+        lot.remaining_amount = amount
+    result.restored = restored
+    first = len(restored)
+    result.lots = list(map(
+        OpenLot, lot_tx_ids[first:], map(asset_names.__getitem__, lot_asset[first:].tolist()), remaining[first:],
+        lot_price[first:].tolist(), lot_dates[first:]
+    ))
+    all_lots = restored + result.lots
+    for k in np.flatnonzero(lot_remaining > 0).tolist():
+        result.add_lot(all_lots[k])
+    return result, updates
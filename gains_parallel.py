@@ -0,0 +1,256 @@
+"""
+Per-asset parallel version of the FIFO lot matching in gains.py.
+
+Lots of an asset are only ever consumed by disposals of that same asset, so
+the ledger splits into one independent partition per consumed asset:
+
+- a BUY opens a lot in the partition of its to_asset;
+- a SELL/SWAP disposes of its from_asset in that asset's partition;
+- gas fees dispose of the gas asset in that asset's partition.
+
+Each partition is replayed with the reference engine in a worker process,
+and the partial results are merged back in ledger order. A transaction that
+sells one asset and pays gas in another gets its gains from two partitions.
+Since every partition does the same arithmetic in the same order as the
+single-threaded engine, the results are identical.
+"""
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from gains import LotEngine, OpenLot, Disposal, _dispose
+
+GAINS_WORKERS = os.cpu_count() or 1
+
+# Below this many transactions, starting worker processes costs more than it saves
+MIN_PARALLEL_ROWS = 20000
+
+# Event kinds, in the order process_transaction() applies them within a transaction.
+# Events are encoded as ledger position * 3 + kind, so they sort in ledger order.
+LOT, SELL, GAS = 0, 1, 2
+
+# Ledger of the current run, inherited by forked workers instead of pickled
+_ledger = None
+
+
+def _set_ledger(rows, partitions, method, selections):
+    global _ledger
+    _ledger = (rows, partitions, method, selections)
+
+
+def _match_inherited(asset):
+    rows, partitions, method, selections = _ledger
+    return match_partition(asset, rows, *partitions[asset], method=method, selections=selections)
+
+
+def match_partition(asset, rows, restored, events, boundaries, method="FIFO", selections=None):
+    """
+    Replay the events of one asset.
+    :param asset: Asset of the partition.
+    :param rows: The whole ledger.
+    :param restored: Snapshot entries of the asset's lots carried over from a checkpoint.
+    :param events: Encoded events of the asset, in ledger order.
+    :param boundaries: Ledger positions where a new calendar year starts (only
+                       needed for checkpoints).
+    :param method: Cost basis method or plan of the run.
+    :param selections: Lots chosen for disposals under the SPECIFIC method.
+    :return: Dict of flat lists (columns pickle much faster than rows on the way back from a worker):
+             "gain_events", "short_term_gains", "long_term_gains", "unallocated": one entry per disposal,
+             "disposal_events", "lot_transaction_ids", "quantities", "proceeds", "cost_basis", "is_short":
+             one entry per allocation, "lots" / "restored": remaining amount of every lot opened / restored,
+             "snapshots": one engine snapshot per boundary.
+    """
+    engine = LotEngine.restore(restored, method, selections)
+    output = {name: [] for name in (
+        "gain_events", "short_term_gains", "long_term_gains", "unallocated",
+        "disposal_events", "lot_transaction_ids", "quantities", "proceeds", "cost_basis", "is_short",
+        "snapshots",
+    )}
+    boundary = 0
+    year = None
+    for event in events:
+        pos, kind = divmod(event, 3)
+        while boundary < len(boundaries) and boundaries[boundary] <= pos:
+            output["snapshots"].append(engine.snapshot())
+            boundary += 1
+
+        tx = rows[pos]
+        if tx.transaction_date.year != year:
+            year = tx.transaction_date.year
+            engine.start_year(year)
+        if kind == LOT:
+            engine.open_lot(tx.id, asset, tx.to_amount or 0.0, tx.to_asset_cost_basis or 0.0, tx.transaction_date)
+            continue
+
+        def on_disposal(disposal):
+            output["disposal_events"].append(event)
+            output["lot_transaction_ids"].append(disposal.lot_transaction_id)
+            output["quantities"].append(disposal.quantity)
+            output["proceeds"].append(disposal.proceeds)
+            output["cost_basis"].append(disposal.cost_basis)
+            output["is_short"].append(disposal.is_short)
+
+        if kind == SELL:
+            short_term_gains, long_term_gains, remaining = _dispose(
+                engine, tx, asset, tx.from_amount, tx.from_asset_price_usd, False, on_disposal
+            )
+        else:
+            short_term_gains, long_term_gains, remaining = _dispose(
+                engine, tx, asset, tx.gas_fees, tx.gas_asset_price_usd or 0, True, on_disposal
+            )
+        output["gain_events"].append(event)
+        output["short_term_gains"].append(short_term_gains)
+        output["long_term_gains"].append(long_term_gains)
+        output["unallocated"].append(remaining)
+
+    output["snapshots"].extend(engine.snapshot() for _ in range(len(boundaries) - boundary))
+    output["lots"] = [lot.remaining_amount for lot in engine.lots]
+    output["restored"] = [lot.remaining_amount for lot in engine.restored]
+    return output
+
+
+def partition_ledger(rows, restored, boundaries=()):
+    """
+    Split the ledger into per-asset events.
+    :return: Dict of asset -> (restored snapshot entries, encoded events, boundaries)
+    """
+    partitions = defaultdict(lambda: ([], [], boundaries))
+    for lot in restored:
+        partitions[lot.asset_name][0].append(
+            [lot.transaction_id, lot.asset_name, lot.remaining_amount, lot.buy_price,
+             lot.transaction_date.isoformat()]
+        )
+    for pos, tx in enumerate(rows):
+        if tx.transaction_type == "BUY":
+            partitions[tx.to_asset][1].append(pos * 3 + LOT)
+        elif tx.transaction_type in ("SELL", "SWAP"):
+            partitions[tx.from_asset][1].append(pos * 3 + SELL)
+        if tx.gas_asset and (tx.gas_fees or 0) > 0:
+            partitions[tx.gas_asset][1].append(pos * 3 + GAS)
+    return dict(partitions)
+
+
+def compute_gains_parallel(rows, conversion_rate, on_disposal=None, engine=None, on_checkpoint=None,
+                           workers=GAINS_WORKERS):
+    """
+    Drop-in replacement for gains.compute_gains() running each asset in its own process.
+    :param rows: Iterable of rows ordered by (transaction_date, id).
+    :param conversion_rate: Callable returning the USD->EUR rate for a datetime.
+    :param on_disposal: Optional callable receiving every Disposal, in the same
+                        order as the reference engine.
+    :param engine: Optional LotEngine restored from a checkpoint.
+    :param on_checkpoint: Optional callable receiving (year start, snapshot) for
+                          each calendar year the ledger crosses into.
+    :param workers: Number of worker processes.
+    :return: (engine holding the final lots, list of per-transaction update dicts)
+    """
+    rows = list(rows)
+    if engine is None:
+        engine = LotEngine()
+    restored = list(engine.restored)
+    boundaries = []
+    if on_checkpoint is not None:
+        boundaries = [pos for pos in range(1, len(rows))
+                      if rows[pos].transaction_date.year > rows[pos - 1].transaction_date.year]
+
+    # Step 1: Replay every asset on its own, largest partitions first
+    partitions = partition_ledger(rows, restored, boundaries)
+    assets = sorted(partitions, key=lambda asset: (-len(partitions[asset][1]), str(asset)))
+    if workers > 1 and len(assets) > 1 and len(rows) >= MIN_PARALLEL_ROWS:
+        with ProcessPoolExecutor(max_workers=min(workers, len(assets)),
+                                 initializer=_set_ledger,
+                                 initargs=(rows, partitions, engine.method, engine.selections)) as executor:
+            outputs = dict(zip(assets, executor.map(_match_inherited, assets)))
+    else:
+        outputs = {asset: match_partition(asset, rows, *partitions[asset], method=engine.method,
+                                          selections=engine.selections)
+                   for asset in assets}
+
+    # Step 2: Merge the sell and gas results of every transaction
+    updates = [{
+        "id": tx.id,
+        "gains_usd_short": None,
+        "gains_eur_short": None,
+        "gains_usd_long": None,
+        "gains_eur_long": None,
+        "gains_gas_usd_short": None,
+        "gains_gas_eur_short": None,
+        "gains_gas_usd_long": None,
+        "gains_gas_eur_long": None,
+        "error": None,
+    } for tx in rows]
+    def column(name):
+        return [value for asset in assets for value in outputs[asset][name]]
+
+    events = column("gain_events")
+    rates = {}
+    # In event order, so that a gas error overrides a SELL error as in process_transaction()
+    for event, short_term_gains, long_term_gains, remaining in sorted(zip(
+            events, column("short_term_gains"), column("long_term_gains"), column("unallocated"))):
+        pos, kind = divmod(event, 3)
+        update = updates[pos]
+        if remaining > 0:
+            update["error"] = ("SELL exceeds available BUY lots" if kind == SELL
+                               else "Gas fees exceed available lots for the gas asset.")
+            continue
+        if pos not in rates:
+            rates[pos] = conversion_rate(rows[pos].transaction_date)
+        prefix = "gains_" if kind == SELL else "gains_gas_"
+        update[prefix + "usd_short"] = short_term_gains
+        update[prefix + "usd_long"] = long_term_gains
+        update[prefix + "eur_short"] = short_term_gains * rates[pos]
+        update[prefix + "eur_long"] = long_term_gains * rates[pos]
+
+    # Step 3: Final lots, as a LotEngine (pool order is re-derived from the lots)
+    result = LotEngine(engine.method, engine.selections)
+    if rows:
+        result.start_year(rows[-1].transaction_date.year)
+    restored_remaining = {asset: iter(outputs[asset]["restored"]) for asset in assets}
+    for lot in restored:
+        lot.remaining_amount = next(restored_remaining[lot.asset_name])
+        result.restored.append(lot)
+        if lot.remaining_amount > 0:
+            result.add_lot(lot)
+
+    lot_remaining = {asset: iter(outputs[asset]["lots"]) for asset in assets}
+    for tx in rows:
+        if tx.transaction_type == "BUY":
+            lot = OpenLot(tx.id, tx.to_asset, next(lot_remaining[tx.to_asset]),
+                          tx.to_asset_cost_basis or 0.0, tx.transaction_date)
+            result.lots.append(lot)
+            if lot.remaining_amount > 0:
+                result.add_lot(lot)
+
+    # Step 4: Disposals and checkpoints, in ledger order
+    if on_disposal is not None:
+        lot_dates = {lot.transaction_id: lot.transaction_date for lot in result.restored + result.lots}
+        events = column("disposal_events")
+        lot_transaction_ids = column("lot_transaction_ids")
+        quantities = column("quantities")
+        proceeds = column("proceeds")
+        cost_basis = column("cost_basis")
+        is_short = column("is_short")
+        # Stable sort: keeps the FIFO order of the allocations within a disposal
+        for index in sorted(range(len(events)), key=events.__getitem__):
+            pos, kind = divmod(events[index], 3)
+            tx = rows[pos]
+            on_disposal(Disposal(
+                transaction_id=tx.id,
+                lot_transaction_id=lot_transaction_ids[index],
+                asset=tx.gas_asset if kind == GAS else tx.from_asset,
+                quantity=quantities[index],
+                date_acquired=lot_dates[lot_transaction_ids[index]],
+                date_sold=tx.transaction_date,
+                proceeds=proceeds[index],
+                cost_basis=cost_basis[index],
+                is_short=is_short[index],
+                is_gas=kind == GAS,
+                tax_year=tx.tax_year,
+            ))
+
+    for index, pos in enumerate(boundaries):
+        snapshot = [entry for asset in assets for entry in outputs[asset]["snapshots"][index]]
+        on_checkpoint(datetime(rows[pos].transaction_date.year, 1, 1), snapshot)
+
+    return result, updates
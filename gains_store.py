@@ -0,0 +1,518 @@
+"""
+Gains calculations against the database: replaying the ledger from the last
+checkpoint, storing lots, disposals and summaries, and the Form 8949 export.
+
+Needs an app context for the database but not the web app, so the command
+line can run it without importing Flask's routes, forms or the job runner.
+"""
+import io
+import csv
+import json
+import os
+import time
+import uuid
+import socket
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, bindparam, func, case, or_
+
+from config import GAINS_ENGINE, COST_BASIS_METHOD
+from models import db, Transaction, Lot, Holding, LotCheckpoint, LotDisposal, LotSelection, GainsSummary, \
+    GainsRun, get_gains_run
+from fx import get_rate_table
+from gains import LEDGER_COLUMNS, LotEngine, compute_gains, normalize_method
+from metrics import stage_timer, StageAccumulator, GAINS_REPLAYED
+from storage import bulk_insert, bulk_update
+
+logger = logging.getLogger(__name__)
+
+# How often (in transactions) the gains replay reports its progress
+GAINS_PROGRESS_INTERVAL = 10000
+
+# Transactions fetched per round trip while streaming the ledger
+STREAM_BATCH_SIZE = 10000
+
+# Lots, disposals or transaction updates written per bulk statement
+WRITE_BATCH_SIZE = 10000
+
+# Seconds a gains run holds its method's lease; after that another process may take it over
+GAINS_LEASE_SECONDS = 3600
+
+# Seconds between renewals of the lease while a run replays
+GAINS_LEASE_RENEW_SECONDS = GAINS_LEASE_SECONDS // 4
+
+# USD difference per tax year tolerated between the summary and the transactions' gain columns (rounding)
+SUMMARY_CHECK_TOLERANCE = 0.01
+
+
+class RecomputeInProgress(Exception):
+    """
+    Raised when another process holds the lease on a method's gains.
+    """
+
+
+def acquire_lease(method, owner):
+    """
+    Take the lease on a method's gains, in a short transaction of its own.
+    :return: True if the lease was free (or expired) and is now held by `owner`.
+    """
+    get_gains_run(method)
+    db.session.commit()
+    now = datetime.now()
+    result = db.session.execute(
+        update(GainsRun)
+        .where(GainsRun.method == method, or_(GainsRun.lease_owner.is_(None), GainsRun.lease_expires_at < now))
+        .values(lease_owner=owner, lease_expires_at=now + timedelta(seconds=GAINS_LEASE_SECONDS))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def renew_lease(method, owner):
+    """
+    Push back the expiry of a lease held by `owner`, on a connection of its
+    own so that other processes see it before the run commits.
+    :raises RecomputeInProgress: If the lease was taken over.
+    """
+    gains_runs = GainsRun.__table__
+    with db.engine.begin() as connection:
+        renewed = connection.execute(
+            update(gains_runs).where(gains_runs.c.method == method, gains_runs.c.lease_owner == owner)
+            .values(lease_expires_at=datetime.now() + timedelta(seconds=GAINS_LEASE_SECONDS))
+        ).rowcount
+    if renewed != 1:
+        raise RecomputeInProgress(f"The lease on the {method} gains expired and was taken over")
+
+
+class LeaseKeeper:
+    """
+    Renews a run's lease every GAINS_LEASE_RENEW_SECONDS when called, so runs
+    longer than GAINS_LEASE_SECONDS are not taken over.
+
+    On SQLite there is nothing to renew: from its first write, the run holds
+    the database's only write lock until it commits, so other runners cannot
+    take the lease over (and the renewal itself would wait for the lock).
+    """
+
+    def __init__(self, method, owner):
+        self.method = method
+        self.owner = owner
+        self.enabled = db.engine.dialect.name != "sqlite"
+        self.renewed_at = time.monotonic()
+
+    def __call__(self):
+        if self.enabled and time.monotonic() - self.renewed_at >= GAINS_LEASE_RENEW_SECONDS:
+            renew_lease(self.method, self.owner)
+            self.renewed_at = time.monotonic()
+
+
+def release_lease(method, owner):
+    db.session.execute(
+        update(GainsRun).where(GainsRun.method == method, GainsRun.lease_owner == owner)
+        .values(lease_owner=None, lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+class GainsWriter:
+    """
+    Buffers the lots, disposals and transaction updates a replay produces and
+    writes them in bounded batches, so memory does not grow with the ledger.
+    """
+
+    def __init__(self, method, write_transactions, batch_size=WRITE_BATCH_SIZE, on_flush=None):
+        """
+        :param write_transactions: Whether the gain columns of the transactions are updated.
+        :param on_flush: Optional callable run after each batch is written.
+        """
+        self.method = method
+        self.write_transactions = write_transactions
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.restored_ids = set()  # Lots restored from a checkpoint, updated rather than inserted
+        self.lots = []
+        self.disposals = []
+        self.updates = []
+        self.incomplete = []  # (transaction id, is gas) of the disposals that exceeded the available lots
+        self.replayed = 0
+
+    def add_lot(self, lot):
+        if lot.transaction_id in self.restored_ids:
+            return
+        self.lots.append(dict(lot.to_mapping(), method=self.method))
+        if len(self.lots) >= self.batch_size:
+            self.flush()
+
+    def add_disposal(self, disposal):
+        self.disposals.append(dict(disposal._asdict(), method=self.method))
+        if len(self.disposals) >= self.batch_size:
+            self.flush()
+
+    def add_update(self, update):
+        self.replayed += 1
+        if update["error"] is not None:
+            # The engine leaves the gains of an incomplete disposal unset
+            if update["gains_usd_short"] is None:
+                self.incomplete.append({"tx_id": update["id"], "part_is_gas": False})
+            if update["gains_gas_usd_short"] is None:
+                self.incomplete.append({"tx_id": update["id"], "part_is_gas": True})
+        if self.write_transactions:
+            self.updates.append(update)
+            if len(self.updates) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        with stage_timer("write"):
+            if self.lots:
+                bulk_insert(db.session, Lot, self.lots)
+            if self.disposals:
+                bulk_insert(db.session, LotDisposal, self.disposals)
+            if self.updates:
+                bulk_update(db.session, Transaction, self.updates)
+        self.lots, self.disposals, self.updates = [], [], []
+        if self.on_flush is not None:
+            self.on_flush()
+
+
+def calculate_gains(gains_engine=None, progress=None, method=None):
+    """
+    Calculate gains for all transactions and manage the Lot and disposal tables.
+
+    Only the part of the ledger after the earliest change since the last run
+    is replayed, starting from the closest lot checkpoint at or before it.
+    Each cost basis method keeps its own lots, disposals, checkpoints and
+    summaries; only the default method writes the gain columns of the transactions.
+    The reference engine streams the ledger and writes its results in
+    batches as it goes, holding only the open lots; the columnar and
+    parallel engines load the whole ledger first.
+
+    All results are written in one database transaction, so pages keep
+    showing the previous results until the commit publishes the new ones.
+    A lease on the method's GainsRun row, renewed as the run goes, keeps
+    other processes from recalculating the same method at the same time.
+    On SQLite that transaction holds the only write lock: other writes (edits,
+    imports) wait up to SQLITE_BUSY_TIMEOUT seconds, then fail with
+    "database is locked".
+    :param gains_engine: "reference", "columnar" or "parallel" (defaults to GAINS_ENGINE).
+    :param progress: Optional callable receiving (transactions replayed, transactions to replay).
+    :param method: Cost basis method or plan (defaults to COST_BASIS_METHOD).
+    :return: Number of transactions replayed.
+    :raises RecomputeInProgress: If another process is recalculating the method.
+    """
+    gains_engine = gains_engine or GAINS_ENGINE
+    if gains_engine == "columnar":
+        from gains_columnar import compute_gains_columnar as run_lot_matching
+    elif gains_engine == "parallel":
+        from gains_parallel import compute_gains_parallel as run_lot_matching
+    elif gains_engine == "reference":
+        run_lot_matching = compute_gains
+    else:
+        raise ValueError(f"Unknown gains engine: {gains_engine}")
+    method = normalize_method(method or COST_BASIS_METHOD)
+
+    run = GainsRun.query.filter_by(method=method).first()
+    if run is not None and run.computed_at is not None and run.dirty_from is None:
+        logger.info("Gains are up to date", extra={"method": method})
+        return 0
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if not acquire_lease(method, owner):
+        raise RecomputeInProgress(f"{method} gains are already being calculated by {get_gains_run(method).lease_owner}")
+    try:
+        return _replay(method, owner, run_lot_matching, gains_engine == "reference", progress)
+    except Exception:
+        db.session.rollback()
+        release_lease(method, owner)
+        raise
+
+def _replay(method, owner, run_lot_matching, streaming, progress):
+    """
+    Body of calculate_gains(), run while holding the method's lease.
+    """
+    # Loading the rate table and every USD->EUR conversion made by the lot
+    # matching, which also count towards the allocation stage
+    fx = StageAccumulator("fx")
+    rate_table = fx.timed(get_rate_table)()
+    conversion_rate = fx.timed(rate_table.usd_to_eur)
+
+    def save_checkpoint(as_of, snapshot):
+        db.session.add(LotCheckpoint(method=method, as_of=as_of, lots=json.dumps(snapshot)))
+
+    # Step 1: Find where the replay has to start. Changes counted after this
+    # point may not be part of the replay, so they keep the run dirty
+    run = get_gains_run(method)
+    dirty_count = run.dirty_count
+
+    checkpoint = None
+    if run.computed_at is not None:
+        if run.dirty_from is None:
+            # Another process finished while this one waited for the lease
+            release_lease(method, owner)
+            return 0
+        checkpoint = LotCheckpoint.query.filter(LotCheckpoint.method == method, LotCheckpoint.as_of <= run.dirty_from) \
+            .order_by(LotCheckpoint.as_of.desc()).first()
+    replay_from = checkpoint.as_of if checkpoint is not None else None
+
+    # Lots chosen for the disposals being replayed, for specific identification
+    selections = defaultdict(list)
+    if "SPECIFIC" in method:
+        query = db.session.query(LotSelection.transaction_id, LotSelection.lot_transaction_id, LotSelection.amount) \
+            .join(Transaction, Transaction.id == LotSelection.transaction_id)
+        if replay_from is not None:
+            query = query.filter(Transaction.transaction_date >= replay_from)
+        for transaction_id, lot_transaction_id, amount in query.order_by(LotSelection.id):
+            selections[transaction_id].append((lot_transaction_id, amount))
+
+    # Step 2: Run the lot matching from the checkpoint (or the beginning)
+    keep_lease = LeaseKeeper(method, owner)
+    writer = GainsWriter(method, write_transactions=method == normalize_method(COST_BASIS_METHOD),
+                         on_flush=keep_lease)
+    on_lot_closed = writer.add_lot if streaming else None
+    columns = [getattr(Transaction, name) for name in LEDGER_COLUMNS]
+    query = db.session.query(*columns)
+    logger.info("Replaying gains", extra={"method": method, "from": replay_from or "start"})
+    with stage_timer("lot_rebuild"):
+        if replay_from is not None:
+            engine = LotEngine.restore(json.loads(checkpoint.lots), method, selections, on_lot_closed)
+            query = query.filter(Transaction.transaction_date >= replay_from)
+            LotCheckpoint.query.filter(LotCheckpoint.method == method, LotCheckpoint.as_of > replay_from).delete()
+            Lot.query.filter(Lot.method == method, Lot.transaction_date >= replay_from).delete()
+            LotDisposal.query.filter(LotDisposal.method == method, LotDisposal.date_sold >= replay_from).delete()
+        else:
+            engine = LotEngine(method, selections, on_lot_closed)
+            LotCheckpoint.query.filter_by(method=method).delete()
+            Lot.query.filter_by(method=method).delete()
+            LotDisposal.query.filter_by(method=method).delete()
+    writer.restored_ids = {lot.transaction_id for lot in engine.restored}
+    query = query.order_by(Transaction.transaction_date, Transaction.id)
+
+    if streaming:
+        # Plain row tuples, fetched in batches through a server-side cursor where supported
+        ledger = query.yield_per(STREAM_BATCH_SIZE)
+        total = query.count() if progress is not None else None
+    else:
+        with stage_timer("load"):
+            ledger = query.all()
+        total = len(ledger)
+    def report(rows):
+        for done, row in enumerate(rows):
+            if done % GAINS_PROGRESS_INTERVAL == 0:
+                keep_lease()
+                if progress is not None:
+                    progress(done, total)
+            yield row
+    ledger = report(ledger)
+    with stage_timer("allocation"):
+        if streaming:
+            engine, _ = compute_gains(ledger, conversion_rate, on_disposal=writer.add_disposal, engine=engine,
+                                      on_checkpoint=save_checkpoint, on_update=writer.add_update)
+        else:
+            engine, updates = run_lot_matching(ledger, conversion_rate, on_disposal=writer.add_disposal,
+                                               engine=engine, on_checkpoint=save_checkpoint)
+            for row in updates:
+                writer.add_update(row)
+
+    # Step 3: Write the remaining lots and the holdings. Used up lots were
+    # already written as they closed when streaming; open ones are still in the pools
+    for lot in engine.open_lots() if streaming else engine.lots:
+        writer.add_lot(lot)
+    writer.flush()
+    with stage_timer("write"):
+        disposals = LotDisposal.__table__
+        if writer.incomplete:
+            db.session.execute(
+                update(disposals).where(disposals.c.method == method, disposals.c.transaction_id == bindparam("tx_id"),
+                                        disposals.c.is_gas == bindparam("part_is_gas"))
+                .values(incomplete=True),
+                writer.incomplete
+            )
+        lots = Lot.__table__
+        if engine.restored:
+            db.session.execute(
+                update(lots).where(lots.c.method == method, lots.c.transaction_id == bindparam("lot_tx_id"))
+                .values(remaining_amount=bindparam("lot_remaining")),
+                [{"lot_tx_id": lot.transaction_id, "lot_remaining": lot.remaining_amount} for lot in engine.restored]
+            )
+        # The engine's pools hold every open lot, including the ones restored from the checkpoint
+        Holding.query.filter_by(method=method).delete()
+        bulk_insert(db.session, Holding, [dict(row, method=method) for row in engine.holdings()])
+    fx.observe()
+    keep_lease()
+    with stage_timer("summary"):
+        update_gains_summary(method, replay_from.year if replay_from is not None else None)
+
+    # Step 4: Publish everything at once, unless the lease was taken over meanwhile
+    published = db.session.execute(
+        update(GainsRun).where(GainsRun.method == method, GainsRun.lease_owner == owner).values(
+            dirty_from=case((GainsRun.dirty_count == dirty_count, None), else_=GainsRun.dirty_from),
+            computed_at=datetime.now(), lease_owner=None, lease_expires_at=None,
+        ).execution_options(synchronize_session=False)
+    )
+    if published.rowcount != 1:
+        raise RecomputeInProgress(f"The lease on the {method} gains expired and was taken over; results discarded")
+    with stage_timer("commit"):
+        db.session.commit()
+    if progress is not None:
+        progress(writer.replayed, writer.replayed)
+    GAINS_REPLAYED.inc(writer.replayed, method=method)
+    logger.info("Gains calculation completed", extra={"method": method, "replayed": writer.replayed})
+    return writer.replayed
+
+def build_csv_line(asset, quantity, date_acquired, date_sold, proceeds, cost_basis, is_short):
+    """
+    Return a tuple: (Security Description, Quantity, Date Acquired, Date Sold, Proceeds, Cost Basis, Term)
+    """
+    security_desc = f"CRYPTO {asset}"
+    quantity_str = f"{quantity:.8f}"
+    date_acq_str = date_acquired.strftime("%Y-%m-%d")
+    date_sold_str = date_sold.strftime("%Y-%m-%d")
+    proceeds_str = f"{proceeds:.8f}"
+    cost_basis_str = f"{cost_basis:.8f}"
+    term_flag = "C" if is_short else "F"  # e.g. "C" for short, "F" for long
+
+    return (security_desc, quantity_str, date_acq_str, date_sold_str, proceeds_str, cost_basis_str, term_flag)
+
+
+def iter_disposals_csv(tax_year, method=None):
+    """
+    Yield the Form 8949 CSV for a tax year line by line from the disposals table.
+    :param method: Cost basis method whose disposals are exported (defaults to COST_BASIS_METHOD).
+    """
+    method = normalize_method(method or COST_BASIS_METHOD)
+    output = io.StringIO()
+    writer = csv.writer(output)
+
+    def flush():
+        line = output.getvalue()
+        output.seek(0)
+        output.truncate(0)
+        return line
+
+    writer.writerow(["Security Description", "Quantity", "Date Acquired", "Date Sold", "Proceeds", "Cost Basis", "Term"])
+    yield flush()
+
+    query = db.session.query(
+        LotDisposal.asset, LotDisposal.quantity, LotDisposal.date_acquired, LotDisposal.date_sold,
+        LotDisposal.proceeds, LotDisposal.cost_basis, LotDisposal.is_short
+    ).filter(LotDisposal.method == method, LotDisposal.tax_year == tax_year) \
+        .order_by(LotDisposal.date_sold, LotDisposal.id)
+    for row in query.yield_per(1000):
+        writer.writerow(build_csv_line(*row))
+        yield flush()
+
+
+# Transaction types whose received amount is income, by GainsSummary column prefix
+INCOME_TYPES = {"STAKE": "staking_rewards", "CLAIM": "airdrops", "AIRDROP": "airdrops"}
+
+def update_gains_summary(method, from_year=None):
+    """
+    Rebuild the GainsSummary rows of a cost basis method for every tax year from
+    `from_year` on (all years if None), with one GROUP BY per kind of amount.
+    Gains come from the method's disposals, income and gas paid from the ledger.
+    Disposals that exceeded the available lots are left out, as they are from
+    the transactions' gain columns.
+    """
+    rate_table = get_rate_table()
+    amounts = [column.name for column in GainsSummary.__table__.columns
+               if column.name not in ("id", "method", "tax_year", "asset")]
+    totals = defaultdict(lambda: dict.fromkeys(amounts, 0.0))
+
+    def grouped(asset_column, *columns):
+        query = db.session.query(Transaction.tax_year, asset_column, *columns) \
+            .filter(Transaction.tax_year.isnot(None), asset_column.isnot(None))
+        if from_year is not None:
+            query = query.filter(Transaction.tax_year >= from_year)
+        return query
+
+    def total(column):
+        return func.coalesce(func.sum(column), 0.0)
+
+    def to_datetime(day_value):
+        # func.date() returns a string on SQLite and a date on PostgreSQL
+        return datetime.fromisoformat(day_value) if isinstance(day_value, str) else day_value
+
+    # Gains on the assets sold and spent as gas, grouped by day to convert them to EUR
+    day = func.date(LotDisposal.date_sold)
+    query = db.session.query(
+        LotDisposal.tax_year, LotDisposal.asset, LotDisposal.is_gas, LotDisposal.is_short, day,
+        total(LotDisposal.proceeds - LotDisposal.cost_basis),
+    ).filter(LotDisposal.method == method, LotDisposal.tax_year.isnot(None), LotDisposal.incomplete.is_(False))
+    if from_year is not None:
+        query = query.filter(LotDisposal.tax_year >= from_year)
+    query = query.group_by(LotDisposal.tax_year, LotDisposal.asset, LotDisposal.is_gas, LotDisposal.is_short, day)
+    for tax_year, asset, is_gas, is_short, day_value, gains_usd in query:
+        name = ("gas_" if is_gas else "") + ("short_term" if is_short else "long_term")
+        row = totals[(tax_year, asset)]
+        row[name + "_usd"] += gains_usd
+        row[name + "_eur"] += rate_table.usd_to_eur(to_datetime(day_value), gains_usd)
+
+    # Gas paid
+    query = grouped(
+        Transaction.gas_asset, total(Transaction.gas_fees), total(Transaction.gas_fees * Transaction.gas_asset_price_usd),
+    ).filter(Transaction.gas_fees > 0).group_by(Transaction.tax_year, Transaction.gas_asset)
+    for tax_year, asset, gas_fees, gas_fees_usd in query:
+        totals[(tax_year, asset)].update(gas_fees=gas_fees, gas_fees_usd=gas_fees_usd)
+
+    # Income at its value when received, grouped by day to convert it to EUR
+    day = func.date(Transaction.transaction_date)
+    query = grouped(
+        Transaction.to_asset, Transaction.transaction_type, day,
+        total(Transaction.to_amount * Transaction.to_asset_cost_basis),
+    ).filter(Transaction.transaction_type.in_(INCOME_TYPES)) \
+        .group_by(Transaction.tax_year, Transaction.to_asset, Transaction.transaction_type, day)
+    for tax_year, asset, transaction_type, day_value, income_usd in query:
+        row = totals[(tax_year, asset)]
+        prefix = INCOME_TYPES[transaction_type]
+        row[prefix + "_usd"] += income_usd
+        row[prefix + "_eur"] += rate_table.usd_to_eur(to_datetime(day_value), income_usd)
+
+    summaries = []
+    for (tax_year, asset), row in totals.items():
+        for currency in ("usd", "eur"):
+            row[f"net_gain_{currency}"] = sum(
+                row[name] for name in (
+                    f"short_term_{currency}", f"long_term_{currency}",
+                    f"gas_short_term_{currency}", f"gas_long_term_{currency}",
+                    f"staking_rewards_{currency}", f"airdrops_{currency}",
+                )
+            )
+        summaries.append(dict(row, method=method, tax_year=tax_year, asset=asset))
+
+    query = GainsSummary.query.filter_by(method=method)
+    if from_year is not None:
+        query = query.filter(GainsSummary.tax_year >= from_year)
+    query.delete()
+    bulk_insert(db.session, GainsSummary, summaries)
+    if method == normalize_method(COST_BASIS_METHOD):
+        check_gains_summary(totals, from_year)
+
+
+def check_gains_summary(totals, from_year=None):
+    """
+    Log a warning for every tax year whose summed gains differ from the gain
+    columns of its transactions, which only the default method writes.
+    :param totals: Dict of (tax year, asset) -> summary amounts, as built by update_gains_summary().
+    """
+    names = ("short_term_usd", "long_term_usd", "gas_short_term_usd", "gas_long_term_usd")
+    summary_gains = defaultdict(float)
+    for (tax_year, _), row in totals.items():
+        summary_gains[tax_year] += sum(row[name] for name in names)
+
+    columns = (Transaction.gains_usd_short, Transaction.gains_usd_long,
+               Transaction.gains_gas_usd_short, Transaction.gains_gas_usd_long)
+    query = db.session.query(Transaction.tax_year, *(func.coalesce(func.sum(column), 0.0) for column in columns)) \
+        .filter(Transaction.tax_year.isnot(None))
+    if from_year is not None:
+        query = query.filter(Transaction.tax_year >= from_year)
+    transaction_gains = {tax_year: sum(gains) for tax_year, *gains in query.group_by(Transaction.tax_year)}
+
+    for tax_year in sorted(set(summary_gains) | set(transaction_gains)):
+        difference = summary_gains.get(tax_year, 0.0) - transaction_gains.get(tax_year, 0.0)
+        if abs(difference) > SUMMARY_CHECK_TOLERANCE:
+            logger.warning("Gains summary disagrees with the transactions", extra={
+                "tax_year": tax_year, "summary_usd": summary_gains.get(tax_year, 0.0),
+                "transactions_usd": transaction_gains.get(tax_year, 0.0),
+            })
@@ -0,0 +1,231 @@
+"""
+Background jobs: gains runs, imports and syncs are queued from the request
+and run in a worker thread, with their state kept in the jobs table.
+"""
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from models import db, Job
+from metrics import query_counter
+from storage import SQLITE_BUSY_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Jobs all write to the same database, so they run one at a time (per process)
+JOB_WORKERS = 1
+
+# Seconds between writes of a running job's progress to its row, where the other web workers read it
+PROGRESS_SAVE_SECONDS = 2
+
+
+def worker_id():
+    """
+    Identify this process, also after a fork of the web server's workers.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def worker_gone(worker):
+    """
+    Whether the process that claimed a job has died. Processes on other hosts
+    cannot be checked and are assumed alive; a pid matching this process comes
+    from before a restart, since a process resumes jobs before it runs any.
+    """
+    if worker is None:
+        return True
+    host, _, pid = worker.rpartition(":")
+    if host != socket.gethostname():
+        return False
+    if int(pid) == os.getpid():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class JobRunner:
+    """
+    Queue of background jobs for one Flask app.
+
+    The jobs table is the source of truth for a job's status, progress and
+    result. The live progress of a running job is kept in memory and saved to
+    the table every PROGRESS_SAVE_SECONDS. With several web workers, each has
+    its own runner and a queued job is run by whichever claims it first.
+    Requests are coalesced through the unique jobs.pending_key, set while a
+    job can still answer new requests for its kind and key.
+    """
+
+    def __init__(self, app, workers=JOB_WORKERS):
+        self.app = app
+        self.handlers = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.lock = threading.Lock()
+        self.progress = {}  # Job id -> (rows done, rows total) while it runs
+        self.progress_saved = {}  # Job id -> time.monotonic() of the last progress write
+        self.resumed = False
+
+    def handler(self, kind, coalesce_running=True):
+        """
+        Decorator registering the function that runs the jobs of a kind.
+
+        The function is called with the job's params as keyword arguments plus
+        `progress`, a callable taking (rows done, rows total), and returns
+        (JSON-serializable result, path of a file to download or None).
+        :param coalesce_running: Whether a request for a job that is already running
+                                 is answered by that job. Use False when a new request
+                                 may need data the running job has already read.
+        """
+        def register(func):
+            self.handlers[kind] = (func, coalesce_running)
+            return func
+        return register
+
+    def enqueue(self, kind, key="", **params):
+        """
+        Queue a job, unless one of the same kind and key is already pending.
+        :return: (Job, True if a new job was queued)
+        """
+        self.resume()
+        pending_key = f"{kind}:{key}"
+        while True:
+            job = Job.query.filter_by(pending_key=pending_key).first()
+            if job is not None:
+                return job, False
+            job = Job(kind=kind, key=key, params=json.dumps(params), pending_key=pending_key)
+            db.session.add(job)
+            try:
+                db.session.commit()
+                break
+            except IntegrityError:
+                # Another worker queued the same job meanwhile
+                db.session.rollback()
+        self.executor.submit(self._run, job.id)
+        return job, True
+
+    def resume(self):
+        """
+        Pick up the jobs a previous process left behind (once per process):
+        queued jobs are run, jobs whose process died while running them are
+        marked as failed. Jobs running in the other web workers are left alone.
+        """
+        with self.lock:
+            if self.resumed:
+                return
+            self.resumed = True
+            for job in Job.query.filter_by(status="running"):
+                if worker_gone(job.worker):
+                    job.status = "failed"
+                    job.pending_key = None
+                    job.error = "Interrupted by a restart."
+                    job.finished_at = datetime.now()
+            queued = [job_id for job_id, in db.session.query(Job.id).filter_by(status="queued").order_by(Job.id)]
+            db.session.commit()
+        for job_id in queued:
+            self.executor.submit(self._run, job_id)
+
+    def _save_progress(self, job_id, done, total):
+        """
+        Write a running job's progress to its row, on a connection of its own
+        so the job's transaction is not committed with it. Best effort: on
+        SQLite a job holding the write lock (a gains run) would block the
+        write, so it is skipped instead of waiting.
+        """
+        jobs = Job.__table__
+        try:
+            with db.engine.begin() as connection:
+                sqlite = connection.dialect.name == "sqlite"
+                if sqlite:
+                    connection.exec_driver_sql("PRAGMA busy_timeout=0")
+                try:
+                    connection.execute(
+                        update(jobs).where(jobs.c.id == job_id).values(rows_done=done, rows_total=total)
+                    )
+                finally:
+                    if sqlite:
+                        connection.exec_driver_sql(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}")
+        except OperationalError as e:
+            logger.debug("Job progress not saved", extra={"job_id": job_id, "error": str(e)})
+        self.progress_saved[job_id] = time.monotonic()
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            job = db.session.get(Job, job_id)
+            func, coalesce_running = self.handlers[job.kind]
+            # Claim the job, unless another web worker already has. Requests
+            # arriving from now on get a new job unless it coalesces running ones
+            claimed = db.session.execute(
+                update(Job).where(Job.id == job_id, Job.status == "queued")
+                .values(status="running", worker=worker_id(), started_at=datetime.now(),
+                        pending_key=Job.pending_key if coalesce_running else None)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                return
+            job = db.session.get(Job, job_id)
+            query_counter.start(f"job:{job.kind}")
+            params = json.loads(job.params)
+            self.progress[job_id] = (0, None)
+            self.progress_saved[job_id] = time.monotonic()
+
+            def progress(done, total=None):
+                self.progress[job_id] = (done, total)
+                if time.monotonic() - self.progress_saved[job_id] >= PROGRESS_SAVE_SECONDS:
+                    self._save_progress(job_id, done, total)
+
+            try:
+                result, result_path = func(progress=progress, **params)
+            except Exception as e:
+                logger.exception("Job failed", extra={"job_id": job_id, "kind": job.kind})
+                db.session.rollback()
+                job = db.session.get(Job, job_id)
+                job.status = "failed"
+                job.error = str(e)
+            else:
+                job = db.session.get(Job, job_id)
+                job.status = "done"
+                job.result = json.dumps(result, default=str)
+                job.result_path = result_path
+            job.rows_done, job.rows_total = self.progress.pop(job_id)
+            self.progress_saved.pop(job_id, None)
+            job.pending_key = None
+            job.finished_at = datetime.now()
+            db.session.commit()
+
+    def status(self, job):
+        """
+        JSON-serializable state of a job, including the live progress and an ETA while it runs.
+        """
+        rows_done, rows_total = self.progress.get(job.id, (job.rows_done, job.rows_total))
+        eta_seconds = None
+        if job.status == "running" and rows_done and rows_total:
+            elapsed = (datetime.now() - job.started_at).total_seconds()
+            eta_seconds = elapsed * (rows_total - rows_done) / rows_done
+        result = json.loads(job.result) if job.result else None
+        return {
+            "id": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "rows_done": rows_done,
+            "rows_total": rows_total,
+            "eta_seconds": eta_seconds,
+            "error": job.error,
+            "result": result,
+            "has_file": job.result_path is not None,
+            "created_at": job.created_at.isoformat(),
+            "started_at": job.started_at.isoformat() if job.started_at else None,
+            "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        }
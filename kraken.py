@@ -0,0 +1,212 @@
+import csv
+import io
+import logging
+import time
+from datetime import datetime
+from itertools import islice
+
+from models import db, Transaction, mark_dirty, existing_external_ids
+from fx import get_rate_table
+from storage import bulk_insert
+
+logger = logging.getLogger(__name__)
+
+# Rows parsed, converted and committed together
+IMPORT_BATCH_SIZE = 5000
+
+FIAT = ("USD", "EUR")
+
+# Transaction.source of imported rows
+KRAKEN_SOURCE = "KRAKEN"
+
+
+def parse_kraken_time(value):
+    """
+    Parse Kraken's "%Y-%m-%d %H:%M:%S.%f" timestamps.
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+
+
+def kraken_external_id(row):
+    """
+    Deduplication key of a trade row: its txid, unique per fill. Without one,
+    the order's ordertxid plus the fill's time and volume, since one order can
+    be filled several times.
+    :return: Key, or None if the row has neither ID.
+    """
+    if row.get("txid"):
+        return row["txid"]
+    if row.get("ordertxid"):
+        return f"{row['ordertxid']}:{row['time']}:{row['vol']}"
+    return None
+
+
+def _parse_row(row, skipped):
+    """
+    Split a Kraken trade row into the fields that do not depend on FX rates.
+    :return: Partial mapping, or None if the row is skipped.
+    """
+    # Split the pair into FROM and TO assets
+    pair = row["pair"]
+    try:
+        asset1, asset2 = pair.split("/")  # e.g., "XRP/EUR" -> ("XRP", "EUR")
+    except ValueError:
+        skipped["invalid pair"] += 1
+        return None
+
+    if asset1 in FIAT and asset2 in FIAT:
+        skipped["fiat pair"] += 1
+        return None
+
+    transaction_type = row["type"].lower()
+    if transaction_type == "buy":
+        from_asset, to_asset = asset2, asset1  # Buying asset1 with asset2
+        from_amount = float(row["cost"])
+        to_amount = float(row["vol"])
+        fee_asset = from_asset
+    elif transaction_type == "sell":
+        from_asset, to_asset = asset1, asset2  # Selling asset1 for asset2
+        from_amount = float(row["vol"])
+        to_amount = float(row["cost"])
+        fee_asset = to_asset
+    else:
+        skipped["unsupported type"] += 1
+        return None
+
+    transaction_date = parse_kraken_time(row["time"])
+    return {
+        "source": KRAKEN_SOURCE,
+        "external_id": kraken_external_id(row),
+        "chain": "EXCH",
+        "from_asset": from_asset,
+        "to_asset": to_asset,
+        "from_amount": from_amount,
+        "to_amount": to_amount,
+        "transaction_type": transaction_type.upper(),
+        "transaction_date": transaction_date,
+        "tax_year": transaction_date.year,
+        "gas_fees": float(row["fee"]),
+        "gas_asset": fee_asset,  # Kraken charges fees in the quote currency
+        "gas_asset_price_usd": 0.0,
+        "price": float(row["price"]),
+    }
+
+
+def _apply_prices(mappings, rate_table):
+    """
+    Fill in the USD/EUR price columns for a batch, with one rate lookup per row.
+    Only fiat-quoted pairs are priced; others are left at 0.
+    """
+    eur_usd_rates = rate_table.eur_to_usd_many([m["transaction_date"] for m in mappings])
+    for mapping, eur_usd in zip(mappings, eur_usd_rates):
+        price = mapping.pop("price")
+        if mapping["transaction_type"] == "BUY":
+            fiat = mapping["from_asset"]
+            if fiat == "EUR":
+                mapping["from_asset_price_usd"] = eur_usd
+                mapping["from_asset_price_eur"] = 1.0
+                mapping["to_asset_cost_basis"] = price * eur_usd
+            elif fiat == "USD":
+                mapping["from_asset_price_usd"] = 1.0
+                mapping["from_asset_price_eur"] = 1.0 / eur_usd
+                mapping["to_asset_cost_basis"] = price
+            else:
+                mapping["from_asset_price_usd"] = 0.0
+                mapping["from_asset_price_eur"] = 0.0
+                mapping["to_asset_cost_basis"] = 0.0
+        else:
+            fiat = mapping["to_asset"]
+            if fiat == "EUR":
+                mapping["from_asset_price_usd"] = price * eur_usd
+                mapping["from_asset_price_eur"] = price
+                mapping["to_asset_cost_basis"] = eur_usd
+            elif fiat == "USD":
+                mapping["from_asset_price_usd"] = price
+                mapping["from_asset_price_eur"] = price / eur_usd
+                mapping["to_asset_cost_basis"] = 1.0
+            else:
+                mapping["from_asset_price_usd"] = 0.0
+                mapping["from_asset_price_eur"] = 0.0
+                mapping["to_asset_cost_basis"] = 0.0
+
+
+def import_kraken_stream(stream, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """
+    Import transactions from a Kraken trades CSV, reading it as a stream.
+    :param stream: Binary or text file-like object (e.g. an upload's stream).
+    :param batch_size: Number of rows converted and committed at a time.
+    :param progress: Optional callable receiving the number of CSV rows read after each batch.
+    :return: Dict with the imported, duplicate and skipped row counts and the throughput.
+
+    Rows whose Kraken txid is already stored (or repeated in the file) are
+    skipped, so re-importing an overlapping export only adds the new trades.
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    reader = csv.DictReader(stream)
+    rate_table = get_rate_table()
+
+    started = time.perf_counter()
+    imported = 0
+    duplicates = 0
+    rows_read = 0
+    seen = set()
+    skipped = {"invalid pair": 0, "fiat pair": 0, "unsupported type": 0}
+    while True:
+        rows = list(islice(reader, batch_size))
+        if not rows:
+            break
+        rows_read += len(rows)
+        mappings = [m for m in (_parse_row(row, skipped) for row in rows) if m is not None]
+
+        # Drop trades that are already stored or were seen earlier in the file
+        batch_ids = {m["external_id"] for m in mappings if m["external_id"]}
+        known = seen | existing_external_ids(KRAKEN_SOURCE, batch_ids - seen)
+        new_mappings = []
+        for mapping in mappings:
+            external_id = mapping["external_id"]
+            if external_id in known:
+                duplicates += 1
+                continue
+            if external_id:
+                known.add(external_id)
+            new_mappings.append(mapping)
+        seen |= batch_ids
+        mappings = new_mappings
+        if mappings:
+            _apply_prices(mappings, rate_table)
+
+            # Bulk inserts bypass the change tracking, so flag the gains explicitly
+            bulk_insert(db.session, Transaction, mappings)
+            mark_dirty(min(m["transaction_date"] for m in mappings))
+            db.session.commit()
+            imported += len(mappings)
+        if progress is not None:
+            progress(rows_read)
+
+    elapsed = time.perf_counter() - started
+    result = {
+        "imported": imported,
+        "duplicates": duplicates,
+        "skipped": sum(skipped.values()),
+        "skipped_by_reason": skipped,
+        "seconds": elapsed,
+        "rows_per_sec": (imported + duplicates + sum(skipped.values())) / elapsed if elapsed > 0 else 0.0,
+    }
+    logger.info("Kraken import finished", extra={
+        "imported": imported, "duplicates": duplicates, "skipped": result["skipped"],
+        "rows_per_sec": round(result["rows_per_sec"]),
+    })
+    return result
+
+
+def import_kraken_csv(file_path):
+    """
+    Import transactions from a Kraken CSV file on disk.
+    :param file_path: Path to the Kraken CSV file.
+    """
+    with open(file_path, mode="r", newline="") as file:
+        return import_kraken_stream(file)
@@ -0,0 +1,270 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# LogRecord attributes that are not structured fields passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, or as text followed by
+    key=value pairs, including the fields passed through `extra`.
+    """
+
+    def __init__(self, json_lines=False):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+        if self.json_lines:
+            entry = {
+                "time": self.formatTime(record),
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+def configure_logging(level="INFO", log_format="text"):
+    """
+    Send the application's logs to stderr at the given level.
+    :param log_format: "text" or "json" (one JSON object per line).
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(json_lines=log_format == "json"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+
+
+class _Metric:
+    """
+    Base of the metric types: values keyed by a tuple of label values.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key, **extra):
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing total.
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._labels(key)} {value}"]
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (e.g. seconds) in cumulative buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def _render_value(self, key, value):
+        bucket_counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), bucket_counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{self._labels(key, le=le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+        lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = []
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests served.", ("method", "endpoint", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Time spent serving HTTP requests.", ("endpoint",))
+DB_QUERIES = Counter("db_queries_total", "SQL statements executed, by the endpoint (or job) running them.",
+                     ("endpoint",))
+GAINS_STAGE_SECONDS = Histogram("gains_stage_duration_seconds", "Time spent in each stage of a gains calculation.",
+                                ("stage",))
+GAINS_REPLAYED = Counter("gains_transactions_replayed_total", "Transactions replayed by gains calculations.",
+                         ("method",))
+OUTBOUND_REQUESTS = Counter("outbound_requests_total", "Requests made to external APIs.", ("service", "status"))
+OUTBOUND_LATENCY = Histogram("outbound_request_duration_seconds", "Latency of requests to external APIs.",
+                             ("service",))
+OUTBOUND_RATE_LIMITED = Counter("outbound_rate_limited_total",
+                                "External API responses refusing a request for the rate limit (HTTP 429).",
+                                ("service",))
+OUTBOUND_RETRIES = Counter("outbound_retries_total", "Failed external API calls that were retried.", ("service",))
+RATE_LIMIT_WAITS = Counter("rate_limit_waits_total", "Times a request waited for a rate limit token.", ("service",))
+RATE_LIMIT_WAIT_SECONDS = Counter("rate_limit_wait_seconds_total", "Time spent waiting for rate limit tokens.",
+                                  ("service",))
+
+
+def render():
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Time a block as one stage of a gains calculation.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        GAINS_STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+class OutboundCall:
+    """
+    What outbound_request() yields: the block sets status_code to the HTTP
+    status of the response it got.
+    """
+
+    def __init__(self):
+        self.status_code = None
+
+    @property
+    def status(self):
+        if self.status_code == 429:
+            return "rate_limited"
+        if self.status_code is None or self.status_code >= 400:
+            return "error"
+        return "ok"
+
+
+class StageAccumulator:
+    """
+    Time of a gains calculation stage spread over many short calls (e.g. one
+    rate lookup per row), added up and observed once.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = 0.0
+
+    def timed(self, func):
+        """
+        Wrap a function so the time spent in it counts towards the stage.
+        """
+        def timed_func(*args):
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.seconds += time.perf_counter() - started
+        return timed_func
+
+    def observe(self):
+        GAINS_STAGE_SECONDS.observe(self.seconds, stage=self.stage)
+
+
+@contextmanager
+def outbound_request(service):
+    """
+    Count and time one call to an external API. The status label is
+    "rate_limited" for an HTTP 429, "error" for another error status or if
+    the block raised, else "ok".
+
+        with outbound_request("coingecko") as call:
+            response = requests.get(url)
+            call.status_code = response.status_code
+    """
+    started = time.perf_counter()
+    call = OutboundCall()
+    status = "error"
+    try:
+        yield call
+        status = call.status
+    finally:
+        OUTBOUND_LATENCY.observe(time.perf_counter() - started, service=service)
+        OUTBOUND_REQUESTS.inc(service=service, status=status)
+        if status == "rate_limited":
+            OUTBOUND_RATE_LIMITED.inc(service=service)
+
+
+class QueryCounter(threading.local):
+    """
+    Per-thread count of the SQL statements executed, so each request (or job
+    thread) counts only its own queries.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.endpoint = "other"
+
+    def start(self, endpoint):
+        self.count = 0
+        self.endpoint = endpoint
+
+    def on_execute(self, *args, **kwargs):
+        self.count += 1
+        DB_QUERIES.inc(endpoint=self.endpoint)
+
+
+query_counter = QueryCounter()
@@ -1,5 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from sqlalchemy import event, inspect, literal, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from gains import LEDGER_COLUMNS
 
 db = SQLAlchemy()
 
@@ -18,8 +23,12 @@ COINGECKO_ASSET_MAPPING = {
 
 class Lot(db.Model):
     __tablename__ = 'lots'
+    __table_args__ = (
+        db.Index('ix_lots_method_asset_name_transaction_date', 'method', 'asset_name', 'transaction_date'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
+    method = db.Column(db.String(40), nullable=False, default="FIFO")  # Cost basis method of the run
     transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'), nullable=False)
     asset_name = db.Column(db.String(20), nullable=False)  # e.g. BTC
     remaining_amount = db.Column(db.Float, nullable=False)  # Unsold amount from this buy
@@ -28,23 +37,43 @@ class Lot(db.Model):
     
     transaction = db.relationship("Transaction", back_populates="lots")
 
+class Holding(db.Model):
+    __tablename__ = 'holdings'
+    __table_args__ = (
+        db.Index('uq_holdings_method_asset_name', 'method', 'asset_name', unique=True),
+    )
+
+    # One row per method and asset with open lots, rebuilt by each gains run
+    id = db.Column(db.Integer, primary_key=True)
+    method = db.Column(db.String(40), nullable=False, default="FIFO")  # Cost basis method of the run
+    asset_name = db.Column(db.String(20), nullable=False)  # e.g. BTC
+    total_amount = db.Column(db.Float, nullable=False)  # Sum of the remaining amounts of the open lots
+    total_cost = db.Column(db.Float, nullable=False)  # Cost basis of the remaining amounts in USD
+    average_cost = db.Column(db.Float, nullable=False)  # Weighted by remaining amount
+    lot_count = db.Column(db.Integer, nullable=False)  # Number of open lots
+    oldest_lot_date = db.Column(db.DateTime, nullable=False)
+
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        db.Index('ix_transactions_transaction_date_id', 'transaction_date', 'id'),  # Keyset pagination
+        db.Index('uq_transactions_source_external_id', 'source', 'external_id', unique=True),  # Re-import dedup
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    chain = db.Column(db.String(10), nullable=False, default="EXCH")  # Default to "EXCH" for exchange transactions
-    from_asset = db.Column(db.String(20), nullable=False)  # FROM asset (e.g., ETH)
+    chain = db.Column(db.String(10), nullable=False, default="EXCH", index=True)  # Default to "EXCH" for exchange transactions
+    from_asset = db.Column(db.String(20), nullable=False, index=True)  # FROM asset (e.g., ETH)
     from_amount = db.Column(db.Float, nullable=False)      # Amount of FROM asset
     from_asset_price_usd = db.Column(db.Float, nullable=False)  # FMV or sell price in USD
     from_asset_price_eur = db.Column(db.Float, nullable=True)   # FMV or sell price in EUR
     
-    to_asset = db.Column(db.String(20), nullable=True)     # TO asset (e.g., BTC)
+    to_asset = db.Column(db.String(20), nullable=True, index=True)     # TO asset (e.g., BTC)
     to_amount = db.Column(db.Float, nullable=True, default=0.0)         # Amount of TO asset
     to_asset_cost_basis = db.Column(db.Float, nullable=True)  # Cost basis of TO asset in USD
     
     transaction_type = db.Column(db.String(10), nullable=False)  # SELL, SWAP, TXFR, etc.
     transaction_date = db.Column(db.DateTime, nullable=False)
-    tax_year = db.Column(db.Integer, nullable=True)  # Tax year for this transaction
+    tax_year = db.Column(db.Integer, nullable=True, index=True)  # Tax year for this transaction
     
     gas_fees = db.Column(db.Float, nullable=True, default=0.0)  # Gas fees in FROM asset
     gas_asset = db.Column(db.String(20), nullable=True, default="")  # Asset used for gas fees
@@ -60,19 +89,350 @@ class Transaction(db.Model):
     gains_gas_eur_long = db.Column(db.Float, nullable=True)  # Computed capital gains for gas in EUR
     
     error = db.Column(db.String(255), nullable=True)  # Errors (e.g., SELL before BUY)
+    balance_error = db.Column(db.String(255), nullable=True)  # Disposal exceeding the running holdings
     note = db.Column(db.Text, nullable=True)  # Optional description for the transaction
 
+    source = db.Column(db.String(20), nullable=True)  # Where the row was imported from (e.g. KRAKEN, ETH, BASE)
+    external_id = db.Column(db.String(128), nullable=True)  # ID in the source (Kraken txid, or tx hash:wallet address)
+
     lots = db.relationship("Lot", back_populates="transaction", cascade="all, delete-orphan")
+    disposals = db.relationship("LotDisposal", back_populates="transaction", cascade="all, delete-orphan")
+    lot_selections = db.relationship("LotSelection", cascade="all, delete-orphan")
+
+class LotDisposal(db.Model):
+    __tablename__ = 'disposals'
+    __table_args__ = (
+        db.Index('ix_disposals_method_tax_year_date_sold_id', 'method', 'tax_year', 'date_sold', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    method = db.Column(db.String(40), nullable=False, default="FIFO")  # Cost basis method of the run
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'), nullable=False)  # SELL/SWAP or gas-paying transaction
+    lot_transaction_id = db.Column(db.Integer, nullable=False)  # BUY transaction the lot came from
+    asset = db.Column(db.String(20), nullable=False)  # Asset disposed of
+    quantity = db.Column(db.Float, nullable=False)  # Amount taken from the lot
+    date_acquired = db.Column(db.DateTime, nullable=False)  # Date of the lot
+    date_sold = db.Column(db.DateTime, nullable=False)  # Date of the disposal
+    proceeds = db.Column(db.Float, nullable=False)  # Proceeds in USD
+    cost_basis = db.Column(db.Float, nullable=False)  # Cost basis in USD
+    is_short = db.Column(db.Boolean, nullable=False)  # Held less than a year
+    is_gas = db.Column(db.Boolean, nullable=False, default=False)  # Disposal paid a gas fee
+    tax_year = db.Column(db.Integer, nullable=True)  # Tax year of the disposing transaction
+    incomplete = db.Column(db.Boolean, nullable=False, default=False)  # Part of a disposal that exceeded the available lots; no gains
+
+    transaction = db.relationship("Transaction", back_populates="disposals")
+
+class PricePoint(db.Model):
+    __tablename__ = 'price_points'
+    __table_args__ = (
+        db.UniqueConstraint('asset', 'timestamp', name='uq_price_points_asset_timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    asset = db.Column(db.String(20), nullable=False)  # Our asset symbol (e.g. ETH)
+    timestamp = db.Column(db.Integer, nullable=False)  # UNIX time in seconds
+    price_usd = db.Column(db.Float, nullable=False)
+
+class PriceChunk(db.Model):
+    __tablename__ = 'price_chunks'
+    __table_args__ = (
+        db.UniqueConstraint('asset', 'chunk_start', name='uq_price_chunks_asset_chunk_start'),
+    )
+
+    # One row per price chunk fetched from CoinGecko (see prices.py)
+    id = db.Column(db.Integer, primary_key=True)
+    asset = db.Column(db.String(20), nullable=False)  # Our asset symbol (e.g. ETH)
+    chunk_start = db.Column(db.Integer, nullable=False)  # UNIX time in seconds, a multiple of CHUNK_SECONDS
+    covered_until = db.Column(db.Integer, nullable=False)  # Prices are complete up to here: the chunk end, or the fetch time if earlier
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
+class SyncState(db.Model):
+    __tablename__ = 'sync_state'
+    __table_args__ = (
+        db.UniqueConstraint('chain', 'address', name='uq_sync_state_chain_address'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    chain = db.Column(db.String(10), nullable=False)  # ETH, BASE
+    address = db.Column(db.String(64), nullable=False)  # Lower-cased wallet address
+    last_block = db.Column(db.Integer, nullable=False, default=0)  # Highest block synced so far
+    synced_at = db.Column(db.DateTime, nullable=True)
 
 class GainsSummary(db.Model):
     __tablename__ = 'gains_summary'
-    
+    __table_args__ = (
+        db.Index('uq_gains_summary_method_tax_year_asset', 'method', 'tax_year', 'asset', unique=True),
+    )
+
+    # One row per method, tax year and asset, rebuilt by each gains run (see update_gains_summary)
+    id = db.Column(db.Integer, primary_key=True)
+    method = db.Column(db.String(40), nullable=False, default="FIFO")  # Cost basis method of the run
+    tax_year = db.Column(db.Integer, nullable=False)  # Tax year
+    asset = db.Column(db.String(20), nullable=False)  # Asset sold, paid as gas or received
+    short_term_usd = db.Column(db.Float, nullable=False, default=0.0)  # SELL/SWAP gains
+    short_term_eur = db.Column(db.Float, nullable=False, default=0.0)
+    long_term_usd = db.Column(db.Float, nullable=False, default=0.0)
+    long_term_eur = db.Column(db.Float, nullable=False, default=0.0)
+    gas_short_term_usd = db.Column(db.Float, nullable=False, default=0.0)  # Gains on the asset spent as gas
+    gas_short_term_eur = db.Column(db.Float, nullable=False, default=0.0)
+    gas_long_term_usd = db.Column(db.Float, nullable=False, default=0.0)
+    gas_long_term_eur = db.Column(db.Float, nullable=False, default=0.0)
+    gas_fees = db.Column(db.Float, nullable=False, default=0.0)  # Amount of the asset paid as gas
+    gas_fees_usd = db.Column(db.Float, nullable=False, default=0.0)
+    staking_rewards_usd = db.Column(db.Float, nullable=False, default=0.0)  # STAKE income
+    staking_rewards_eur = db.Column(db.Float, nullable=False, default=0.0)
+    airdrops_usd = db.Column(db.Float, nullable=False, default=0.0)  # CLAIM/AIRDROP income
+    airdrops_eur = db.Column(db.Float, nullable=False, default=0.0)
+    net_gain_usd = db.Column(db.Float, nullable=False, default=0.0)  # All gains plus income
+    net_gain_eur = db.Column(db.Float, nullable=False, default=0.0)
+
+
+class GainsState(db.Model):
+    __tablename__ = 'gains_state'
+
+    id = db.Column(db.Integer, primary_key=True)  # Single row, id 1
+    errors_stale = db.Column(db.Boolean, nullable=False, default=True)  # balance_error needs a new sweep
+
+class GainsRun(db.Model):
+    __tablename__ = 'gains_runs'
+
+    # One row per cost basis method that has been calculated
     id = db.Column(db.Integer, primary_key=True)
-    tax_year = db.Column(db.Integer, nullable=False, unique=True)  # Tax year
-    total_short_term_gains = db.Column(db.Float, nullable=False, default=0.0)
-    total_long_term_gains = db.Column(db.Float, nullable=False, default=0.0)
-    total_staking_rewards = db.Column(db.Float, nullable=False, default=0.0)
-    total_airdrops = db.Column(db.Float, nullable=False, default=0.0)
-    total_gas_fees = db.Column(db.Float, nullable=False, default=0.0)
-    net_gain_usd = db.Column(db.Float, nullable=False, default=0.0)
+    method = db.Column(db.String(40), nullable=False, unique=True)  # e.g. FIFO, or FIFO,2022:HIFO
+    dirty_from = db.Column(db.DateTime, nullable=True)  # Earliest transaction date changed since the last run
+    dirty_count = db.Column(db.Integer, nullable=False, default=0)  # Bumped by every change, to spot edits made during a run
+    computed_at = db.Column(db.DateTime, nullable=True)  # When gains were last calculated
+    lease_owner = db.Column(db.String(100), nullable=True)  # Process recalculating the gains, if any
+    lease_expires_at = db.Column(db.DateTime, nullable=True)  # After this the lease can be taken over
+
+class LotCheckpoint(db.Model):
+    __tablename__ = 'lot_checkpoints'
+    __table_args__ = (
+        db.Index('uq_lot_checkpoints_method_as_of', 'method', 'as_of', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    method = db.Column(db.String(40), nullable=False, default="FIFO")  # Cost basis method of the run
+    as_of = db.Column(db.DateTime, nullable=False)  # State before any transaction on/after this date
+    lots = db.Column(db.Text, nullable=False)  # JSON list of the open lots, in pool order
+
+class LotSelection(db.Model):
+    __tablename__ = 'lot_selections'
+
+    # Lots chosen for a disposal, used by the SPECIFIC cost basis method
+    id = db.Column(db.Integer, primary_key=True)
+    transaction_id = db.Column(db.Integer, db.ForeignKey('transactions.id'), nullable=False, index=True)  # SELL/SWAP
+    lot_transaction_id = db.Column(db.Integer, nullable=False)  # BUY transaction the lot came from
+    amount = db.Column(db.Float, nullable=False)  # Amount to take from that lot
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_kind_key_status', 'kind', 'key', 'status'),
+        db.Index('uq_jobs_pending_key', 'pending_key', unique=True),  # Coalescing across web workers
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)  # gains, import_kraken, sync, backfill
+    key = db.Column(db.String(255), nullable=False)  # Pending jobs with the same kind and key are coalesced
+    pending_key = db.Column(db.String(300), nullable=True)  # kind:key while the job can absorb new requests, else NULL
+    status = db.Column(db.String(16), nullable=False, default="queued")  # queued, running, done, failed
+    params = db.Column(db.Text, nullable=False, default="{}")  # JSON arguments for the job
+    result = db.Column(db.Text, nullable=True)  # JSON summary of a finished job
+    result_path = db.Column(db.String(500), nullable=True)  # File to download, e.g. a capital gains CSV
+    error = db.Column(db.Text, nullable=True)
+    worker = db.Column(db.String(100), nullable=True)  # host:pid of the process running the job
+    rows_done = db.Column(db.Integer, nullable=True)
+    rows_total = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+def create_tables():
+    """
+    Upgrade tables created by earlier versions, then create the missing tables
+    and indexes. Needs an app context.
+    """
+    upgrade_schema()
+    db.create_all()
+    # create_all() skips indexes on tables that already exist
+    for table in db.metadata.sorted_tables:
+        for table_index in table.indexes:
+            table_index.create(db.engine, checkfirst=True)
+
+
+# Indexes replaced by ones leading with the cost basis method; the unique one would
+# only allow one method's summary per tax year and asset
+_SUPERSEDED_INDEXES = [
+    "ix_lots_asset_name_transaction_date",
+    "ix_disposals_tax_year_date_sold_id",
+    "uq_gains_summary_tax_year_asset",
+]
+
+def upgrade_schema():
+    """
+    Bring a database created by an earlier version up to the current models:
+    create_all() adds missing tables but never changes existing ones. Each
+    step checks the live schema first, so running it on every start is safe.
+    """
+    existing = inspect(db.engine)
+    tables = set(existing.get_table_names())
+    with db.engine.begin() as connection:
+        if "transactions" in tables:
+            _add_columns(connection, existing, Transaction, ["balance_error"])
+            if "source" in _add_columns(connection, existing, Transaction, ["source", "external_id"]):
+                # Synced rows came from their chain; exchange rows cannot be told apart from manual ones
+                connection.execute(
+                    update(Transaction.__table__).where(Transaction.__table__.c.chain != "EXCH")
+                    .values(source=Transaction.__table__.c.chain)
+                )
+        if "gains_summary" in tables and "asset" not in {c["name"] for c in existing.get_columns("gains_summary")}:
+            # The yearly totals (tax_year UNIQUE) cannot be split by asset: drop the table for
+            # create_all() to recreate, and have every method's next run rebuild its summary
+            connection.execute(text(f"DROP TABLE {connection.dialect.identifier_preparer.quote('gains_summary')}"))
+            if "gains_runs" in tables:
+                connection.execute(update(GainsRun.__table__).values(computed_at=None))
+            tables.discard("gains_summary")
+        if "gains_state" in tables:
+            _add_columns(connection, existing, GainsState, ["errors_stale"])
+        if "gains_runs" in tables:
+            _add_columns(connection, existing, GainsRun, ["dirty_count", "lease_owner", "lease_expires_at"])
+        if "jobs" in tables:
+            _add_columns(connection, existing, Job, ["worker", "pending_key"])
+
+        # Results stored before the cost basis methods were added are FIFO ones
+        for model in (Lot, LotDisposal, GainsSummary):
+            if model.__tablename__ in tables:
+                _add_columns(connection, existing, model, ["method"])
+        if LotDisposal.__tablename__ in tables and "incomplete" in _add_columns(connection, existing, LotDisposal, ["incomplete"]):
+            # Flagged by the next run of each method, which then rebuilds its summary
+            if "gains_runs" in tables:
+                connection.execute(update(GainsRun.__table__).values(computed_at=None))
+        for name in _SUPERSEDED_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {connection.dialect.identifier_preparer.quote(name)}"))
+        # Holdings and checkpoints had a UNIQUE asset or date column, which SQLite cannot drop;
+        # they are rebuilt by the next run (a database this old has no gains_runs to mark yet)
+        for model in (Holding, LotCheckpoint):
+            if model.__tablename__ in tables and \
+                    "method" not in {c["name"] for c in existing.get_columns(model.__tablename__)}:
+                connection.execute(text(f"DROP TABLE {connection.dialect.identifier_preparer.quote(model.__tablename__)}"))
+
+
+def _add_columns(connection, existing, model, names):
+    """
+    ALTER TABLE ... ADD COLUMN for the named model columns the table lacks.
+    Existing rows get the column's default, if it has a scalar one.
+    :return: Names of the columns added.
+    """
+    present = {column["name"] for column in existing.get_columns(model.__tablename__)}
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    added = []
+    for name in names:
+        if name in present:
+            continue
+        column = model.__table__.columns[name]
+        ddl = f"ALTER TABLE {quote(model.__tablename__)} ADD COLUMN {quote(name)} {column.type.compile(dialect)}"
+        if column.default is not None and column.default.is_scalar:
+            default = literal(column.default.arg).compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+            ddl += f" DEFAULT {default}"
+            if not column.nullable:
+                ddl += " NOT NULL"
+        connection.execute(text(ddl))
+        added.append(name)
+    return added
+
+
+def get_gains_state(session=None):
+    """
+    Return the single GainsState row, creating it if needed.
+    """
+    session = session or db.session
+    with session.no_autoflush:
+        state = session.get(GainsState, 1)
+        if state is None:
+            state = GainsState(id=1, errors_stale=True)
+            session.add(state)
+    return state
+
+def get_gains_run(method, session=None):
+    """
+    Return the GainsRun row of a cost basis method, creating it if needed.
+    """
+    session = session or db.session
+    with session.no_autoflush:
+        run = session.query(GainsRun).filter_by(method=method).first()
+        if run is None:
+            run = GainsRun(method=method)
+            session.add(run)
+    return run
+
+def mark_dirty(transaction_date, session=None):
+    """
+    Lower the gains watermark of every method so their next run replays from
+    transaction_date, and flag the balance errors for a new sweep.
+    """
+    session = session or db.session
+    with session.no_autoflush:
+        for run in session.query(GainsRun):
+            if run.dirty_from is None or transaction_date < run.dirty_from:
+                run.dirty_from = transaction_date
+            run.dirty_count = GainsRun.dirty_count + 1
+    get_gains_state(session).errors_stale = True
+
+
+# Columns whose changes affect the computed gains
+_TRACKED_COLUMNS = [name for name in LEDGER_COLUMNS if name != "id"]
+
+@event.listens_for(Session, "before_flush")
+def track_dirty_transactions(session, flush_context, instances):
+    """
+    Record the earliest transaction date added, deleted or edited in this flush.
+    """
+    dates = []
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Transaction):
+            dates.append(obj.transaction_date)
+    for obj in session.dirty:
+        if not isinstance(obj, Transaction):
+            continue
+        state = inspect(obj)
+        if any(state.attrs[name].history.has_changes() for name in _TRACKED_COLUMNS):
+            dates.append(obj.transaction_date)
+            dates.extend(state.attrs.transaction_date.history.deleted)
+    dates = [d for d in dates if d is not None]
+    if dates:
+        mark_dirty(min(dates), session)
+
+
+def existing_external_ids(source, external_ids, chunk_size=500):
+    """
+    Return the subset of external_ids already stored for a source.
+    """
+    external_ids = list(external_ids)
+    found = set()
+    for i in range(0, len(external_ids), chunk_size):
+        chunk = external_ids[i:i + chunk_size]
+        found.update(
+            row.external_id for row in db.session.query(Transaction.external_id).filter(
+                Transaction.source == source, Transaction.external_id.in_(chunk)
+            )
+        )
+    return found
 
+def insert_ignore(model, rows, session=None):
+    """
+    Insert mappings, silently skipping rows that hit a unique constraint.
+    """
+    if not rows:
+        return
+    session = session or db.session
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(model.__table__).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(model.__table__).on_conflict_do_nothing()
+    else:
+        raise NotImplementedError(f"insert_ignore is not supported on {dialect}")
+    session.execute(stmt, rows)
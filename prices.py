@@ -0,0 +1,187 @@
+import time
+from bisect import bisect_left
+from datetime import datetime
+
+import requests
+
+from metrics import outbound_request
+from models import db, PricePoint, PriceChunk, COINGECKO_ASSET_MAPPING, insert_ignore
+from vars import coingecko_key
+
+COINGECKO_RANGE_URL = "https://api.coingecko.com/api/v3/coins/{gecko_id}/market_chart/range"
+
+# CoinGecko returns hourly prices for ranges of up to 90 days, so prices are
+# fetched in 90-day chunks aligned on multiples of CHUNK_SECONDS
+CHUNK_SECONDS = 90 * 86400
+
+# Largest distance (in seconds) between a lookup and the closest stored price
+MAX_PRICE_GAP = 86400
+
+
+def fetch_market_chart_range(gecko_id, range_start, range_end, vs_currency="usd"):
+    """
+    Fetch the [timestamp in ms, price] pairs CoinGecko has for a time range.
+    :param gecko_id: CoinGecko coin ID (e.g., "ethereum").
+    :param range_start: UNIX timestamp (seconds) of the start of the range.
+    :param range_end: UNIX timestamp (seconds) of the end of the range.
+    :param vs_currency: Target currency (e.g., "usd").
+    """
+    url = COINGECKO_RANGE_URL.format(gecko_id=gecko_id)
+    params = {
+        "vs_currency": vs_currency,
+        "from": range_start,
+        "to": range_end,
+    }
+    headers = {"x-cg-demo-api-key": coingecko_key} if coingecko_key else {}
+    with outbound_request("coingecko") as call:
+        response = requests.get(url, params=params, headers=headers)
+        call.status_code = response.status_code
+    if response.status_code != 200:
+        raise Exception(f"Error fetching price range: {response.status_code}, {response.text}")
+    return response.json().get("prices", [])
+
+
+class PriceStore:
+    """
+    Historical USD prices backed by the price_points table.
+
+    Each asset's stored prices are loaded once into sorted in-memory lists and
+    looked up with bisect. Missing data is fetched from CoinGecko one aligned
+    chunk at a time, so nearby and repeated lookups never go to the network.
+
+    The price_chunks table records how far each fetched chunk is complete: a
+    chunk fetched before its end (the one holding "now") only covers up to its
+    fetch time, and is fetched again once lookups need later prices.
+    """
+
+    def __init__(self, fetch_range=fetch_market_chart_range):
+        self.fetch_range = fetch_range
+        self.timestamps = {}  # asset -> sorted list of UNIX timestamps
+        self.prices = {}  # asset -> prices matching self.timestamps
+        self.fetched_chunks = {}  # asset -> chunk starts fetched by this process
+        self.covered = {}  # asset -> {chunk start: UNIX time its prices are complete up to}
+
+    def _load(self, asset):
+        if asset not in self.timestamps:
+            rows = db.session.query(PricePoint.timestamp, PricePoint.price_usd) \
+                .filter(PricePoint.asset == asset).order_by(PricePoint.timestamp).all()
+            self.timestamps[asset] = [row.timestamp for row in rows]
+            self.prices[asset] = [row.price_usd for row in rows]
+            self.fetched_chunks[asset] = set()
+            covered = dict(
+                db.session.query(PriceChunk.chunk_start, PriceChunk.covered_until).filter(PriceChunk.asset == asset)
+            )
+            # Chunks stored before coverage was recorded: complete if their last
+            # price is within MAX_PRICE_GAP of the end, else up to that price
+            for timestamp in self.timestamps[asset]:
+                chunk_start = timestamp - timestamp % CHUNK_SECONDS
+                if chunk_start not in covered:
+                    chunk_end = chunk_start + CHUNK_SECONDS
+                    covered[chunk_start] = chunk_end if timestamp >= chunk_end - MAX_PRICE_GAP else timestamp
+            self.covered[asset] = covered
+
+    def _has_chunk(self, asset, chunk_start, needed_until):
+        """
+        Whether a chunk's stored prices are complete up to needed_until (or the chunk end).
+        """
+        covered_until = self.covered[asset].get(chunk_start)
+        return covered_until is not None and covered_until >= min(needed_until, chunk_start + CHUNK_SECONDS)
+
+    def _fetch_chunk(self, asset, chunk_start):
+        gecko_id = COINGECKO_ASSET_MAPPING[asset]
+        requested_at = int(time.time())
+        points = self.fetch_range(gecko_id, chunk_start, chunk_start + CHUNK_SECONDS)
+        self.store_chunk(asset, chunk_start, points, requested_at)
+
+    def store_chunk(self, asset, chunk_start, points, requested_at):
+        """
+        Persist the [timestamp in ms, price] pairs fetched for one chunk, and
+        how far they cover it.
+        :param requested_at: UNIX time the range was requested; no prices after it can be in `points`.
+        """
+        self._load(asset)
+        rows = [
+            {"asset": asset, "timestamp": int(timestamp // 1000), "price_usd": price}
+            for timestamp, price in points
+        ]
+        insert_ignore(PricePoint, rows)
+        covered_until = min(chunk_start + CHUNK_SECONDS, requested_at)
+        chunk = PriceChunk.query.filter_by(asset=asset, chunk_start=chunk_start).first()
+        if chunk is None:
+            chunk = PriceChunk(asset=asset, chunk_start=chunk_start)
+            db.session.add(chunk)
+        chunk.covered_until = max(chunk.covered_until or 0, covered_until)
+        chunk.fetched_at = datetime.now()
+        db.session.commit()
+        self.fetched_chunks[asset].add(chunk_start)
+        self.covered[asset][chunk_start] = chunk.covered_until
+
+        # Merge into the in-memory index
+        merged = dict(zip(self.timestamps[asset], self.prices[asset]))
+        merged.update((row["timestamp"], row["price_usd"]) for row in rows)
+        self.timestamps[asset] = sorted(merged)
+        self.prices[asset] = [merged[timestamp] for timestamp in self.timestamps[asset]]
+
+    @staticmethod
+    def _chunks(range_start, range_end):
+        chunk_start = range_start - range_start % CHUNK_SECONDS
+        while chunk_start <= range_end:
+            yield chunk_start
+            chunk_start += CHUNK_SECONDS
+
+    def missing_chunks(self, asset, range_start, range_end):
+        """
+        Start times of the chunks between two UNIX timestamps whose stored
+        prices do not cover the range (up to now).
+        """
+        self._load(asset)
+        needed_until = min(range_end, int(time.time()))
+        return [
+            chunk_start for chunk_start in self._chunks(range_start, range_end)
+            if not self._has_chunk(asset, chunk_start, needed_until)
+        ]
+
+    def prefetch(self, asset, range_start, range_end):
+        """
+        Make sure prices for an asset between two UNIX timestamps are stored locally.
+        """
+        for chunk_start in self.missing_chunks(asset, range_start, range_end):
+            self._fetch_chunk(asset, chunk_start)
+
+    def lookup(self, asset, timestamp):
+        """
+        Return the stored price closest to a UNIX timestamp, or None, without fetching.
+        """
+        self._load(asset)
+        return self._closest(asset, timestamp)
+
+    def _closest(self, asset, timestamp):
+        timestamps = self.timestamps[asset]
+        i = bisect_left(timestamps, timestamp)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(timestamps)]
+        if not candidates:
+            return None
+        j = min(candidates, key=lambda k: abs(timestamps[k] - timestamp))
+        if abs(timestamps[j] - timestamp) > MAX_PRICE_GAP:
+            return None
+        return self.prices[asset][j]
+
+    def get_price(self, asset, timestamp):
+        """
+        Return the stored price closest to a UNIX timestamp, fetching it if needed.
+        """
+        self._load(asset)
+        price = self._closest(asset, timestamp)
+        if price is None:
+            # Stored chunks may predate the data we need, so refetch anything
+            # around the lookup that this process has not fetched itself
+            for chunk_start in self._chunks(timestamp - MAX_PRICE_GAP, timestamp + MAX_PRICE_GAP):
+                if chunk_start not in self.fetched_chunks[asset]:
+                    self._fetch_chunk(asset, chunk_start)
+            price = self._closest(asset, timestamp)
+        if price is None:
+            raise ValueError("No price data found for the given range.")
+        return price
+
+
+price_store = PriceStore()
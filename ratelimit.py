@@ -0,0 +1,56 @@
+import logging
+import threading
+import time
+
+from metrics import OUTBOUND_RETRIES, RATE_LIMIT_WAITS, RATE_LIMIT_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 2.0
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting how often outbound requests can start.
+    :param name: Service the bucket limits, used to label its metrics.
+    """
+
+    def __init__(self, rate, capacity, name="other"):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            RATE_LIMIT_WAITS.inc(service=self.name)
+            RATE_LIMIT_WAIT_SECONDS.inc(wait, service=self.name)
+            time.sleep(wait)
+
+
+def fetch_with_retry(fetch, bucket, *args, retries=MAX_RETRIES, backoff=RETRY_BACKOFF_SECONDS):
+    """
+    Call fetch(*args) once a token is available, retrying with exponential backoff.
+    """
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            return fetch(*args)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            OUTBOUND_RETRIES.inc(service=bucket.name)
+            logger.warning("Request failed, retrying", extra={"service": bucket.name, "error": str(e), "delay": delay})
+            time.sleep(delay)
@@ -0,0 +1,245 @@
+"""
+Database backends: SQLite (the default) or PostgreSQL, chosen by DATABASE_URL.
+
+This module holds what differs between them: the engine and connection pool
+options, the per-connection SQLite tuning, and the bulk write path used by
+imports and gains runs (COPY on PostgreSQL, batched executemany elsewhere).
+It is imported by config.py, which registers the SQLite tuning for every engine.
+"""
+import io
+import sqlite3
+from datetime import datetime, date
+
+from sqlalchemy import event, insert, text
+from sqlalchemy.engine import Engine, make_url
+
+# Seconds a SQLite connection waits for another process's write lock before failing
+SQLITE_BUSY_TIMEOUT = 30
+
+# Page cache per SQLite connection, in KiB
+SQLITE_CACHE_SIZE_KB = 64 * 1024
+
+# Seconds after which a pooled PostgreSQL connection is replaced (servers and proxies drop idle ones)
+POSTGRES_POOL_RECYCLE = 1800
+
+# Below this many rows, COPY costs more in setup than executemany
+COPY_MIN_ROWS = 500
+
+# Bytes sent per write during a COPY
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def normalize_database_url(url):
+    """
+    Accept the postgres:// scheme some hosts hand out, which SQLAlchemy rejects.
+    """
+    if url.startswith("postgres://"):
+        return "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def engine_options(url, pool_size, max_overflow):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS for a database URL.
+    :param pool_size: Connections kept open per process.
+    :param max_overflow: Extra connections opened under load, closed when returned.
+    """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return {}  # Flask-SQLAlchemy shares a single connection
+        return {
+            "pool_size": pool_size,
+            "max_overflow": max_overflow,
+            "connect_args": {"timeout": SQLITE_BUSY_TIMEOUT},
+        }
+    options = {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_pre_ping": True,
+    }
+    if backend == "postgresql":
+        options["pool_recycle"] = POSTGRES_POOL_RECYCLE
+        if url.get_driver_name() == "psycopg2":
+            # Send executemany UPDATEs in pages instead of one round trip per row
+            options["executemany_mode"] = "values_plus_batch"
+    return options
+
+
+@event.listens_for(Engine, "connect")
+def tune_sqlite(dbapi_connection, connection_record):
+    """
+    Use write-ahead logging on SQLite, so pages keep being served from the last
+    committed state while a gains run writes its results. With WAL, NORMAL
+    synchronous only fsyncs at checkpoints and stays safe against corruption.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+
+def bulk_insert(session, model, rows):
+    """
+    Insert mappings in the session's transaction, with COPY on PostgreSQL.
+    Like bulk_insert_mappings(), this bypasses the change tracking.
+    """
+    if not rows:
+        return
+    table = model.__table__
+    rows = _with_defaults(table, rows)
+    keys = rows[0].keys()
+    if session.get_bind().dialect.name == "postgresql" and len(rows) >= COPY_MIN_ROWS:
+        columns = [column for column in table.columns if column.name in set().union(*rows)]
+        _copy(session, _quote_table(session, table), columns, rows)
+    elif all(row.keys() == keys for row in rows):
+        # One executemany; bulk_insert_mappings() splits the rows wherever a
+        # different set of columns is None
+        session.execute(insert(table), rows)
+    else:
+        session.bulk_insert_mappings(model, rows)
+
+
+def bulk_update(session, model, rows):
+    """
+    Update rows by primary key from mappings, in the session's transaction.
+    On PostgreSQL the values are copied into a temporary table and applied
+    with a single UPDATE ... FROM. Like bulk_update_mappings(), this bypasses
+    the change tracking.
+    """
+    if not rows:
+        return
+    if session.get_bind().dialect.name != "postgresql" or len(rows) < COPY_MIN_ROWS:
+        session.bulk_update_mappings(model, rows)
+        return
+
+    table = model.__table__
+    primary_key = table.primary_key.columns.values()[0].name
+    # Rows setting different columns (e.g. only some prices) are applied separately
+    by_keys = {}
+    for row in rows:
+        by_keys.setdefault(tuple(sorted(row)), []).append(row)
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    target = _quote_table(session, table)
+    for keys, group in by_keys.items():
+        columns = [primary_key] + [key for key in keys if key != primary_key]
+        names = ", ".join(quote(column) for column in columns)
+        session.execute(text(f"CREATE TEMPORARY TABLE bulk_update AS SELECT {names} FROM {target} WITH NO DATA"))
+        _copy(session, "bulk_update", [table.columns[column] for column in columns], group)
+        assignments = ", ".join(f"{quote(column)} = bulk_update.{quote(column)}" for column in columns[1:])
+        session.execute(text(
+            f"UPDATE {target} SET {assignments} FROM bulk_update "
+            f"WHERE {target}.{quote(primary_key)} = bulk_update.{quote(primary_key)}"
+        ))
+        session.execute(text("DROP TABLE bulk_update"))
+
+
+def reset_id_sequence(session, model):
+    """
+    Move PostgreSQL's id sequence past rows inserted with explicit ids, so
+    the next insert does not reuse one. SQLite always continues from the
+    highest id.
+    """
+    if session.get_bind().dialect.name != "postgresql":
+        return
+    table = model.__table__
+    primary_key = table.primary_key.columns.values()[0].name
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    session.execute(
+        text(f"SELECT setval(pg_get_serial_sequence(:table, :column), COALESCE(MAX({quote(primary_key)}), 0) + 1, "
+             f"false) FROM {_quote_table(session, table)}"),
+        {"table": table.name, "column": primary_key},
+    )
+
+
+def _quote_table(session, table):
+    return session.get_bind().dialect.identifier_preparer.format_table(table)
+
+
+def _with_defaults(table, rows):
+    """
+    The rows with the column defaults filled in where a value is missing or
+    None, as bulk_insert_mappings() does. Callable defaults are evaluated once.
+    """
+    defaults = [(column.name, _default_value(column)) for column in table.columns
+                if column.default is not None and not column.primary_key]
+    filled = []
+    for row in rows:
+        missing = {name: value for name, value in defaults if row.get(name) is None}
+        filled.append({**row, **missing} if missing else row)
+    return filled
+
+
+def _copy(session, target, columns, rows):
+    """
+    Stream mappings into a table with COPY FROM STDIN, in its text format.
+    Columns a row does not set are NULL.
+    """
+    names = [column.name for column in columns]
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(row.get(name)) for name in names))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    _copy_from(session, f"COPY {target} ({', '.join(quote(name) for name in names)}) FROM STDIN", buffer)
+
+
+def copy_csv(session, model, names, stream):
+    """
+    Load CSV rows (no header; NULL as an unquoted empty field, so empty
+    strings must be quoted) into a table with COPY. PostgreSQL only.
+    :param names: Columns of the CSV, in order.
+    """
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    sql = f"COPY {_quote_table(session, model.__table__)} ({', '.join(quote(name) for name in names)}) " \
+          f"FROM STDIN WITH (FORMAT csv)"
+    _copy_from(session, sql, stream)
+
+
+def _copy_from(session, sql, stream):
+    """
+    Run a COPY FROM STDIN on the connection of the session's current
+    transaction, reading a file-like object. Supports psycopg 3 and psycopg2.
+    """
+    cursor = session.connection().connection.cursor()
+    try:
+        if hasattr(cursor, "copy"):
+            with cursor.copy(sql) as copy:
+                while data := stream.read(COPY_CHUNK_SIZE):
+                    copy.write(data)
+        else:
+            cursor.copy_expert(sql, stream, size=COPY_CHUNK_SIZE)
+    finally:
+        cursor.close()
+
+
+def _default_value(column):
+    default = column.default
+    if default is None:
+        return None
+    if default.is_callable:
+        return default.arg(None)
+    return default.arg
+
+
+# Characters with a meaning in COPY's text format
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(value)
+    return str(value).translate(_COPY_ESCAPES)